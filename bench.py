@@ -0,0 +1,433 @@
+"""
+bench.py
+
+Copyright (C) 2020-2021 Tomas Hlavacek (tmshlvck@gmail.com)
+
+Benchmarks for the sim driver, run against simemu.ScriptedModem,
+on a host with CPython: PYTHONPATH=host python3 bench.py [--json out.json] [--compare base.json]
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import gc
+import usys
+import ujson
+import utime
+import uasyncio
+import sim
+import simemu
+import codec
+
+
+def _alloc_start():
+  gc.collect()
+  try:
+    a = gc.mem_alloc()
+    gc.disable()
+    return a
+  except AttributeError: # CPython
+    import tracemalloc
+    tracemalloc.start()
+    return 0
+
+
+def _alloc_stop(start):
+  """
+  MicroPython: heap bytes allocated since _alloc_start()
+  CPython: peak of traced memory since _alloc_start()
+  """
+  try:
+    a = gc.mem_alloc() - start
+    gc.enable()
+    return a
+  except AttributeError:
+    import tracemalloc
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def _sim(modem):
+  s = sim.SIM(None, None, None, None)
+  s.attach(modem, modem)
+  return s
+
+
+async def bench_mqtt_pub(n=50, size=64, latency_ms=20):
+  """
+  publish n messages of size bytes, the modem answers every step after latency_ms
+  """
+  modem = simemu.ScriptedModem(latency_ms=latency_ms)
+  s = _sim(modem)
+  msg = 'x' * size
+  t = utime.ticks_ms()
+  for i in range(n):
+    await s.mqtt_pub('bench/%d' % i, msg)
+  dt = utime.ticks_diff(utime.ticks_ms(), t)
+  await s.detach()
+  rate = n * 1000 / dt if dt else 0
+  print("mqtt_pub: %d msgs (%d B) in %d ms, %.1f msg/s" % (n, size, dt, rate))
+  return {'msg_s': rate}
+
+
+async def bench_init():
+  """
+  SIM.init() against the emulator, warm (modem answers AT) and cold (power-on
+  pulses, on the host machine.Pin is a stand-in so only the pulse waits count)
+  """
+  res = {}
+  for cold in (False, True):
+    modem = simemu.ScriptedModem()
+    s = sim.SIM(4, 5, None, None)
+    s.attach(modem, modem)
+    t = utime.ticks_ms()
+    await s.init(cold)
+    dt = utime.ticks_diff(utime.ticks_ms(), t)
+    await s.detach()
+    name = 'cold' if cold else 'warm'
+    print("init %s: %d ms %s" % (name, dt, str(s.timings)))
+    res[name + '_ms'] = dt
+  return res
+
+
+async def bench_at(n=200):
+  """
+  round trip of AT/OK against a modem answering without delay, i.e. the
+  driver overhead per command, with and without metrics
+  """
+  res = {}
+  for metrics in (True, False):
+    modem = simemu.ScriptedModem()
+    s = _sim(modem)
+    if not metrics:
+      s.metrics = None
+    await s.at('AT', 'OK')
+    t = utime.ticks_us()
+    for _ in range(n):
+      await s.at('AT', 'OK')
+    dt = utime.ticks_diff(utime.ticks_us(), t) / n
+    await s.detach()
+    name = 'us' if metrics else 'us_nometrics'
+    print("at() round trip: %.1f us%s" % (dt, '' if metrics else ' without metrics'))
+    res[name] = dt
+  return res
+
+
+async def bench_urc_flood(n=2000):
+  """
+  lines/s through the reader and the URC table for a burst of n +CREG URCs,
+  and the latency of an AT command issued during the burst
+  """
+  modem = simemu.ScriptedModem()
+  s = _sim(modem)
+  await s.at('AT', 'OK')
+  t = utime.ticks_ms()
+  modem.feed(b'\r\n+CREG: 1,"0B4C","01A2B3C4",7\r\n' * n) # URC format, no <n>
+  ta = utime.ticks_ms()
+  await s.at('AT', 'OK')
+  lat = utime.ticks_diff(utime.ticks_ms(), ta)
+  while s.urc.counters[b'+CREG:'] < n and utime.ticks_diff(utime.ticks_ms(), t) < 30000:
+    await uasyncio.sleep_ms(1)
+  dt = utime.ticks_diff(utime.ticks_ms(), t)
+  await s.detach()
+  rate = s.urc.counters[b'+CREG:'] * 1000 / dt if dt else 0
+  print("URC flood: %d lines in %d ms, %.0f lines/s, AT during flood %d ms" % (n, dt, rate, lat))
+  return {'lines_s': rate, 'at_ms': lat}
+
+
+CMGL = ''.join('+CMGL: %d,"REC READ","+420777123%03d",,"21/05/%02d,22:10:39+08"\n'
+               'Battery low, please check unit %d at the north gate\n' % (i, i, i % 28 + 1, i)
+               for i in range(10)) + 'OK'
+
+async def bench_cmgl(n=50):
+  """
+  atcsv_multi() on an inbox of 10 messages, end to end, streamed by
+  get_sms_iter() and the parsing alone
+  """
+  modem = simemu.ScriptedModem({'AT+CMGL=': CMGL})
+  s = _sim(modem)
+  await s.get_sms()
+  t = utime.ticks_us()
+  for _ in range(n):
+    await s.get_sms()
+  dt = utime.ticks_diff(utime.ticks_us(), t) / n
+  t = utime.ticks_us()
+  for _ in range(n):
+    async with s.get_sms_iter() as msgs:
+      async for _ in msgs:
+        pass
+  dts = utime.ticks_diff(utime.ticks_us(), t) / n
+  await s.detach()
+  lines = [l.encode() + b'\r\n' for l in CMGL.split('\n') if l.startswith('+CMGL')]
+  def parse():
+    for l in lines:
+      sim.splitcsv(l, sim.csvstart(l, b'+CMGL:'))
+  r = _bench_parse('cmgl', parse, n)
+  print("get_sms: %.1f us per 10 messages, streamed %.1f us" % (dt, dts))
+  return {'get_sms_us': dt, 'get_sms_iter_us': dts, 'parse_us': r['us'], 'parse_alloc': r['alloc']}
+
+
+async def bench_uplink_mem(nkeys=10):
+  """
+  heap allocated (MicroPython) or peak traced memory (CPython) by one
+  MQTTUplink publish cycle
+  """
+  data = dict(('k%d' % i, 20.0 + i) for i in range(nkeys))
+  modem = simemu.ScriptedModem()
+  u = sim.MQTTUplink({})
+  u.sim = _sim(modem)
+  await u._publish(data) # first cycle sets up the delta state
+  for k in data:
+    data[k] += 1
+  a = _alloc_start()
+  await u._publish(data)
+  alloc = _alloc_stop(a)
+  await u.sim.detach()
+  print("uplink cycle: %d keys, %d B" % (nkeys, alloc))
+  return {'bytes': alloc}
+
+
+# the character-by-character parser sim.atcsv_multi used before splitcsv()
+def _legacy_splitcsv(l):
+  acc = ''
+  quote = None
+  for c in l:
+    if quote:
+      acc += c
+      if c == quote:
+        quote = None
+    else:
+      if c == ',':
+        yield acc
+        acc = ''
+      elif c in ["'", '"']:
+        acc += c
+        quote = c
+      else:
+        acc += c
+  if acc:
+    yield acc
+
+
+def _legacy_parse(rl, keystr):
+  l = rl.decode().strip()
+  if l.startswith(keystr):
+    g = list(_legacy_splitcsv(l))
+    g[0] = g[0].split(':', 1)[1].lstrip()
+    return g
+
+
+CSV_SAMPLES = (
+  ('+CPSI', sim.NetInfo, b'+CPSI: LTE CAT-M1,Online,230-03,0x0B4C,27458329,347,EUTRAN-BAND20,6300,3,3,-10,-97,-69,13\r\n'),
+  ('+CSQ', sim.SignalInfo, b'+CSQ: 20,99\r\n'),
+  ('+CREG', sim.NetReg, b'+CREG: 0,1\r\n'),
+  ('+CGNSINF', sim.GNSSInfo, b'+CGNSINF: 1,1,20210510221039.000,50.087451,14.420671,235.400,0.00,0.0,1,,1.1,1.4,0.9,,12,8,3,,38,,\r\n'),
+  )
+
+def _bench_parse(name, f, n):
+  f() # warm up
+  t = utime.ticks_us()
+  for _ in range(n):
+    f()
+  dt = utime.ticks_diff(utime.ticks_us(), t)
+  a = _alloc_start()
+  f()
+  alloc = _alloc_stop(a)
+  print("  %-8s %8.1f us/parse %8d B/parse" % (name, dt / n, alloc))
+  return {'us': dt / n, 'alloc': alloc}
+
+
+def bench_csv_parse(n=200):
+  """
+  time and heap allocation per parsed line, old parser vs. splitcsv/Record
+  """
+  res = {}
+  for keystr, cls, l in CSV_SAMPLES:
+    key = keystr.encode()
+    print("%s:" % keystr)
+    res[keystr] = {
+      'legacy': _bench_parse('legacy', lambda: _legacy_parse(l, keystr), n),
+      'spans': _bench_parse('spans', lambda: sim.splitcsv(l, sim.csvstart(l, key)), n),
+      'record': _bench_parse('record', lambda: cls.parse(l, sim.csvstart(l, key)), n),
+      }
+  return res
+
+
+# representative telemetry dict of a sensor node
+TELEMETRY = {
+  'temp': 21.5, 'hum': 48, 'press': 1013.25, 'bat': 3.71, 'rssi': -97,
+  'door': False, 'uptime': 864123, 'name': 'beetle',
+  'adc': [512, 498, 505, 530, 517, 501, 499, 510],
+  }
+
+def bench_codec(n=200, value=TELEMETRY):
+  """
+  encoded size, encode/decode time and chunk count per codec
+  """
+  res = {}
+  for c in (codec.JSON, codec.CBOR):
+    e = c.encode(value)
+    t = utime.ticks_us()
+    for _ in range(n):
+      c.encode(value)
+    te = utime.ticks_diff(utime.ticks_us(), t) / n
+    t = utime.ticks_us()
+    for _ in range(n):
+      c.decode(e)
+    td = utime.ticks_diff(utime.ticks_us(), t) / n
+    # the same value repeated until it needs chunking
+    big = c.encode([value] * 8)
+    nch = len(codec.chunks(big, sim.SIM.MQTT_MAX_PAYLOAD, 0))
+    print("codec %-5s %4d B  enc %7.1f us  dec %7.1f us  %5.0f kB/s  8x: %d B in %d chunks" %
+          (c.name, len(e), te, td, len(e) * 1000 / te if te else 0, len(big), nch))
+    res[c.name] = {'size': len(e), 'enc_us': te, 'dec_us': td, 'big_size': len(big), 'big_chunks': nch}
+  return res
+
+
+async def bench_uplink_batch(nkeys=10, latency_ms=20):
+  """
+  one MQTTUplink publish cycle with nkeys changed keys, per-key topics vs. batch mode
+  """
+  res = {}
+  data = dict(('k%d' % i, 20.0 + i) for i in range(nkeys))
+  for batch in (False, True):
+    modem = simemu.ScriptedModem(latency_ms=latency_ms)
+    u = sim.MQTTUplink({})
+    u.BATCH = batch
+    u.sim = _sim(modem)
+    t = utime.ticks_ms()
+    await u._publish(data)
+    dt = utime.ticks_diff(utime.ticks_ms(), t)
+    await u.sim.detach()
+    msgs = len(modem.published)
+    nbytes = sum(len(p) + len(c) for c, p in modem.published)
+    name = 'batch' if batch else 'per-key'
+    print("uplink %-7s %2d keys: %3d AT cmds, %2d MQTT msgs, %5d B, %5d ms" %
+          (name, nkeys, len(modem.cmds), msgs, nbytes, dt))
+    res[name] = {'cmds': len(modem.cmds), 'msgs': msgs, 'bytes': nbytes, 'ms': dt}
+  return res
+
+
+async def bench_gnss_track(nfixes=120):
+  """
+  nfixes positions uploaded as 'loc' polls vs. one simplified 'track'
+  """
+  res = {}
+  for track in (False, True):
+    modem = simemu.ScriptedModem()
+    modem.fix_ms = 2
+    u = sim.MQTTUplink({})
+    u.ENABLE_GNSS = True
+    u.TRACK = track
+    u.sim = _sim(modem)
+    t = utime.ticks_ms()
+    if track:
+      tr = await u.sim.gnss_track(1, nfixes)
+      while tr.added < nfixes:
+        await uasyncio.sleep_ms(10)
+      await u.sim.gnss_track(0)
+      t = utime.ticks_ms()
+      await u._publish({}, ('track',))
+    else:
+      for _ in range(nfixes):
+        await u._publish({}, ('loc',))
+    dt = utime.ticks_diff(utime.ticks_ms(), t)
+    await u.sim.detach()
+    nbytes = sum(len(p) + len(c) for c, p in modem.published)
+    name = 'track' if track else 'loc'
+    print("gnss %-5s %3d fixes: %3d AT cmds, %3d MQTT msgs, %5d B, %5d ms" %
+          (name, nfixes, len(modem.cmds), len(modem.published), nbytes, dt))
+    res[name] = {'cmds': len(modem.cmds), 'msgs': len(modem.published), 'bytes': nbytes, 'ms': dt}
+  return res
+
+
+async def bench_baudrates(rates=(9600, 115200, 921600), s=None):
+  """
+  AT+CLAC throughput at each rate, against the emulated wire unless an
+  initialized sim.SIM is given, the initial rate is restored at the end
+  """
+  modem = None
+  if s is None:
+    modem = simemu.ScriptedModem(baudrate=9600)
+    s = _sim(modem)
+    s.baudrate = 9600
+  start = s.baudrate
+  res = {}
+  for r in rates:
+    if not await s.set_baudrate(r):
+      print("baudrate %7d: not supported" % r)
+      continue
+    bps = await s.throughput()
+    print("baudrate %7d: %8.0f B/s" % (r, bps))
+    res[r] = bps
+  await s.set_baudrate(start)
+  if modem:
+    await s.detach()
+  return res
+
+
+def flatten(res, prefix=''):
+  """
+  {'a': {'b': 1}} -> {'a.b': 1}, numeric leaves only
+  """
+  out = {}
+  for k in res:
+    v = res[k]
+    if type(v) is dict:
+      out.update(flatten(v, '%s%s.' % (prefix, k)))
+    elif type(v) in (int, float):
+      out[prefix + str(k)] = v
+  return out
+
+
+def compare(base, res, threshold=10):
+  """
+  print metrics that moved by more than threshold percent against base
+  """
+  b = flatten(base.get('results', base))
+  r = flatten(res.get('results', res))
+  print("%-40s %12s %12s %8s" % ('metric', 'base', 'now', 'delta'))
+  for k in sorted(r):
+    if k not in b:
+      continue
+    d = (r[k] - b[k]) * 100 / b[k] if b[k] else 0
+    if abs(d) >= threshold:
+      print("%-40s %12.1f %12.1f %+7.1f%%" % (k, b[k], r[k], d))
+
+
+def run(argv=()):
+  sim.DEBUG = False
+  res = {}
+  res['init'] = uasyncio.run(bench_init())
+  res['at'] = uasyncio.run(bench_at())
+  res['mqtt_pub'] = uasyncio.run(bench_mqtt_pub())
+  res['urc_flood'] = uasyncio.run(bench_urc_flood())
+  res['csv_parse'] = bench_csv_parse()
+  res['cmgl'] = uasyncio.run(bench_cmgl())
+  res['codec'] = bench_codec()
+  res['uplink_batch'] = uasyncio.run(bench_uplink_batch())
+  res['uplink_mem'] = uasyncio.run(bench_uplink_mem())
+  res['gnss_track'] = uasyncio.run(bench_gnss_track())
+  res['baudrates'] = dict((str(k), v) for k, v in uasyncio.run(bench_baudrates()).items())
+  out = {'platform': usys.platform, 'implementation': usys.implementation.name, 'results': res}
+
+  argv = list(argv)
+  if '--json' in argv:
+    with open(argv[argv.index('--json') + 1], 'w') as f:
+      f.write(ujson.dumps(out))
+  if '--compare' in argv:
+    with open(argv[argv.index('--compare') + 1]) as f:
+      compare(ujson.loads(f.read()), out)
+  return out
+
+
+if __name__ == '__main__':
+  run(usys.argv[1:])
@@ -0,0 +1,262 @@
+"""
+codec.py
+
+Copyright (C) 2020-2021 Tomas Hlavacek (tmshlvck@gmail.com)
+
+Payload codecs and chunking for the MQTT publish path
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import ujson
+import ustruct
+
+
+class JSONCodec:
+  name = 'json'
+
+  def encode(self, v):
+    return ujson.dumps(v).encode()
+
+
+  def decode(self, b):
+    return ujson.loads(b)
+
+
+class CBORCodec:
+  """
+  Subset of CBOR (RFC 8949): None, bool, int, float, str, bytes, list/tuple, dict.
+  Floats go out as float32 when that is lossless, float64 otherwise.
+  """
+  name = 'cbor'
+
+  @staticmethod
+  def _head(out, major, n):
+    major <<= 5
+    if n < 24:
+      out.append(major | n)
+    elif n < 0x100:
+      out.append(major | 24)
+      out.append(n)
+    elif n < 0x10000:
+      out.append(major | 25)
+      out.extend(ustruct.pack('>H', n))
+    elif n < 0x100000000:
+      out.append(major | 26)
+      out.extend(ustruct.pack('>I', n))
+    else:
+      out.append(major | 27)
+      out.extend(ustruct.pack('>Q', n))
+
+
+  def _enc(self, out, v):
+    t = type(v)
+    if v is None:
+      out.append(0xf6)
+    elif v is True:
+      out.append(0xf5)
+    elif v is False:
+      out.append(0xf4)
+    elif t is int:
+      if v >= 0:
+        self._head(out, 0, v)
+      else:
+        self._head(out, 1, -1 - v)
+    elif t is float:
+      f = ustruct.pack('>f', v)
+      if ustruct.unpack('>f', f)[0] == v:
+        out.append(0xfa)
+        out.extend(f)
+      else:
+        out.append(0xfb)
+        out.extend(ustruct.pack('>d', v))
+    elif t is str:
+      b = v.encode()
+      self._head(out, 3, len(b))
+      out.extend(b)
+    elif t is bytes or t is bytearray:
+      self._head(out, 2, len(v))
+      out.extend(v)
+    elif t is list or t is tuple:
+      self._head(out, 4, len(v))
+      for e in v:
+        self._enc(out, e)
+    elif t is dict:
+      self._head(out, 5, len(v))
+      for k in v:
+        self._enc(out, k)
+        self._enc(out, v[k])
+    else:
+      raise TypeError('Can not encode %s' % str(t))
+
+
+  def encode(self, v):
+    out = bytearray()
+    self._enc(out, v)
+    return bytes(out)
+
+
+  def _dec(self, b, i):
+    ib = b[i]
+    major = ib >> 5
+    ai = ib & 0x1f
+    i += 1
+    if major == 7:
+      if ai == 20:
+        return False, i
+      if ai == 21:
+        return True, i
+      if ai == 22 or ai == 23:
+        return None, i
+      if ai == 25: # float16
+        h = b[i] << 8 | b[i+1]
+        e = (h >> 10) & 0x1f
+        m = h & 0x3ff
+        if e == 0:
+          v = m * 2.0 ** -24
+        elif e == 31:
+          v = float('inf') if m == 0 else float('nan')
+        else:
+          v = (m + 1024) * 2.0 ** (e - 25)
+        return (-v if h & 0x8000 else v), i + 2
+      if ai == 26:
+        return ustruct.unpack('>f', b[i:i+4])[0], i + 4
+      if ai == 27:
+        return ustruct.unpack('>d', b[i:i+8])[0], i + 8
+      raise ValueError('Unsupported CBOR simple value %d' % ai)
+    if ai < 24:
+      n = ai
+    elif ai == 24:
+      n = b[i]
+      i += 1
+    elif ai == 25:
+      n = ustruct.unpack('>H', b[i:i+2])[0]
+      i += 2
+    elif ai == 26:
+      n = ustruct.unpack('>I', b[i:i+4])[0]
+      i += 4
+    elif ai == 27:
+      n = ustruct.unpack('>Q', b[i:i+8])[0]
+      i += 8
+    else:
+      raise ValueError('Unsupported CBOR length %d' % ai)
+    if major == 0:
+      return n, i
+    if major == 1:
+      return -1 - n, i
+    if major == 2:
+      return bytes(b[i:i+n]), i + n
+    if major == 3:
+      return bytes(b[i:i+n]).decode(), i + n
+    if major == 4:
+      r = []
+      for _ in range(n):
+        v, i = self._dec(b, i)
+        r.append(v)
+      return r, i
+    if major == 5:
+      r = {}
+      for _ in range(n):
+        k, i = self._dec(b, i)
+        r[k], i = self._dec(b, i)
+      return r, i
+    raise ValueError('Unsupported CBOR major type %d' % major)
+
+
+  def decode(self, b):
+    return self._dec(b, 0)[0]
+
+
+class StructCodec:
+  """
+  Fixed binary layout for values with a known shape, fmt is a ustruct
+  format, e.g. '<hH' for a list [temperature_decicelsius, humidity_permille]
+  """
+  def __init__(self, fmt):
+    self.fmt = fmt
+    self.name = 'struct:%s' % fmt
+
+
+  def encode(self, v):
+    if type(v) is list or type(v) is tuple:
+      return ustruct.pack(self.fmt, *v)
+    return ustruct.pack(self.fmt, v)
+
+
+  def decode(self, b):
+    r = ustruct.unpack(self.fmt, b)
+    return r[0] if len(r) == 1 else list(r)
+
+
+JSON = JSONCodec()
+CBOR = CBORCodec()
+
+
+# Chunking of payloads over the modem limit
+#
+# Frame: magic(1) msgid(2) index(1) count(1) data. 0xFE can start neither
+# UTF-8 text (JSON) nor well-formed CBOR, so subscribers tell a chunk from
+# a whole message by the first byte. A payload that does start with 0xFE
+# (StructCodec can produce it) always goes out framed, as a single chunk
+# when it fits.
+
+CHUNK_MAGIC = 0xFE
+CHUNK_HDR = '>BHBB'
+CHUNK_HDR_LEN = ustruct.calcsize(CHUNK_HDR)
+
+
+def chunks(payload, limit, msgid):
+  """
+  split payload into frames of at most limit bytes,
+  a payload that fits is returned as the only element
+  """
+  if len(payload) <= limit and (not payload or payload[0] != CHUNK_MAGIC):
+    return [payload]
+  step = limit - CHUNK_HDR_LEN
+  count = (len(payload) + step - 1) // step
+  if count > 255:
+    raise ValueError('Payload of %d B needs more than 255 chunks' % len(payload))
+  return [ustruct.pack(CHUNK_HDR, CHUNK_MAGIC, msgid & 0xffff, i, count) + payload[i*step:(i+1)*step]
+          for i in range(count)]
+
+
+class Reassembler:
+  """
+  Subscriber side of chunks(): feed() every received payload of a topic,
+  it returns the complete payload or None while chunks are missing.
+  At most maxpending messages are tracked, the oldest is dropped.
+  """
+  def __init__(self, maxpending=4):
+    self.maxpending = maxpending
+    self.pending = {} # msgid -> [count, {index: data}]
+    self.order = []
+    self.dropped = 0
+
+
+  def feed(self, payload):
+    if len(payload) < CHUNK_HDR_LEN or payload[0] != CHUNK_MAGIC:
+      return payload
+    _, msgid, idx, count = ustruct.unpack(CHUNK_HDR, payload[:CHUNK_HDR_LEN])
+    p = self.pending.get(msgid)
+    if p is None or p[0] != count:
+      if len(self.order) >= self.maxpending:
+        self.pending.pop(self.order.pop(0), None)
+        self.dropped += 1
+      p = self.pending[msgid] = [count, {}]
+      if msgid in self.order:
+        self.order.remove(msgid)
+      self.order.append(msgid)
+    p[1][idx] = payload[CHUNK_HDR_LEN:]
+    if len(p[1]) < count:
+      return None
+    del self.pending[msgid]
+    self.order.remove(msgid)
+    return b''.join(p[1][i] for i in range(count))
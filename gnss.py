@@ -0,0 +1,244 @@
+"""
+gnss.py
+
+Copyright (C) 2020-2021 Tomas Hlavacek (tmshlvck@gmail.com)
+
+GNSS track recording, simplification and packing for the sim driver
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import math
+import ustruct
+from array import array
+
+
+# Fix: t seconds since 2000-01-01 UTC, lat/lon in 1e-6 degrees, alt in
+# metres, speed in 0.1 km/h. Integers only, float32 on the ESP32 would
+# cost the sixth decimal of the coordinates.
+
+M_PER_UDEG = 0.111195 # metres per 1e-6 degree of latitude
+
+
+def seconds(y, mo, d, h, mi, s):
+  """
+  seconds since 2000-01-01 00:00:00 UTC
+  """
+  # days from civil, see http://howardhinnant.github.io/date_algorithms.html
+  y -= mo <= 2
+  era = y // 400
+  yoe = y - era * 400
+  doy = (153 * (mo + (-3 if mo > 2 else 9)) + 2) // 5 + d - 1
+  doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+  days = era * 146097 + doe - 730425 # 1970-01-01 is 719468, 2000-01-01 10957 days later
+  return ((days * 24 + h) * 60 + mi) * 60 + s
+
+
+def simplify(xs, ys, tol):
+  """
+  Douglas-Peucker: sorted indexes of the points of polyline (xs, ys) to keep,
+  no dropped point is farther than tol from the simplified line
+  """
+  n = len(xs)
+  if n < 3:
+    return list(range(n))
+  keep = bytearray(n)
+  keep[0] = keep[n-1] = 1
+  tol2 = tol * tol
+  stack = [(0, n - 1)] # explicit stack, recursion depth is scarce
+  while stack:
+    a, b = stack.pop()
+    if b - a < 2:
+      continue
+    ax = xs[a]
+    ay = ys[a]
+    dx = xs[b] - ax
+    dy = ys[b] - ay
+    l2 = dx * dx + dy * dy
+    dmax = -1.0
+    imax = a
+    for i in range(a + 1, b):
+      px = xs[i] - ax
+      py = ys[i] - ay
+      if l2 > 0:
+        u = (px * dx + py * dy) / l2
+        if u > 1:
+          u = 1
+        elif u < 0:
+          u = 0
+        px -= u * dx
+        py -= u * dy
+      d2 = px * px + py * py
+      if d2 > dmax:
+        dmax = d2
+        imax = i
+    if dmax > tol2:
+      keep[imax] = 1
+      stack.append((a, imax))
+      stack.append((imax, b))
+  return [i for i in range(n) if keep[i]]
+
+
+# Packed track: magic(1) count(2) then the first fix as t(4) lat(4) lon(4)
+# alt(2) speed(2), every further fix as varints of dt, dlat, dlon, dalt
+# (zigzag, signed) and speed. 0xFD tells it apart from codec.chunks() frames.
+
+TRACK_MAGIC = 0xFD
+TRACK_HDR = '<BHlllhH'
+TRACK_HDR_LEN = ustruct.calcsize(TRACK_HDR)
+
+
+def _varint(out, v):
+  while v > 0x7f:
+    out.append(0x80 | (v & 0x7f))
+    v >>= 7
+  out.append(v)
+
+
+def _zigzag(out, v):
+  _varint(out, (v << 1) if v >= 0 else ((-v << 1) - 1))
+
+
+def unpack(b):
+  """
+  subscriber side of Track.pack(), returns [(t, lat, lon, alt, speed)]
+  """
+  magic, n, t, lat, lon, alt, speed = ustruct.unpack(TRACK_HDR, b[:TRACK_HDR_LEN])
+  if magic != TRACK_MAGIC:
+    raise ValueError('Not a packed track')
+  r = [(t, lat, lon, alt, speed)]
+  i = TRACK_HDR_LEN
+  for _ in range(n - 1):
+    v = [0] * 5
+    for j in range(5):
+      x = 0
+      sh = 0
+      while True:
+        c = b[i]
+        i += 1
+        x |= (c & 0x7f) << sh
+        sh += 7
+        if not c & 0x80:
+          break
+      v[j] = x if j == 0 or j == 4 else (x >> 1) ^ -(x & 1)
+    t += v[0]
+    lat += v[1]
+    lon += v[2]
+    alt += v[3]
+    r.append((t, lat, lon, alt, v[4]))
+  return r
+
+
+class Track:
+  """
+  Fixed-size ring of fixes in arrays, a new fix overwrites the oldest one
+  when full. Uploads take a snapshot with mark(), pack() the simplified
+  points and release() what was uploaded, fixes added meanwhile stay.
+  """
+  def __init__(self, size=256):
+    self.size = size
+    self.t = array('l', [0] * size)
+    self.lat = array('l', [0] * size)
+    self.lon = array('l', [0] * size)
+    self.alt = array('h', [0] * size)
+    self.speed = array('H', [0] * size)
+    self.head = 0
+    self.n = 0
+    self.added = 0
+    self.overwritten = 0
+    self.packed = 0
+    self.kept = 0
+
+
+  def __len__(self):
+    return self.n
+
+
+  def add(self, t, lat, lon, alt=0, speed=0):
+    if self.n == self.size:
+      self.head = (self.head + 1) % self.size
+      self.n -= 1
+      self.overwritten += 1
+    i = (self.head + self.n) % self.size
+    self.t[i] = t
+    self.lat[i] = lat
+    self.lon[i] = lon
+    self.alt[i] = max(-32768, min(32767, alt))
+    self.speed[i] = max(0, min(65535, speed))
+    self.n += 1
+    self.added += 1
+
+
+  def fix(self, k):
+    """
+    k-th oldest fix as (t, lat, lon, alt, speed)
+    """
+    i = (self.head + k) % self.size
+    return self.t[i], self.lat[i], self.lon[i], self.alt[i], self.speed[i]
+
+
+  def simplify(self, tol):
+    """
+    positions (0 = oldest) of the fixes to keep for a line within tol metres
+    """
+    n = self.n
+    if n == 0:
+      return []
+    i0 = self.head
+    lat0 = self.lat[i0]
+    lon0 = self.lon[i0]
+    kx = M_PER_UDEG * math.cos(math.radians(lat0 / 1000000))
+    xs = array('f', [0] * n)
+    ys = array('f', [0] * n)
+    for k in range(n):
+      i = (i0 + k) % self.size
+      xs[k] = (self.lon[i] - lon0) * kx
+      ys[k] = (self.lat[i] - lat0) * M_PER_UDEG
+    return simplify(xs, ys, tol)
+
+
+  def pack(self, ks=None):
+    """
+    the fixes at positions ks (all when None) as a packed track
+    """
+    if ks is None:
+      ks = list(range(self.n))
+    t, lat, lon, alt, speed = self.fix(ks[0])
+    out = bytearray(ustruct.pack(TRACK_HDR, TRACK_MAGIC, len(ks), t, lat, lon, alt, speed))
+    for k in ks[1:]:
+      f = self.fix(k)
+      _varint(out, max(0, f[0] - t))
+      _zigzag(out, f[1] - lat)
+      _zigzag(out, f[2] - lon)
+      _zigzag(out, f[3] - alt)
+      _varint(out, f[4])
+      t, lat, lon, alt = f[0], f[1], f[2], f[3]
+    self.packed += self.n
+    self.kept += len(ks)
+    return bytes(out)
+
+
+  def mark(self):
+    return self.added
+
+
+  def release(self, mark):
+    """
+    drop the fixes added before mark
+    """
+    n = min(self.n, self.added - mark)
+    self.head = (self.head + self.n - n) % self.size
+    self.n = n
+
+
+  def stats(self):
+    return {'len': self.n, 'size': self.size, 'added': self.added, 'overwritten': self.overwritten,
+            'packed': self.packed, 'kept': self.kept}
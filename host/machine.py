@@ -0,0 +1,100 @@
+"""
+host/machine.py
+
+Copyright (C) 2020-2021 Tomas Hlavacek (tmshlvck@gmail.com)
+
+CPython stand-in for the parts of the MicroPython machine module used by sim.py,
+UART talks to a tty (e.g. the pty of simemu.ScriptedModem.pty()) named in UART.PORTS
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+
+
+class Pin:
+  IN = 0
+  OUT = 1
+
+  def __init__(self, n, mode=-1, value=None):
+    self.n = n
+    self.v = value or 0
+    self.log = [] # values set, for checking pulse sequences
+
+
+  def on(self):
+    self.value(1)
+
+
+  def off(self):
+    self.value(0)
+
+
+  def value(self, v=None):
+    if v is None:
+      return self.v
+    self.v = 1 if v else 0
+    self.log.append(self.v)
+
+
+class UART:
+  RTS = 1
+  CTS = 2
+  PORTS = {} # UART number -> tty path
+
+  def __init__(self, n):
+    self.n = n
+    self.fd = None
+    self.baudrate = None
+    self.flow = 0
+
+
+  def init(self, baudrate=9600, rx=None, tx=None, rxbuf=256, rts=None, cts=None, flow=0, **kw):
+    """
+    the baudrate is only recorded, a pty has no line speed
+    """
+    if self.fd is None:
+      path = self.PORTS.get(self.n)
+      if path is None:
+        raise OSError('No tty for UART %d in machine.UART.PORTS' % self.n)
+      import tty
+      self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+      tty.setraw(self.fd)
+    self.baudrate = baudrate
+    self.flow = flow
+
+
+  def read(self, n=-1):
+    try:
+      return os.read(self.fd, 4096 if n < 0 else n) or None
+    except BlockingIOError:
+      return None
+
+
+  def write(self, b):
+    try:
+      return os.write(self.fd, b)
+    except BlockingIOError:
+      return 0
+
+
+  def deinit(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+
+def reset():
+  raise SystemExit('machine.reset()')
+
+
+def unique_id():
+  return b'host'
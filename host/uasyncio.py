@@ -0,0 +1,94 @@
+"""
+host/uasyncio.py
+
+Copyright (C) 2020-2021 Tomas Hlavacek (tmshlvck@gmail.com)
+
+CPython stand-in for MicroPython uasyncio: asyncio plus the _ms helpers
+and StreamReader/StreamWriter over a machine.UART
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from asyncio import *
+import asyncio as _asyncio
+
+
+async def sleep_ms(ms):
+  await _asyncio.sleep(ms / 1000)
+
+
+async def wait_for_ms(aw, ms):
+  return await _asyncio.wait_for(aw, ms / 1000)
+
+
+async def _ready(fd, writer=False):
+  loop = _asyncio.get_event_loop()
+  fut = loop.create_future()
+  add, remove = (loop.add_writer, loop.remove_writer) if writer else (loop.add_reader, loop.remove_reader)
+  add(fd, lambda: fut.done() or fut.set_result(None))
+  try:
+    await fut
+  finally:
+    remove(fd)
+
+
+class StreamReader:
+  """
+  reader over an object with a non-blocking read(n) and a file descriptor fd
+  """
+  def __init__(self, s):
+    self.s = s
+    self.buf = b''
+
+
+  async def read(self, n=-1):
+    if self.buf:
+      r, self.buf = (self.buf, b'') if n < 0 else (self.buf[:n], self.buf[n:])
+      return r
+    while True:
+      r = self.s.read(n)
+      if r:
+        return r
+      await _ready(self.s.fd)
+
+
+  async def readline(self):
+    while b'\n' not in self.buf:
+      self.buf += await self.read()
+    i = self.buf.index(b'\n') + 1
+    r, self.buf = self.buf[:i], self.buf[i:]
+    return r
+
+
+class StreamWriter:
+  """
+  writer over an object with a non-blocking write(b) and a file descriptor fd
+  """
+  def __init__(self, s, extra=None):
+    self.s = s
+
+
+  async def awrite(self, b):
+    b = memoryview(b)
+    while b:
+      n = self.s.write(b)
+      if n:
+        b = b[n:]
+      else:
+        await _ready(self.s.fd, True)
+
+
+  async def drain(self):
+    pass
+
+
+  def close(self):
+    pass
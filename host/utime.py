@@ -0,0 +1,47 @@
+"""
+host/utime.py
+
+Copyright (C) 2020-2021 Tomas Hlavacek (tmshlvck@gmail.com)
+
+CPython stand-in for the MicroPython utime module, ticks wrap like on the ESP32
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from time import *
+import time as _time
+
+TICKS_PERIOD = 1 << 30
+_TICKS_HALF = TICKS_PERIOD // 2
+
+
+def ticks_ms():
+  return int(_time.monotonic() * 1000) % TICKS_PERIOD
+
+
+def ticks_us():
+  return int(_time.monotonic() * 1000000) % TICKS_PERIOD
+
+
+def ticks_add(t, delta):
+  return (t + delta) % TICKS_PERIOD
+
+
+def ticks_diff(t1, t2):
+  return (t1 - t2 + _TICKS_HALF) % TICKS_PERIOD - _TICKS_HALF
+
+
+def sleep_ms(ms):
+  _time.sleep(ms / 1000)
+
+
+def sleep_us(us):
+  _time.sleep(us / 1000000)
@@ -0,0 +1,232 @@
+"""
+journal.py
+
+Copyright (C) 2020-2021 Tomas Hlavacek (tmshlvck@gmail.com)
+
+Flash-backed append-only ring journal for the telemetry store-and-forward
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import uos
+import ustruct
+import ubinascii
+
+
+# Layout: <dir>/<n>.seg segment files filled up to SEG_SIZE bytes and <dir>/ack
+# with the sequence number of the last acknowledged record.
+#
+# Record: magic(1) len(2) seq(4) ts(4) payload(len) crc32(4) of header+payload
+#
+# A record torn by a power loss fails the CRC check, reading stops there and
+# appends continue in a fresh segment, so the damaged tail is never reused.
+# The ack file is replaced by rename, segments are removed only after the ack
+# covering them has been written.
+
+MAGIC = 0xA5
+HDR = '<BHII'
+HDR_LEN = ustruct.calcsize(HDR)
+
+
+class Journal:
+  SEG_SIZE = 4096 # bytes
+  MAX_SEGS = 8 # oldest segment is evicted when a new one would exceed this
+  BATCH = 8 # records buffered in RAM before a flash write
+
+  def __init__(self, path):
+    self.path = path
+    try:
+      uos.mkdir(path)
+    except OSError:
+      pass
+    self.segs = [] # [segno, first_seq, last_seq, size]
+    self.nextseg = 0
+    self.buf = []
+    self.seq = 0
+    self.acked = 0
+    self.written = 0
+    self.evicted = 0
+    self.torn = 0
+    self.tailok = True
+    self._load()
+
+
+  def _seg(self, n):
+    return '%s/%d.seg' % (self.path, n)
+
+
+  def _scan(self, n):
+    """
+    returns (first_seq, last_seq, valid_size, clean) of segment n
+    """
+    first = last = None
+    size = 0
+    with open(self._seg(n), 'rb') as f:
+      while True:
+        h = f.read(HDR_LEN)
+        if not h:
+          return first, last, size, True
+        if len(h) < HDR_LEN:
+          return first, last, size, False
+        magic, ln, seq, ts = ustruct.unpack(HDR, h)
+        p = f.read(ln)
+        c = f.read(4)
+        if magic != MAGIC or len(p) < ln or len(c) < 4 or \
+           ustruct.unpack('<I', c)[0] != ubinascii.crc32(p, ubinascii.crc32(h)) & 0xffffffff:
+          return first, last, size, False
+        if first is None:
+          first = seq
+        last = seq
+        size += HDR_LEN + ln + 4
+
+
+  def _load(self):
+    try:
+      with open('%s/ack' % self.path) as f:
+        self.acked = int(f.read())
+    except (OSError, ValueError):
+      self.acked = 0
+    self.seq = self.acked
+    ns = sorted(int(fn[:-4]) for fn in uos.listdir(self.path) if fn.endswith('.seg'))
+    for n in ns:
+      self.nextseg = n + 1
+      first, last, size, clean = self._scan(n)
+      if not clean:
+        self.torn += 1
+      if first is None:
+        uos.remove(self._seg(n))
+        continue
+      self.segs.append([n, first, last, size])
+      self.seq = max(self.seq, last)
+      self.tailok = clean
+    self._trim()
+
+
+  def append(self, ts, payload):
+    """
+    buffer a record, payload is bytes or str, returns its sequence number
+    """
+    if type(payload) is str:
+      payload = payload.encode()
+    self.seq += 1
+    self.buf.append((self.seq, int(ts), payload))
+    if len(self.buf) >= self.BATCH:
+      self.flush()
+    return self.seq
+
+
+  def flush(self):
+    """
+    write the buffered records to flash in one go
+    """
+    if not self.buf:
+      return
+    out = []
+    size = 0
+    for seq, ts, p in self.buf:
+      h = ustruct.pack(HDR, MAGIC, len(p), seq, ts)
+      out.append(h + p + ustruct.pack('<I', ubinascii.crc32(p, ubinascii.crc32(h)) & 0xffffffff))
+      size += len(out[-1])
+    if not self.segs or not self.tailok or self.segs[-1][3] + size > self.SEG_SIZE:
+      self.segs.append([self.nextseg, self.buf[0][0], self.buf[0][0], 0])
+      self.nextseg += 1
+      self.tailok = True
+      self._evict()
+    s = self.segs[-1]
+    with open(self._seg(s[0]), 'ab') as f:
+      for r in out:
+        f.write(r)
+    s[2] = self.buf[-1][0]
+    s[3] += size
+    self.written += len(self.buf)
+    self.buf = []
+
+
+  def _evict(self):
+    """
+    drop the oldest segments over MAX_SEGS, lost records count as acknowledged
+    """
+    while len(self.segs) > self.MAX_SEGS:
+      n, first, last, _ = self.segs.pop(0)
+      if last > self.acked:
+        self.evicted += last - max(first - 1, self.acked)
+        self.acked = last
+        self._store_ack()
+      uos.remove(self._seg(n))
+
+
+  def _trim(self):
+    """
+    remove segments that are fully acknowledged
+    """
+    while self.segs and self.segs[0][2] <= self.acked:
+      uos.remove(self._seg(self.segs.pop(0)[0]))
+
+
+  def read(self, maxn):
+    """
+    up to maxn oldest unacknowledged records as list of (seq, ts, payload)
+    """
+    self.flush()
+    res = []
+    for n, first, last, _ in self.segs:
+      if last <= self.acked:
+        continue
+      with open(self._seg(n), 'rb') as f:
+        while len(res) < maxn:
+          h = f.read(HDR_LEN)
+          if len(h) < HDR_LEN:
+            break
+          magic, ln, seq, ts = ustruct.unpack(HDR, h)
+          p = f.read(ln)
+          c = f.read(4)
+          if magic != MAGIC or len(c) < 4 or \
+             ustruct.unpack('<I', c)[0] != ubinascii.crc32(p, ubinascii.crc32(h)) & 0xffffffff:
+            break
+          if seq > self.acked:
+            res.append((seq, ts, p))
+      if len(res) >= maxn:
+        break
+    return res
+
+
+  def ack(self, seq):
+    """
+    mark records up to seq as delivered and persist it
+    """
+    if seq <= self.acked:
+      return
+    self.acked = seq
+    self._store_ack()
+    self._trim()
+
+
+  def _store_ack(self):
+    tmp = '%s/ack.tmp' % self.path
+    with open(tmp, 'w') as f:
+      f.write(str(self.acked))
+    try:
+      uos.rename(tmp, '%s/ack' % self.path)
+    except OSError: # FAT does not rename over an existing file
+      uos.remove('%s/ack' % self.path)
+      uos.rename(tmp, '%s/ack' % self.path)
+
+
+  def __len__(self):
+    """
+    number of records waiting for acknowledgement
+    """
+    return self.seq - self.acked
+
+
+  def stats(self):
+    return {'depth': len(self), 'segments': len(self.segs), 'written': self.written,
+            'evicted': self.evicted, 'torn': self.torn}
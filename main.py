@@ -19,6 +19,7 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 import usys
 import uasyncio
 import machine
+import uio
 import uselect
 import sim
 
@@ -101,6 +102,7 @@ async def shell(uplink, data):
         print("  help")
         print("  exit")
         print("  status")
+        print("  stats")
         print("  simd | simdebug")
         print("  debug")
         print("  undebug")
@@ -117,6 +119,7 @@ async def shell(uplink, data):
       elif l == 'status':
         try:
           print("Uplink: %s" % str(await uplink.get_status()))
+          print("Diagnostics: %s" % str(uplink.get_diag()))
         except Exception as e:
           print("Uplink failed to retreive status!")
           usys.print_exception(e)
@@ -124,20 +127,35 @@ async def shell(uplink, data):
         print("Data:")
         print(str(data))
 
+      elif l == 'stats':
+        if not uplink.sim:
+          print("Uplink not running")
+          continue
+        print("%-12s %6s %4s %4s %6s %6s %6s %6s %6s %8s %8s" %
+              ('verb', 'calls', 'tmo', 'err', 'min', 'avg', 'max', 'qavg', 'qmax', 'tx', 'rx'))
+        m = uplink.sim.metrics_stats()
+        for v in sorted(m):
+          e = m[v]
+          print("%-12s %6d %4d %4d %6d %6d %6d %6d %6d %8d %8d" %
+                (v, e['calls'], e['timeouts'], e['errors'], e['min'], e['avg'], e['max'],
+                 e['qwait_avg'], e['qwait_max'], e['tx'], e['rx']))
+          print("%-12s ms<=%s: %s" % ('', '/'.join(str(b) for b in sim.Metrics.BUCKETS), str(e['hist'])))
+
       elif l == 'data':
         print("Data:")
         print(str(data))
 
       elif l == 'simd' or l == 'simdebug':
         try:
-          sim = SIM(CONFIG['MODEM_POWER_PIN'], CONFIG['MODEM_RESET_PIN'], CONFIG['MODEM_RX_PIN'], CONFIG['MODEM_TX_PIN'])
-          await sim.init()
+          # not named sim, that would make the module a local of shell()
+          dbg = sim.SIM(CONFIG['MODEM_POWER_PIN'], CONFIG['MODEM_RESET_PIN'], CONFIG['MODEM_RX_PIN'], CONFIG['MODEM_TX_PIN'])
+          await dbg.init()
           print("GSM running, enter 'stop' to exit GSM shell")
-          await sim.debug_shell()
+          await dbg.debug_shell()
         except:
           raise
         finally:
-          await sim.deinit()
+          await dbg.deinit()
 
       elif l == 'debug':
         DEBUG = True
@@ -152,17 +170,19 @@ async def shell(uplink, data):
         print(uplink.start(data))
 
       elif l.startswith('getsms'):
-        print(await uplink.sim.get_sms())
+        print(await uplink.sim.get_sms(prio=sim.SIM.PRIO_SHELL))
 
       elif l.startswith('delsms'):
         _,smsid = l.split(' ', 1)
-        print(await uplink.sim.del_sms(int(smsid)))
+        print(await uplink.sim.del_sms(int(smsid), prio=sim.SIM.PRIO_SHELL))
 
       elif l.startswith('sendsms'):
         _,tel,msg = l.split(' ', 2)
-        print(await uplink.sim.send_sms(tel, msg))
+        print(await uplink.sim.send_sms(tel, msg, prio=sim.SIM.PRIO_SHELL))
 
       elif l == 'reset':
+        if uplink.sim:
+          uplink.sim.transcript_flush()
         machine.reset()
       else:
         if l != "":
@@ -191,5 +211,6 @@ async def main():
 
 
 
-uasyncio.run(main())
+if __name__ == '__main__':
+  uasyncio.run(main())
 
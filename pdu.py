@@ -0,0 +1,287 @@
+"""
+pdu.py
+
+Copyright (C) 2020-2021 Tomas Hlavacek (tmshlvck@gmail.com)
+
+SMS PDU mode (3GPP TS 23.040) encoding and decoding for the sim driver
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import ubinascii
+
+
+# GSM 03.38 default alphabet, index = septet value, 0x1B escapes to GSM7_EXT
+GSM7 = ('@£$¥èéùìòÇ\nØø\rÅå'
+        'Δ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ'
+        ' !"#¤%&\'()*+,-./0123456789:;<=>?'
+        '¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§'
+        '¿abcdefghijklmnopqrstuvwxyzäöñüà')
+GSM7_EXT = {0x0a: '\f', 0x14: '^', 0x28: '{', 0x29: '}', 0x2f: '\\',
+            0x3c: '[', 0x3d: '~', 0x3e: ']', 0x40: '|', 0x65: '€'}
+
+DCS_GSM7 = 0
+DCS_8BIT = 1
+DCS_UCS2 = 2
+
+# user data limits of one message and of one part of a concatenated message
+GSM7_SINGLE = 160 # septets
+GSM7_PART = 153
+UCS2_SINGLE = 140 # bytes
+UCS2_PART = 134
+
+_gsm7rev = None
+
+
+def _gsm7codes():
+  global _gsm7rev
+  if _gsm7rev is None:
+    _gsm7rev = {}
+    for i, c in enumerate(GSM7):
+      if i != 0x1b:
+        _gsm7rev[c] = i
+    for k, c in GSM7_EXT.items():
+      _gsm7rev[c] = 0x1b00 | k
+  return _gsm7rev
+
+
+def septets(text):
+  """
+  GSM 7-bit codes of text, None when a character is not in the alphabet
+  """
+  rev = _gsm7codes()
+  r = bytearray()
+  for c in text:
+    k = rev.get(c)
+    if k is None:
+      return None
+    if k > 0xff:
+      r.append(0x1b)
+    r.append(k & 0x7f)
+  return r
+
+
+def pack7(sp, shift=0):
+  """
+  pack septets sp, the first one starting shift bits into the first byte
+  """
+  out = bytearray()
+  acc = 0
+  bits = shift
+  for s in sp:
+    acc |= s << bits
+    bits += 7
+    while bits >= 8:
+      out.append(acc & 0xff)
+      acc >>= 8
+      bits -= 8
+  if bits:
+    out.append(acc & 0xff)
+  return out
+
+
+def unpack7(b, n, skip=0):
+  """
+  n septets packed in b, without the first skip of them
+  """
+  r = bytearray()
+  acc = 0
+  bits = 0
+  j = 0
+  for x in b:
+    acc |= x << bits
+    bits += 8
+    while bits >= 7 and j < n:
+      if j >= skip:
+        r.append(acc & 0x7f)
+      acc >>= 7
+      bits -= 7
+      j += 1
+    if j >= n:
+      break
+  return r
+
+
+def gsm7text(sp):
+  r = []
+  esc = False
+  for s in sp:
+    if esc:
+      r.append(GSM7_EXT.get(s, ' '))
+      esc = False
+    elif s == 0x1b:
+      esc = True
+    else:
+      r.append(GSM7[s])
+  return ''.join(r)
+
+
+def ucs2(text):
+  """
+  UTF-16BE bytes of text, characters beyond the BMP as surrogate pairs
+  """
+  r = bytearray()
+  for c in text:
+    u = ord(c)
+    if u > 0xffff:
+      u -= 0x10000
+      hi = 0xd800 | (u >> 10)
+      lo = 0xdc00 | (u & 0x3ff)
+      r.extend(bytes((hi >> 8, hi & 0xff, lo >> 8, lo & 0xff)))
+    else:
+      r.append(u >> 8)
+      r.append(u & 0xff)
+  return r
+
+
+def ucs2text(b):
+  r = []
+  hi = 0
+  for i in range(0, len(b) - 1, 2):
+    u = b[i] << 8 | b[i+1]
+    if 0xd800 <= u < 0xdc00:
+      hi = u
+      continue
+    if 0xdc00 <= u < 0xe000 and hi:
+      u = 0x10000 + ((hi - 0xd800) << 10) + (u - 0xdc00)
+    hi = 0
+    r.append(chr(u))
+  return ''.join(r)
+
+
+def _semioctets(b, n):
+  r = []
+  for x in b:
+    r.append('0123456789*#abc'[x & 0xf] if x & 0xf != 0xf else '')
+    r.append('0123456789*#abc'[x >> 4] if x >> 4 != 0xf else '')
+  return ''.join(r)[:n]
+
+
+def _address(tel):
+  intl = tel.startswith('+')
+  digits = tel[1:] if intl else tel
+  d = digits + 'F' if len(digits) % 2 else digits
+  sw = ''.join(d[i+1] + d[i] for i in range(0, len(d), 2))
+  return bytes((len(digits), 0x91 if intl else 0x81)) + ubinascii.unhexlify(sw)
+
+
+def _scts(b):
+  """
+  service centre time stamp in the text mode format, e.g. 21/05/10,22:10:39+08
+  """
+  v = [(x & 0xf) * 10 + (x >> 4) for x in b[:6]]
+  tz = (b[6] & 0x7) * 10 + (b[6] >> 4)
+  return '%02d/%02d/%02d,%02d:%02d:%02d%s%02d' % (v[0], v[1], v[2], v[3], v[4], v[5], '-' if b[6] & 0x8 else '+', tz)
+
+
+def _alphabet(dcs):
+  if dcs & 0xc0 == 0:
+    return (dcs >> 2) & 3
+  if dcs & 0xf0 == 0xf0:
+    return (dcs >> 2) & 1
+  if dcs & 0xf0 == 0xe0:
+    return DCS_UCS2
+  return DCS_GSM7
+
+
+def decode(pdu):
+  """
+  SMS-DELIVER as hex string or bytes like in the +CMGR/+CMGL responses
+  returns (sender, time, text, ref, part, parts), ref is None when the
+  message is not a part of a concatenated one, 8-bit data stays bytes
+  """
+  b = ubinascii.unhexlify(pdu.strip())
+  i = b[0] + 1 # SMSC address
+  fo = b[i]
+  n = b[i+1]
+  toa = b[i+2]
+  i += 3
+  ol = (n + 1) // 2
+  if toa & 0x70 == 0x50: # alphanumeric sender
+    sender = gsm7text(unpack7(b[i:i+ol], n * 4 // 7))
+  else:
+    sender = ('+' if toa & 0x70 == 0x10 else '') + _semioctets(b[i:i+ol], n)
+  i += ol
+  dcs = b[i+1]
+  time = _scts(b[i+2:i+9])
+  udl = b[i+9]
+  ud = b[i+10:]
+  ref = None
+  part = parts = 1
+  hl = 0
+  if fo & 0x40: # user data header
+    hl = ud[0] + 1
+    j = 1
+    while j + 1 < hl:
+      iei = ud[j]
+      iel = ud[j+1]
+      if iei == 0x00: # concatenated, 8-bit reference
+        ref, parts, part = ud[j+2], ud[j+3], ud[j+4]
+      elif iei == 0x08: # concatenated, 16-bit reference
+        ref, parts, part = ud[j+2] << 8 | ud[j+3], ud[j+4], ud[j+5]
+      j += 2 + iel
+  a = _alphabet(dcs)
+  if a == DCS_GSM7:
+    text = gsm7text(unpack7(ud, udl, (hl * 8 + 6) // 7))
+  elif a == DCS_UCS2:
+    text = ucs2text(ud[hl:udl])
+  else:
+    text = bytes(ud[hl:udl])
+  return sender, time, text, ref, part, parts
+
+
+def encode(tel, text, ref=0):
+  """
+  SMS-SUBMIT PDUs for text to tel, in GSM 7-bit when the alphabet covers
+  the text, UCS2 otherwise, split into concatenated parts with reference
+  ref when it does not fit one message
+  returns [(length for AT+CMGS, hex PDU as bytes)]
+  """
+  sp = septets(text)
+  if sp is not None:
+    single, step = GSM7_SINGLE, GSM7_PART
+    data, dcs = sp, 0x00
+  else:
+    single, step = UCS2_SINGLE, UCS2_PART
+    data, dcs = ucs2(text), 0x08
+  chunks = []
+  if len(data) <= single:
+    chunks.append(data)
+  else:
+    i = 0
+    while i < len(data):
+      j = min(i + step, len(data))
+      if j < len(data):
+        if sp is not None and data[j-1] == 0x1b: # do not split an escape
+          j -= 1
+        elif sp is None and 0xd8 <= data[j-2] < 0xdc: # nor a surrogate pair
+          j -= 2
+      chunks.append(data[i:j])
+      i = j
+  if len(chunks) > 255:
+    raise ValueError('Text of %d characters needs more than 255 messages' % len(text))
+  head = _address(tel)
+  r = []
+  for k, c in enumerate(chunks):
+    udh = b''
+    if len(chunks) > 1:
+      udh = bytes((5, 0x00, 3, ref & 0xff, len(chunks), k + 1))
+    if sp is not None:
+      skip = (len(udh) * 8 + 6) // 7
+      ud = udh + pack7(c, skip * 7 - len(udh) * 8)
+      udl = skip + len(c)
+    else:
+      ud = udh + c
+      udl = len(ud)
+    # SMSC from the SIM, SMS-SUBMIT (+UDHI), message reference by the modem
+    tpdu = bytes((0x41 if udh else 0x01, 0)) + head + bytes((0, dcs, udl)) + ud
+    r.append((len(tpdu), ubinascii.hexlify(b'\x00' + tpdu).upper()))
+  return r
@@ -21,6 +21,10 @@ import uasyncio
 import machine
 import uio
 import ujson
+import utime
+import urandom
+from array import array
+import codec
 
 
 # Disable PIN:
@@ -73,43 +77,1247 @@ async def readline(prompt=""):
 
 
 
-class Queue:
+# Response parsing
+#
+# splitcsv() stores (begin, end) offsets of the fields into a preallocated
+# array instead of building strings, the typed records below convert the
+# fields straight from the received bytes.
+
+MAX_FIELDS = 32
+_spans = array('H', [0] * (2 * MAX_FIELDS))
+
+def csvstart(b, key):
+  """
+  offset of the first field after 'key:' (b'+CSQ: 20,99' -> 7) or -1 when b does not start with key
+  """
+  i = 0
+  n = len(b)
+  while i < n and b[i] in (13, 10, 32):
+    i += 1
+  if b.find(key, i, i + len(key)) != i:
+    return -1
+  i = b.find(b':', i)
+  if i < 0:
+    return -1
+  i += 1
+  while i < n and b[i] == 32:
+    i += 1
+  return i
+
+
+def splitcsv(b, start=0, spans=_spans):
+  """
+  split b[start:] on commas outside of quotes, field offsets go to spans
+  (field j is b[spans[2*j]:spans[2*j+1]], quotes are kept)
+  returns the number of fields
+  """
+  end = len(b)
+  while end > start and b[end-1] in (13, 10, 32):
+    end -= 1
+  if end <= start:
+    return 0
+  maxn = len(spans) // 2
+  n = 0
+  a = start
+  q = 0
+  i = start
+  while i < end:
+    c = b[i]
+    if q:
+      if c == q:
+        q = 0
+    elif c == 44: # ,
+      if n == maxn - 1:
+        break
+      spans[2*n] = a
+      spans[2*n+1] = i
+      n += 1
+      a = i + 1
+    elif c == 34 or c == 39: # " '
+      q = c
+    i += 1
+  spans[2*n] = a
+  spans[2*n+1] = i
+  return n + 1
+
+
+def _unquote(b, a, e):
+  if e - a >= 2 and b[a] in (34, 39) and b[e-1] == b[a]:
+    return a + 1, e - 1
+  return a, e
+
+
+def csvint(b, a, e, base=10):
+  """
+  int from b[a:e] without allocation, accepts quotes, sign and 0x hex, empty -> None
+  """
+  a, e = _unquote(b, a, e)
+  if a >= e:
+    return None
+  neg = False
+  if b[a] == 45: # -
+    neg = True
+    a += 1
+  elif b[a] == 43: # +
+    a += 1
+  if e - a > 2 and b[a] == 48 and b[a+1] in (120, 88): # 0x
+    base = 16
+    a += 2
+  v = 0
+  while a < e:
+    c = b[a]
+    if 48 <= c <= 57:
+      c -= 48
+    elif base == 16 and 97 <= (c | 32) <= 102:
+      c = (c | 32) - 87
+    else:
+      return None
+    v = v * base + c
+    a += 1
+  return -v if neg else v
+
+
+def csvfloat(b, a, e):
+  """
+  float from b[a:e] (plain decimal notation), empty -> None
+  """
+  a, e = _unquote(b, a, e)
+  if a >= e:
+    return None
+  neg = False
+  if b[a] == 45:
+    neg = True
+    a += 1
+  elif b[a] == 43:
+    a += 1
+  m = 0
+  frac = -1
+  while a < e:
+    c = b[a]
+    if c == 46: # .
+      frac = 0
+    elif 48 <= c <= 57:
+      m = m * 10 + c - 48
+      if frac >= 0:
+        frac += 1
+    else:
+      return None
+    a += 1
+  v = m / (10 ** frac) if frac > 0 else float(m)
+  return -v if neg else v
+
+
+def csvfixed(b, a, e, digits):
+  """
+  decimal number from b[a:e] as int scaled by 10**digits, b'50.0874515', 6 -> 50087451, empty -> None
+  """
+  a, e = _unquote(b, a, e)
+  if a >= e:
+    return None
+  neg = False
+  if b[a] == 45:
+    neg = True
+    a += 1
+  elif b[a] == 43:
+    a += 1
+  v = 0
+  frac = -1
+  while a < e and frac < digits:
+    c = b[a]
+    if c == 46: # .
+      frac = 0
+    elif 48 <= c <= 57:
+      v = v * 10 + c - 48
+      if frac >= 0:
+        frac += 1
+    else:
+      return None
+    a += 1
+  v *= 10 ** (digits - max(frac, 0))
+  return -v if neg else v
+
+
+def csvstr(b, a, e):
+  a, e = _unquote(b, a, e)
+  if a >= e:
+    return None
+  return b[a:e].decode()
+
+
+class Record:
+  """
+  Base of the typed modem responses, fields are listed in __slots__
+  """
+  __slots__ = ()
+
+  def __init__(self, *args):
+    for i, k in enumerate(self.__slots__):
+      setattr(self, k, args[i] if i < len(args) else None)
+
+
+  @classmethod
+  def parse(cls, b, start):
+    """
+    parse the fields of line b starting at offset start
+    """
+    n = splitcsv(b, start)
+    r = cls()
+    cls._fill(r, b, _spans, n)
+    return r
+
+
+  def todict(self):
+    return dict((k, getattr(self, k)) for k in self.__slots__)
+
+
+  def __repr__(self):
+    return '%s(%s)' % (type(self).__name__, ', '.join('%s=%s' % (k, repr(getattr(self, k))) for k in self.__slots__))
+
+
+class NetInfo(Record):
+  """
+  +CPSI, see SIM.get_netinfo()
+  tac is LAC on GSM, rssi is RxLev on GSM
+  """
+  __slots__ = ('mode', 'opmode', 'mcc', 'mnc', 'tac', 'cellid', 'pcellid', 'band', 'earfcn', 'rsrq', 'rsrp', 'rssi', 'rssnr')
+
+  @staticmethod
+  def _fill(r, b, s, n):
+    r.mode = csvstr(b, s[0], s[1])
+    if n > 1:
+      r.opmode = csvstr(b, s[2], s[3])
+    if n > 2:
+      i = b.find(b'-', s[4], s[5])
+      if i > 0:
+        r.mcc = csvint(b, s[4], i)
+        r.mnc = csvint(b, i + 1, s[5])
+    if n > 4:
+      r.tac = csvint(b, s[6], s[7])
+      r.cellid = csvint(b, s[8], s[9])
+    if r.mode == 'GSM':
+      if n > 6:
+        r.band = csvstr(b, s[10], s[11])
+        r.rssi = csvint(b, s[12], s[13])
+    elif n > 13:
+      r.pcellid = csvint(b, s[10], s[11])
+      r.band = csvstr(b, s[12], s[13])
+      r.earfcn = csvint(b, s[14], s[15])
+      r.rsrq = csvint(b, s[20], s[21])
+      r.rsrp = csvint(b, s[22], s[23])
+      r.rssi = csvint(b, s[24], s[25])
+      r.rssnr = csvint(b, s[26], s[27])
+
+
+class SignalInfo(Record):
+  """
+  +CSQ, see SIM.get_signalinfo()
+  """
+  __slots__ = ('rssi', 'ber')
+
+  @staticmethod
+  def _fill(r, b, s, n):
+    r.rssi = csvint(b, s[0], s[1])
+    if n > 1:
+      r.ber = csvint(b, s[2], s[3])
+
+
+  @property
+  def dbm(self):
+    if self.rssi is None or self.rssi == 99:
+      return None
+    return -113 + 2 * self.rssi
+
+
+class NetReg(Record):
+  """
+  +CREG response to AT+CREG?, see SIM.get_netreg()
+  """
+  __slots__ = ('n', 'stat', 'lac', 'ci', 'act')
+
+  @staticmethod
+  def _fill(r, b, s, n):
+    r.n = csvint(b, s[0], s[1])
+    if n > 1:
+      r.stat = csvint(b, s[2], s[3])
+    if n > 3:
+      r.lac = csvint(b, s[4], s[5], 16)
+      r.ci = csvint(b, s[6], s[7], 16)
+    if n > 4:
+      r.act = csvint(b, s[8], s[9])
+
+
+  @property
+  def registered(self):
+    return self.stat in RegState.REGISTERED
+
+
+class SMS(Record):
+  """
+  one received message, see SIM.read_sms()
+  ref, part and parts describe concatenated messages (PDU mode only),
+  indexes lists the storage indexes of all its parts
+  """
+  __slots__ = ('index', 'stat', 'sender', 'time', 'text', 'ref', 'part', 'parts', 'indexes')
+
+  STATS = ('REC UNREAD', 'REC READ', 'STO UNSENT', 'STO SENT') # PDU mode <stat> -> text mode
+
+
+class RegState:
+  """
+  Network registration state, fed by +CREG/+CEREG URCs (enabled with AT+CREG=2
+  and AT+CEREG=2 in SIM.init) and by AT+CREG? responses. event is set while
+  the modem is registered (home or roaming) on either the CS or the EPS domain.
+  """
+  REGISTERED = (1, 5) # home, roaming
+
   def __init__(self):
-    self.e = uasyncio.Event()
-    self.q = []
+    self.creg = None
+    self.cereg = None
+    self.lac = None
+    self.ci = None
+    self.act = None
+    self.changes = 0
+    self.event = uasyncio.Event()
 
 
-  async def put(self, elem):
-    self.q.append(elem)
+  @property
+  def registered(self):
+    return self.creg in self.REGISTERED or self.cereg in self.REGISTERED
+
+
+  def update(self, domain, stat, lac=None, ci=None, act=None):
+    """
+    domain: 'creg' or 'cereg'
+    """
+    if getattr(self, domain) != stat:
+      self.changes += 1
+    setattr(self, domain, stat)
+    if lac is not None:
+      self.lac = lac
+      self.ci = ci
+      self.act = act
+    if self.registered:
+      self.event.set()
+    else:
+      self.event.clear()
+
+
+  def update_urc(self, domain, l):
+    """
+    +CREG: <stat>[,<lac>,<ci>[,<act>]] / +CEREG: <stat>[,<tac>,<ci>[,<act>]]
+    """
+    n = splitcsv(l, csvstart(l, b'+CREG' if domain == 'creg' else b'+CEREG'))
+    if not n:
+      return
+    s = _spans
+    if n > 2:
+      self.update(domain, csvint(l, s[0], s[1]), csvint(l, s[2], s[3], 16), csvint(l, s[4], s[5], 16),
+                  csvint(l, s[6], s[7]) if n > 3 else None)
+    else:
+      self.update(domain, csvint(l, s[0], s[1]))
+
+
+  def todict(self):
+    return {'creg': self.creg, 'cereg': self.cereg, 'lac': self.lac, 'ci': self.ci,
+            'act': self.act, 'changes': self.changes}
+
+
+class GNSSInfo(Record):
+  """
+  +CGNSINF, see SIM.get_gnss()
+  """
+  __slots__ = ('run', 'fix', 'utc', 'lat', 'lon', 'alt', 'speed', 'course', 'fixmode',
+               'hdop', 'pdop', 'vdop', 'sats_view', 'sats_used', 'glonass_used', 'cn0', 'hpa', 'vpa')
+
+  @staticmethod
+  def _fill(r, b, s, n):
+    r.run = csvint(b, s[0], s[1])
+    if n < 21:
+      return
+    r.fix = csvint(b, s[2], s[3])
+    r.utc = csvstr(b, s[4], s[5])
+    r.lat = csvfloat(b, s[6], s[7])
+    r.lon = csvfloat(b, s[8], s[9])
+    r.alt = csvfloat(b, s[10], s[11])
+    r.speed = csvfloat(b, s[12], s[13])
+    r.course = csvfloat(b, s[14], s[15])
+    r.fixmode = csvint(b, s[16], s[17])
+    r.hdop = csvfloat(b, s[20], s[21])
+    r.pdop = csvfloat(b, s[22], s[23])
+    r.vdop = csvfloat(b, s[24], s[25])
+    r.sats_view = csvint(b, s[28], s[29])
+    r.sats_used = csvint(b, s[30], s[31])
+    r.glonass_used = csvint(b, s[32], s[33])
+    r.cn0 = csvint(b, s[36], s[37])
+    r.hpa = csvfloat(b, s[38], s[39])
+    r.vpa = csvfloat(b, s[40], s[41])
+
+
+class NTPResult(Record):
+  """
+  +CNTP: <code>[,<time>], see SIM.get_ntp()
+  code 1 = success, 61 network error, 62 DNS error, 63 connection error, 64 timeout,
+  65 server error, 66 operation not allowed
+  """
+  __slots__ = ('code', 'time')
+
+  @staticmethod
+  def _fill(r, b, s, n):
+    r.code = csvint(b, s[0], s[1])
+    if n > 1:
+      r.time = csvstr(b, s[2], s[3])
+      if n > 2: # the time contains a comma: "21/05/10,22:10:39"
+        r.time = csvstr(b, s[2], s[5])
+
+
+class Queue:
+  """
+  Fixed-capacity ring buffer queue with preallocated slots.
+
+  policy decides what put() does when the queue is full:
+  DROP_OLDEST - overwrite the oldest element
+  DROP_NEWEST - discard the new element
+  BLOCK - wait until a consumer makes room
+  """
+  DROP_OLDEST = 0
+  DROP_NEWEST = 1
+  BLOCK = 2
+
+  def __init__(self, size=16, policy=DROP_OLDEST):
+    self.e = uasyncio.Event() # not empty
+    self.f = uasyncio.Event() # not full
+    self.q = [None] * size
+    self.size = size
+    self.policy = policy
+    self.head = 0
+    self.n = 0
+    self.drops = 0
+    self.hwm = 0
+
+
+  def __len__(self):
+    return self.n
+
+
+  def put_nowait(self, elem):
+    """
+    returns False when an element had to be dropped
+    """
+    dropped = False
+    if self.n == self.size:
+      self.drops += 1
+      dropped = True
+      if self.policy == self.DROP_OLDEST:
+        self.head = (self.head + 1) % self.size
+        self.n -= 1
+      else:
+        return False
+    self.q[(self.head + self.n) % self.size] = elem
+    self.n += 1
+    if self.n > self.hwm:
+      self.hwm = self.n
     self.e.set()
+    return not dropped
+
+
+  async def put(self, elem):
+    while self.policy == self.BLOCK and self.n == self.size:
+      self.f.clear()
+      await self.f.wait()
+    return self.put_nowait(elem)
 
 
   async def get(self):
-    while not (self.e.is_set() and len(self.q) > 0):
+    while not (self.e.is_set() and self.n > 0):
       await self.e.wait()
 
-    elem = self.q.pop(0)
-    if len(self.q) == 0:
+    elem = self.q[self.head]
+    self.q[self.head] = None
+    self.head = (self.head + 1) % self.size
+    self.n -= 1
+    if self.n == 0:
       self.e.clear()
+    self.f.set()
 
     return elem
 
 
+  def clear(self):
+    while self.n:
+      self.q[self.head] = None
+      self.head = (self.head + 1) % self.size
+      self.n -= 1
+    self.e.clear()
+    self.f.set()
+
+
+  def stats(self):
+    return {'len': self.n, 'size': self.size, 'hwm': self.hwm, 'drops': self.drops}
+
+
+class URCTable:
+  """
+  Registry of unsolicited result code handlers.
+
+  Lines are keyed by the bytes up to and including the first ':' (b'+CMTI:')
+  or by the whole stripped line when there is no ':' (b'NORMAL POWER DOWN').
+  A 256-entry first-byte index rejects ordinary response lines without
+  slicing, registered lines cost one dict lookup.
+
+  A handler is either a Queue (the line is put into it, never blocking)
+  or a callable taking the line. Callables run inside the UART reader
+  and must return quickly.
+  """
+
+  def __init__(self):
+    self.first = bytearray(256)
+    self.handlers = {}
+    self.counters = {}
+
+
+  @staticmethod
+  def _key(l):
+    i = l.find(b':')
+    if i > 0:
+      return l[:i+1]
+    return l.strip()
+
+
+  def register(self, prefix, handler):
+    if type(prefix) is str:
+      prefix = prefix.encode()
+    self.handlers.setdefault(prefix, []).append(handler)
+    self.counters.setdefault(prefix, 0)
+    self.first[prefix[0]] = 1
+
+
+  def unregister(self, prefix, handler):
+    if type(prefix) is str:
+      prefix = prefix.encode()
+    hs = self.handlers.get(prefix)
+    if hs and handler in hs:
+      hs.remove(handler)
+
+
+  def match(self, l, solicit=None):
+    """
+    returns the list of handlers for line l or None
+    lines with key solicit are responses to the command in flight and do not match
+    """
+    if not self.first[l[0]]:
+      return None
+    k = self._key(l)
+    if k == solicit:
+      return None
+    hs = self.handlers.get(k)
+    if hs:
+      self.counters[k] += 1
+    return hs
+
+
+  def stats(self):
+    return dict((k.decode(), v) for k, v in self.counters.items())
+
+
+class SubRouter:
+  """
+  Routes +SMSUB: "<topic>","<payload>" URCs to subscriptions.
+
+  A payload with line breaks spans several lines, they are collected until
+  the one ending with the closing quote. Filters may use the MQTT wildcards
+  + (one level) and # (rest of the topic). Every matching subscription gets
+  (topic, payload) as bytes, a Queue subscription has its own bounded queue
+  so a slow consumer only loses its own oldest messages, a callable is
+  called as handler(topic, payload) inside the UART reader.
+
+  An unterminated payload (cut or garbled) must not swallow the responses
+  that follow: past PARTIAL_LINES lines, PARTIAL_BYTES bytes or PARTIAL_MS
+  it is dropped and the line goes on to the normal dispatch.
+  """
+  PARTIAL_LINES = 16
+  PARTIAL_BYTES = 1024
+  PARTIAL_MS = 1000 # the modem sends a URC in one go
+
+  def __init__(self):
+    self.subs = [] # [filter, filter levels, handler, delivered]
+    self.partial = None # [topic, [lines], bytes, ticks_ms] of a payload not finished yet
+    self.routed = 0
+    self.unrouted = 0
+    self.truncated = 0
+
+
+  def add(self, flt, handler):
+    if type(flt) is str:
+      flt = flt.encode()
+    self.subs.append([flt, tuple(flt.split(b'/')), handler, 0])
+
+
+  def remove(self, flt, handler=None):
+    if type(flt) is str:
+      flt = flt.encode()
+    self.subs = [s for s in self.subs if not (s[0] == flt and (handler is None or s[2] is handler))]
+
+
+  def queue(self, flt):
+    """
+    the Queue of subscription flt or None
+    """
+    if type(flt) is str:
+      flt = flt.encode()
+    for s in self.subs:
+      if s[0] == flt and isinstance(s[2], Queue):
+        return s[2]
+    return None
+
+
+  @staticmethod
+  def match(levels, topic):
+    tl = topic.split(b'/')
+    for i in range(len(levels)):
+      f = levels[i]
+      if f == b'#':
+        return True
+      if i >= len(tl) or (f != b'+' and f != tl[i]):
+        return False
+    return len(levels) == len(tl)
+
+
+  def feed(self, l):
+    """
+    a +SMSUB: line, or a continuation line while self.partial is set,
+    returns False when l does not belong to the payload
+    """
+    p = self.partial
+    if p is None:
+      i = l.find(b'"')
+      j = l.find(b'","', i + 1)
+      if i < 0 or j < 0:
+        raise ValueError('Can not parse %s' % str(l))
+      p = self.partial = [l[i+1:j], [], 0, utime.ticks_ms()]
+      l = l[j+3:]
+    elif (len(p[1]) >= self.PARTIAL_LINES or p[2] + len(l) > self.PARTIAL_BYTES or
+          utime.ticks_diff(utime.ticks_ms(), p[3]) > self.PARTIAL_MS):
+      self.drop()
+      return False
+    e = l.rstrip(b'\r\n')
+    if e.endswith(b'"'):
+      self.partial = None
+      p[1].append(e[:-1])
+      self._route(p[0], b''.join(p[1]))
+    else:
+      p[1].append(l)
+      p[2] += len(l)
+    return True
+
+
+  def drop(self):
+    """
+    give up the unterminated payload in self.partial
+    """
+    if self.partial is not None:
+      d("gsm: dropped unterminated +SMSUB payload for %s" % str(self.partial[0]))
+      self.partial = None
+      self.truncated += 1
+
+
+  def _route(self, topic, payload):
+    n = 0
+    for s in self.subs:
+      if self.match(s[1], topic):
+        n += 1
+        s[3] += 1
+        h = s[2]
+        try:
+          if isinstance(h, Queue):
+            h.put_nowait((topic, payload))
+          else:
+            h(topic, payload)
+        except Exception as e:
+          print('sim subscription handler exception:')
+          usys.print_exception(e)
+    if n:
+      self.routed += 1
+    else:
+      self.unrouted += 1
+      d("gsm: no subscription for %s" % str(topic))
+
+
+  def stats(self):
+    res = {'routed': self.routed, 'unrouted': self.unrouted, 'truncated': self.truncated, 'subs': {}}
+    for flt, _, h, n in self.subs:
+      e = {'delivered': n}
+      if isinstance(h, Queue):
+        e.update(h.stats())
+      res['subs'][flt.decode()] = e
+    return res
+
+
+class ATError(Exception):
+  """
+  final error result code of an AT command, code is the number of
+  +CME ERROR: <n> / +CMS ERROR: <n> (or its text in verbose mode), else None
+  """
+  def __init__(self, cmd, line):
+    self.cmd = cmd
+    self.line = line
+    self.code = None
+    i = line.find(b':')
+    if i > 0:
+      c = line[i+1:].strip()
+      try:
+        self.code = int(c)
+      except ValueError:
+        self.code = c.decode()
+    super().__init__('%s failed: %s' % (cmd, line.decode()))
+
+
+class ATStream:
+  """
+  Async iterator over the response of one AT command, lines are handed out
+  as they arrive instead of being collected first. Iteration ends at the
+  expected final line (not returned) and raises ATError or TimeoutError like
+  SIM.at(), the timeout counts from dispatch. With key (bytes) only lines
+  starting with it are returned, split into lists of str like atcsv_multi().
+
+  It works only inside `async with`: leaving the block by break or by an
+  exception consumes the rest of the response and releases the modem, a
+  bare `async for` raises RuntimeError. The modem is held by the iterating
+  task until then, so the loop body must not issue AT commands (they raise
+  RuntimeError), collect what is needed and act after the block.
+  """
+  def __init__(self, sim, cmd, expectend, timeout, partialend, prio, key=None):
+    self.sim = sim
+    self.cmd = cmd
+    self.expectend = expectend
+    self.timeout = timeout
+    self.partialend = partialend
+    self.prio = prio
+    self.key = key
+    self.state = 0 # 0 = not started, 1 = running, 2 = done
+    self.entered = False
+    self.rx = 0
+
+
+  def __aiter__(self):
+    return self
+
+
+  async def __aenter__(self):
+    self.entered = True
+    return self
+
+
+  async def __aexit__(self, *exc):
+    if self.state == 0:
+      self.state = 2
+      return False
+    try:
+      while self.state != 2:
+        await self.__anext__()
+    except Exception:
+      pass
+    return False
+
+
+  def _finish(self, st):
+    self.state = 2
+    self.sim._end(self.cmd, self.tq, self.t, len(self.cmd) + 2, self.rx, st)
+
+
+  async def __anext__(self):
+    s = self.sim
+    if self.state == 2:
+      raise StopAsyncIteration
+    if self.state == 0:
+      if not self.entered:
+        raise RuntimeError('ATStream used outside of async with')
+      self.exact, self.partial = s._matcher(self.expectend, self.partialend)
+      self.tq, self.t = await s._begin(self.prio)
+      self.state = 1
+      self.deadline = utime.ticks_add(self.t, int(self.timeout * 1000))
+      try:
+        if DEBUG:
+          d("gsm< %s" % self.cmd)
+        s.solicit = s._solicit(self.cmd)
+        await s.wtr.awrite(self.cmd.encode() + b"\r\n")
+      except BaseException:
+        self._finish(Metrics.ERROR)
+        raise
+    while True:
+      try:
+        if len(s.interactqueue):
+          # already received, no need for a timeout task
+          rl = await s.interactqueue.get()
+        else:
+          dl = utime.ticks_diff(self.deadline, utime.ticks_ms())
+          if dl <= 0:
+            raise uasyncio.TimeoutError
+          rl = await uasyncio.wait_for_ms(s.interactqueue.get(), dl)
+      except uasyncio.TimeoutError:
+        self._finish(Metrics.TIMEOUT)
+        raise
+      except BaseException:
+        self._finish(None)
+        raise
+      self.rx += len(rl)
+      l = rl.strip()
+      if l in self.exact or (self.partial is not None and self.partial in l):
+        self._finish(Metrics.OK)
+        raise StopAsyncIteration
+      if s._failed(l):
+        self._finish(Metrics.ERROR)
+        raise ATError(self.cmd, l)
+      if self.key is None:
+        return rl
+      i = csvstart(rl, self.key)
+      if i >= 0:
+        n = splitcsv(rl, i)
+        return [rl[_spans[2*j]:_spans[2*j+1]].decode() for j in range(n)]
+
+
+class SMSStream:
+  """
+  Groups the lines of a text mode AT+CMGL response into (fields, text)
+  per message, see SIM.get_sms_iter()
+  """
+  def __init__(self, lines):
+    self.lines = lines
+    self.head = None
+    self.body = []
+
+
+  def __aiter__(self):
+    return self
+
+
+  async def __aenter__(self):
+    await self.lines.__aenter__()
+    return self
+
+
+  async def __aexit__(self, *exc):
+    return await self.lines.__aexit__(*exc)
+
+
+  def _take(self):
+    r = (self.head, b''.join(self.body).rstrip(b'\r\n').decode())
+    self.head = None
+    self.body = []
+    return r
+
+
+  async def __anext__(self):
+    while True:
+      try:
+        rl = await self.lines.__anext__()
+      except StopAsyncIteration:
+        if self.head is None:
+          raise
+        return self._take()
+      i = csvstart(rl, b'+CMGL:')
+      if i >= 0:
+        prev = self._take() if self.head is not None else None
+        n = splitcsv(rl, i)
+        self.head = [rl[_spans[2*j]:_spans[2*j+1]].decode() for j in range(n)]
+        if prev:
+          return prev
+      elif self.head is not None:
+        self.body.append(rl)
+
+
+class SMSInbox:
+  """
+  URC driven processing of received SMS: each +CMTI index is read with
+  AT+CMGR, handed over and deleted, the storage is never listed again.
+  Parts of concatenated messages are held until complete and handed over
+  as one SMS, MAXPENDING messages at most, the oldest is dropped.
+
+  handler is a Queue or a callable taking the SMS, without one messages go
+  to self.queue for get(). A message is deleted only after the hand-over, so
+  when the queue is full, new messages wait in the SIM storage.
+  """
+  MAXPENDING = 4
+  QUEUE_SIZE = 4
+
+  def __init__(self, sim, handler=None):
+    self.sim = sim
+    self.queue = None
+    if handler is None:
+      self.queue = handler = Queue(self.QUEUE_SIZE, Queue.BLOCK)
+    self.handler = handler
+    self.pending = {} # (sender, ref) -> {part: SMS}
+    self.order = []
+    self.task = None
+    self.received = 0
+    self.delivered = 0
+    self.dropped = 0
+    self.errors = 0
+    self.syncs = 0
+    self.drops = 0
+
+
+  def start(self):
+    if self.task is None:
+      self.task = uasyncio.create_task(self._run())
+
+
+  def stop(self):
+    if self.task:
+      self.task.cancel()
+      self.task = None
+
+
+  async def get(self):
+    return await self.queue.get()
+
+
+  async def sync(self):
+    """
+    process everything in the storage, e.g. what arrived before start()
+    """
+    self.syncs += 1
+    s = self.sim
+    self.drops = s.smsnew.drops
+    s.smsnew.clear()
+    for f in await s.get_sms():
+      await self._take(int(f[0]))
+
+
+  async def _run(self):
+    s = self.sim
+    try:
+      await self.sync()
+    except Exception as e:
+      self.errors += 1
+      print('sim.SMSInbox sync exception:')
+      usys.print_exception(e)
+    while True:
+      idx = await s.smsnew.get()
+      try:
+        if s.smsnew.drops != self.drops: # lost +CMTI, list the storage instead
+          await self.sync()
+        else:
+          await self._take(idx)
+      except uasyncio.CancelledError:
+        raise
+      except Exception as e:
+        # the message stays in the storage for the next sync()
+        self.errors += 1
+        print('sim.SMSInbox exception:')
+        usys.print_exception(e)
+
+
+  async def _take(self, idx):
+    m = await self.sim.read_sms(idx)
+    if m is None:
+      return
+    self.received += 1
+    if m.parts > 1:
+      k = (m.sender, m.ref)
+      p = self.pending.get(k)
+      if p is None:
+        if len(self.order) >= self.MAXPENDING:
+          for o in self.pending.pop(self.order.pop(0)).values():
+            await self.sim.del_sms(o.index)
+          self.dropped += 1
+        p = self.pending[k] = {}
+        self.order.append(k)
+      p[m.part] = m
+      if len(p) < m.parts:
+        return
+      del self.pending[k]
+      self.order.remove(k)
+      ps = [p[i] for i in sorted(p)]
+      m = SMS(ps[0].index, ps[0].stat, m.sender, ps[0].time, ''.join(o.text for o in ps),
+              m.ref, 1, m.parts, [o.index for o in ps])
+    if isinstance(self.handler, Queue):
+      await self.handler.put(m)
+    else:
+      self.handler(m)
+    self.delivered += 1
+    for i in m.indexes:
+      await self.sim.del_sms(i)
+
+
+  def stats(self):
+    return {'received': self.received, 'delivered': self.delivered, 'pending': len(self.pending),
+            'dropped': self.dropped, 'errors': self.errors, 'syncs': self.syncs}
+
+
+class SMSOutbox:
+  """
+  Send queue for SMS: send() returns at once, the task sends all messages
+  queued by then in one batch with AT+CMMS keeping the link to the SMSC
+  open. A message that fails is retried RETRIES times in later batches.
+  """
+  QUEUE_SIZE = 8
+  RETRIES = 2
+
+  def __init__(self, sim):
+    self.sim = sim
+    self.queue = Queue(self.QUEUE_SIZE, Queue.BLOCK)
+    self.task = None
+    self.sent = 0
+    self.failed = 0
+    self.batches = 0
+
+
+  def start(self):
+    if self.task is None:
+      self.task = uasyncio.create_task(self._run())
+
+
+  def stop(self):
+    if self.task:
+      self.task.cancel()
+      self.task = None
+
+
+  async def send(self, tel, msg):
+    await self.queue.put([tel, msg, 0])
+
+
+  async def _run(self):
+    while True:
+      batch = [await self.queue.get()]
+      while len(self.queue):
+        batch.append(await self.queue.get())
+      self.batches += 1
+      failed = await self.sim.send_sms_batch(batch)
+      self.sent += len(batch) - len(failed)
+      for m in failed:
+        m[2] += 1
+        # never wait for room here, this task is the only consumer
+        if m[2] > self.RETRIES or not self.queue.put_nowait(m):
+          self.failed += 1
+
+
+  def stats(self):
+    return {'queued': len(self.queue), 'sent': self.sent, 'failed': self.failed, 'batches': self.batches}
+
+
+class CmdScheduler:
+  """
+  Keeps exactly one AT command in flight. acquire() returns at once when
+  the modem is idle, otherwise the caller waits until release() hands the
+  modem over; waiters are served by priority (lower first), then in order.
+  A task that holds the modem and asks again, e.g. an at() inside the loop
+  over an ATStream, gets RuntimeError instead of waiting for itself.
+  """
+  def __init__(self):
+    self.busy = False
+    self.owner = None # task holding the modem
+    self.waiters = [] # [prio, seq, Event] sorted
+    self.seq = 0
+    self.served = 0
+    self.queued = 0
+    self.hwm = 0
+
+
+  async def acquire(self, prio):
+    t = uasyncio.current_task()
+    if self.busy and self.owner is t:
+      raise RuntimeError('AT command issued by the task that holds the modem')
+    self.served += 1
+    if not self.busy:
+      self.busy = True
+      self.owner = t
+      return
+    w = [prio, self.seq, uasyncio.Event()]
+    self.seq += 1
+    i = len(self.waiters)
+    while i > 0 and self.waiters[i-1][0] > prio:
+      i -= 1
+    self.waiters.insert(i, w)
+    self.queued += 1
+    if len(self.waiters) > self.hwm:
+      self.hwm = len(self.waiters)
+    try:
+      await w[2].wait()
+    except BaseException:
+      if w in self.waiters:
+        self.waiters.remove(w)
+      else: # the modem was handed over already
+        self.release()
+      raise
+    self.owner = t
+
+
+  def release(self):
+    self.owner = None
+    if self.waiters:
+      self.waiters.pop(0)[2].set()
+    else:
+      self.busy = False
+
+
+  def stats(self):
+    return {'busy': self.busy, 'waiting': len(self.waiters), 'hwm': self.hwm,
+            'served': self.served, 'queued': self.queued}
+
+
+class Metrics:
+  """
+  Per-verb AT command counters. Each verb ('AT+SMPUB', 'AT+CSQ', ...) gets
+  one preallocated array on its first use, record() only updates it in place.
+  Execution latency (from dispatch to the final line) is kept as min/sum/max
+  and a histogram over BUCKETS (ms upper bounds, the last slot counts the
+  rest), time spent waiting for the modem in CmdScheduler as sum/max.
+  """
+  OK = 0
+  ERROR = 1
+  TIMEOUT = 2
+
+  CALLS = 0
+  TIMEOUTS = 1
+  ERRORS = 2
+  MIN = 3
+  MAX = 4
+  SUM = 5
+  TX = 6
+  RX = 7
+  QWAIT = 8
+  QWAIT_MAX = 9
+  HIST = 10
+  BUCKETS = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+  def __init__(self):
+    self.verbs = {}
+
+
+  @staticmethod
+  def verbend(cmd):
+    """
+    length of the verb of cmd (AT+CREG? -> 7), found without slicing
+    """
+    e = len(cmd)
+    for c in ('=', '?', '\r'):
+      i = cmd.find(c, 2, e)
+      if i >= 0:
+        e = i
+    return e
+
+
+  def record(self, cmd, ms, tx, rx, status, qwait=0):
+    if type(cmd) is bytes:
+      cmd = cmd.decode()
+    e = self.verbend(cmd)
+    a = None
+    # known verbs are matched in place, only a new one costs a slice
+    for v in self.verbs:
+      if len(v) == e and cmd.startswith(v):
+        a = self.verbs[v]
+        break
+    if a is None:
+      a = self.verbs[cmd[:e]] = array('l', [0] * (self.HIST + len(self.BUCKETS) + 1))
+      a[self.MIN] = 0x7fffffff
+    a[self.CALLS] += 1
+    if status == self.TIMEOUT:
+      a[self.TIMEOUTS] += 1
+    elif status == self.ERROR:
+      a[self.ERRORS] += 1
+    if ms < a[self.MIN]:
+      a[self.MIN] = ms
+    if ms > a[self.MAX]:
+      a[self.MAX] = ms
+    a[self.SUM] += ms
+    a[self.TX] += tx
+    a[self.RX] += rx
+    a[self.QWAIT] += qwait
+    if qwait > a[self.QWAIT_MAX]:
+      a[self.QWAIT_MAX] = qwait
+    i = self.HIST
+    for b in self.BUCKETS:
+      if ms <= b:
+        break
+      i += 1
+    a[i] += 1
+
+
+  def reset(self):
+    self.verbs = {}
+
+
+  def todict(self):
+    res = {}
+    for v, a in self.verbs.items():
+      res[v] = {'calls': a[self.CALLS], 'timeouts': a[self.TIMEOUTS], 'errors': a[self.ERRORS],
+                'min': a[self.MIN], 'avg': a[self.SUM] // a[self.CALLS], 'max': a[self.MAX],
+                'tx': a[self.TX], 'rx': a[self.RX], 'qwait_avg': a[self.QWAIT] // a[self.CALLS],
+                'qwait_max': a[self.QWAIT_MAX], 'hist': list(a[self.HIST:])}
+    return res
+
+
 class SIM:
   CMD_TIMEOUT = 5
-
-  def __init__(self, pwr_pin, reset_pin, rx_pin, tx_pin, uart_num=1):
-    self.pwr_pin = machine.Pin(pwr_pin, machine.Pin.OUT)
-    self.reset_pin = machine.Pin(reset_pin, machine.Pin.OUT)
+  METRICS = True # per-verb AT command metrics, see Metrics
+  TRANSCRIPT = None # directory for a recording of all UART traffic, see transcript.py
+
+  # command priorities in CmdScheduler, lower goes first
+  PRIO_KEEPALIVE = 0 # probes and session checks
+  PRIO_PUBLISH = 1
+  PRIO_NORMAL = 2
+  PRIO_SHELL = 3 # interactive commands, e.g. from the main.py shell
+  MQTTQUEUE_SIZE = 8 # messages per subscription queue
+  INTERACTQUEUE_SIZE = 32
+  SMSQUEUE_SIZE = 16 # +CMTI indexes waiting for SMSInbox
+  SMS_PDU = False # SMS in PDU mode (AT+CMGF=0): fewer UART bytes, UCS2 and concatenated messages, see pdu.py
+
+  def __init__(self, pwr_pin, reset_pin, rx_pin, tx_pin, uart_num=1, dtr_pin=None, rts_pin=None, cts_pin=None,
+               status_pin=None):
+    self.pwr_pin = machine.Pin(pwr_pin, machine.Pin.OUT) if pwr_pin is not None else None
+    self.reset_pin = machine.Pin(reset_pin, machine.Pin.OUT) if reset_pin is not None else None
+    self.dtr_pin = machine.Pin(dtr_pin, machine.Pin.OUT, value=0) if dtr_pin is not None else None
+    self.status_pin = machine.Pin(status_pin, machine.Pin.IN) if status_pin is not None else None
     self.rx_pin = rx_pin
     self.tx_pin = tx_pin
     self.uart_num = uart_num
+    self.rts_pin = rts_pin
+    self.cts_pin = cts_pin
     self.uart = None
+    self.baudrate = None
+    self.flow = False
     self.rdr = None
     self.wtr = None
     self.multiplextask = None
-    self.mqttqueue = Queue()
-    self.interactqueue = Queue()
+    # the reader must never block on a full queue, so drop the oldest lines
+    self.interactqueue = Queue(self.INTERACTQUEUE_SIZE, Queue.DROP_OLDEST)
+    self.solicit = None # response prefix of the command in flight, e.g. b'+CREG:'
+    self.prompting = False # a data command waits for the '> ' prompt
+    self.urc = URCTable()
+    self.router = SubRouter()
+    self.urc.register(b'+SMSUB:', self.router.feed)
+    self.reg = RegState()
+    self.booted = uasyncio.Event()
+    self.warm = False
+    self.timings = {}
+    self.urc.register(b'RDY', self._urc_boot)
+    self.urc.register(b'SMS Ready', self._urc_boot)
+    self.urc.register(b'+CREG:', self._urc_creg) # network registration event
+    self.urc.register(b'+CEREG:', self._urc_cereg) # EPS (LTE) registration event
+    self.urc.register(b'*PSUTTZ:', self._urc_psuttz) # network time event
+    self.urc.register(b'+SMSTATE:', self._urc_smstate) # MQTT connection state change
+    self.urc.register(b'+APP PDP:', self._urc_apppdp) # CNACT bearer state change
+    self.smsnew = Queue(self.SMSQUEUE_SIZE, Queue.DROP_OLDEST)
+    self.urc.register(b'+CMTI:', self._urc_cmti) # new SMS stored
+    self.inbox = None
+    self.outbox = None
+    self.smsref = 0 # reference of concatenated messages sent
+    self.track = None # gnss.Track fed by +UGNSINF, see gnss_track()
+    self.cache = {} # query -> (ticks_ms, result)
+    self.cache_ttl = dict(self.CACHE_TTL)
+    self.cache_hits = 0
+    self.cache_misses = 0
+    self.metrics = Metrics() if self.METRICS else None
+    self.cmdq = CmdScheduler()
+    self.recorder = None
+    self.flushtask = None
+    self.psmode = None # None, 'psm' or 'edrx'
+    self.asleep = False
+    self.awake_since = utime.ticks_ms()
+    self.slept_at = None
+    self.lastawake = 0
+    self.power = {'cycles': 0, 'pwrkey_wakes': 0, 'radio_on_ms': 0, 'sleep_ms': 0, 'last_radio_on_ms': 0}
 
 
   async def signal_reset(self):
@@ -124,30 +1332,42 @@ class SIM:
     self.pwr_pin.off()
 
 
-  async def _input_drain(self):
-    r = b''
-    try:
-      while True:
-        r += await uasyncio.wait_for(self.rdr.readline(), 1)
-    except uasyncio.TimeoutError:
-      pass
-
-
+  RDR_CHUNK = 64
+  PROMPT = b'>' # queued for _at_data() when the prompt arrives
+  PROMPT_LINE = b'> '
   async def _rdr_multiplex(self):
+    """
+    reads the UART byte-wise, splits lines and detects the '> ' data prompt
+    that the modem sends without line termination, only while a data
+    command waits for it
+    """
+    buf = b''
     while True:
       try:
-        l = await self.rdr.readline()
-        if not l:
+        chunk = await self.rdr.read(self.RDR_CHUNK)
+        if not chunk:
           continue
-        #d("DBG: %s" % str(l))
-        if l.startswith(b'+SMSUB:') and self.mqttqueue:
-          await self.mqttqueue.put(l)
-        if l.startswith(b'+CREG:'): # network registration event
-          d("Unsolicited CREG: %s" % str(l))
-        if l.startswith(b'*PSUTTZ:'): # network time event
-          d("Unsolicited PSUTTZ: %s" % str(l))
-        else:
-          await self.interactqueue.put(l)
+        buf += chunk
+        while True:
+          i = buf.find(b'\n')
+          if i < 0:
+            break
+          l = buf[:i+1]
+          buf = buf[i+1:]
+          # payload of a +SMSUB over several lines
+          if self.router.partial is not None:
+            if self._ends_partial(l):
+              self.router.drop()
+            elif self.router.feed(l):
+              continue
+          if not l.strip():
+            continue
+          #d("DBG: %s" % str(l))
+          self._dispatch(l)
+        if self.prompting and buf == self.PROMPT_LINE: # data prompt after AT+SMPUB / AT+CMGS
+          buf = b''
+          self.prompting = False
+          self.interactqueue.put_nowait(self.PROMPT)
       except uasyncio.CancelledError:
         break
       except Exception as e:
@@ -155,43 +1375,135 @@ class SIM:
         usys.print_exception(e)
 
 
-  async def init(self):
-    await self.signal_reset()
+  def _ends_partial(self, l):
+    """
+    a line that can not continue a +SMSUB payload: while a command is in
+    flight, its final result code or response
+    """
+    if not self.cmdq.busy:
+      return False
+    s = l.strip()
+    return (s == b'OK' or self._failed(s) or
+            (self.solicit is not None and l.startswith(self.solicit)))
+
+
+  def _dispatch(self, l):
+    hs = self.urc.match(l, self.solicit)
+    if not hs:
+      self.interactqueue.put_nowait(l)
+      return
+    for h in hs:
+      try:
+        if isinstance(h, Queue):
+          h.put_nowait(l)
+        else:
+          h(l)
+      except Exception as e:
+        print('sim URC handler exception:')
+        usys.print_exception(e)
 
-    self.uart = machine.UART(self.uart_num)
-    self.uart.init(rx=self.rx_pin, tx=self.tx_pin, baudrate=9600)
-    self.rdr = uasyncio.StreamReader(self.uart)
-    self.wtr = uasyncio.StreamWriter(self.uart)
 
-    await self.signal_pwr() 
-    await uasyncio.sleep(6)
-    d("gsm: modem enabled")
+  def _urc_log(self, l):
+    d("Unsolicited %s" % str(l))
 
-    await self._input_drain()
-    self.multiplextask = uasyncio.create_task(self._rdr_multiplex())
-    for _ in [0,1]:
-      for _ in range(0,10):
-        try:
-          await self.at('AT', 'OK', 1)
-          break
-        except uasyncio.TimeoutError:
-          pass
-        await uasyncio.sleep_ms(100)
-      try:
-        await self.at('AT', 'OK', self.CMD_TIMEOUT)
-        break
-      except uasyncio.TimeoutError:
-        await self.signal_pwr()
-    await self.at('AT+CMGF=1', 'OK', self.CMD_TIMEOUT) # set SMS mode to text
 
+  def _urc_creg(self, l):
+    self._urc_log(l)
+    self.reg.update_urc('creg', l)
+    self.cache_invalidate('netreg', 'netinfo', 'signal')
 
 
-  async def deinit(self):
-    await self.wtr.drain()
+  def _urc_cereg(self, l):
+    self._urc_log(l)
+    self.reg.update_urc('cereg', l)
+    self.cache_invalidate('netreg', 'netinfo', 'signal')
+
+
+  def _urc_psuttz(self, l):
+    self._urc_log(l)
+    self.cache_invalidate('netinfo')
+
+
+  def _urc_cmti(self, l):
+    """
+    +CMTI: <mem>,<index>
+    """
+    self._urc_log(l)
+    n = splitcsv(l, csvstart(l, b'+CMTI:'))
+    if n > 1:
+      self.smsnew.put_nowait(csvint(l, _spans[2], _spans[3]))
+
+
+  def _urc_smstate(self, l):
+    """
+    +SMSTATE: <status> carries the same value as the AT+SMSTATE? response
+    """
+    self._urc_log(l)
+    n = splitcsv(l, csvstart(l, b'+SMSTATE'))
+    if n:
+      self.cache['connstatus'] = (utime.ticks_ms(), [l[_spans[0]:_spans[1]].decode()])
+    else:
+      self.cache_invalidate('connstatus')
+
+
+  def _urc_apppdp(self, l):
+    self._urc_log(l)
+    self.cache_invalidate('appstatus', 'connstatus')
+
+
+  def urc_register(self, prefix, handler):
+    """
+    prefix: 'URC up to and including the colon, e.g. +CMTI:, or a whole line like NORMAL POWER DOWN'
+    handler: 'Queue or callable(line)'
+    """
+    self.urc.register(prefix, handler)
+
+
+  def urc_unregister(self, prefix, handler):
+    self.urc.unregister(prefix, handler)
+
+
+  def urc_stats(self):
+    return self.urc.stats()
+
+
+  @staticmethod
+  def _solicit(cmd):
+    """
+    response prefix of query/exec commands (AT+CREG? -> b'+CREG:'), set commands yield None
+    """
+    if type(cmd) is bytes:
+      cmd = cmd.decode()
+    if '=' in cmd or not cmd.startswith('AT+'):
+      return None
+    return (cmd[2:].strip().rstrip('?') + ':').encode()
+
+
+  def attach(self, rdr, wtr):
+    """
+    start the line multiplexer on a reader/writer pair (UART streams or a scripted modem)
+    """
+    if self.TRANSCRIPT:
+      if self.recorder is None:
+        import transcript
+        self.recorder = transcript.Recorder(self.TRANSCRIPT)
+      self.recorder.mark('attach')
+      rdr, wtr = self.recorder.tap(rdr, wtr)
+      self.flushtask = uasyncio.create_task(self.recorder.flusher())
+    self.rdr = rdr
+    self.wtr = wtr
+    self.multiplextask = uasyncio.create_task(self._rdr_multiplex())
+
+
+  async def detach(self):
     if self.multiplextask:
       self.multiplextask.cancel()
       await self.multiplextask
       self.multiplextask = None
+    if self.flushtask:
+      self.flushtask.cancel()
+      self.flushtask = None
+    self.transcript_flush()
     try:
       self.rdr.close()
     except:
@@ -202,7 +1514,215 @@ class SIM:
     except:
       pass
     self.wtr = None
-    self.uart.deinit()
+
+
+  def transcript_flush(self):
+    """
+    write the buffered part of the transcript, e.g. before machine.reset()
+    """
+    if self.recorder:
+      self.recorder.flush()
+
+
+  def _phase(self, name, t):
+    """
+    record duration of a boot phase started at ticks_ms t, returns now
+    """
+    now = utime.ticks_ms()
+    self.timings[name] = utime.ticks_diff(now, t)
+    d("gsm: %s took %d ms" % (name, self.timings[name]))
+    return now
+
+
+  PROBE_TIMEOUT_MS = 500
+  async def _probe(self, tries=2):
+    """
+    returns True when the modem answers AT
+    """
+    for _ in range(tries):
+      await self.cmdq.acquire(self.PRIO_KEEPALIVE)
+      try:
+        self.interactqueue.clear()
+        await uasyncio.wait_for_ms(self._at('AT', 'OK'), self.PROBE_TIMEOUT_MS)
+        return True
+      except uasyncio.TimeoutError:
+        pass
+      finally:
+        self.solicit = None
+        self.cmdq.release()
+    return False
+
+
+  def _urc_boot(self, l):
+    self._urc_log(l)
+    self.booted.set()
+
+
+  BOOT_TIMEOUT = 15 # seconds from PWRKEY to RDY / SMS Ready
+  async def _power_on(self):
+    """
+    power the modem on and wait until it is ready, the RDY and SMS Ready URCs
+    come only with a fixed baudrate, so keep probing with AT to catch autobauding modems
+    """
+    for _ in [0,1]:
+      self.booted.clear()
+      await self.signal_reset()
+      await self.signal_pwr()
+      deadline = utime.ticks_add(utime.ticks_ms(), self.BOOT_TIMEOUT * 1000)
+      while utime.ticks_diff(deadline, utime.ticks_ms()) > 0:
+        try:
+          await uasyncio.wait_for_ms(self.booted.wait(), 1000)
+        except uasyncio.TimeoutError:
+          pass
+        self.interactqueue.clear()
+        if await self._probe(1):
+          return
+      # the modem may keep a fixed AT+IPR rate different from ours
+      if await self._detect_baudrate() is not None:
+        return
+    raise Exception("Modem does not respond after power on")
+
+
+  # UART speed, BAUDRATES are tried in order by _detect_baudrate(), SIM7000
+  # accepts these in AT+IPR, AT+IPR=0 (the default) autobauds on the first AT
+  BAUDRATES = (115200, 9600, 921600, 230400, 57600, 38400, 19200)
+  BAUDRATE = 115200 # switched to in init(), None keeps the detected rate
+  UART_RXBUF = 1024 # bytes, holds a 512 B publish echo or a long +CMGL at high rates
+
+  def _uart_setup(self, baudrate):
+    """
+    (re)configure the MCU side of the UART, no-op with attached foreign streams
+    """
+    self.baudrate = baudrate
+    if not self.uart:
+      return
+    if self.flow:
+      self.uart.init(rx=self.rx_pin, tx=self.tx_pin, baudrate=baudrate, rxbuf=self.UART_RXBUF,
+                     rts=self.rts_pin, cts=self.cts_pin, flow=machine.UART.RTS | machine.UART.CTS)
+    else:
+      self.uart.init(rx=self.rx_pin, tx=self.tx_pin, baudrate=baudrate, rxbuf=self.UART_RXBUF)
+
+
+  async def _detect_baudrate(self, sweep=True):
+    """
+    probe the current and the configured rate, then the rest of BAUDRATES
+    when sweep, returns the rate or None
+    """
+    rates = [self.baudrate] if self.baudrate else []
+    if self.BAUDRATE and self.BAUDRATE not in rates:
+      rates.append(self.BAUDRATE)
+    if sweep:
+      rates += [r for r in self.BAUDRATES if r not in rates]
+    for r in rates:
+      self._uart_setup(r)
+      await uasyncio.sleep_ms(20)
+      self.interactqueue.clear()
+      if await self._probe(1):
+        d("gsm: modem answers at %d baud" % r)
+        return r
+    self._uart_setup(rates[0])
+    return None
+
+
+  async def set_baudrate(self, baudrate):
+    """
+    switch the modem (AT+IPR) and then the UART to baudrate, returns True on success,
+    when the modem does not answer at the new rate the old one is restored
+    """
+    old = self.baudrate
+    if baudrate == old:
+      return True
+    await self.at('AT+IPR=%d' % baudrate, 'OK', self.CMD_TIMEOUT) # answered at the old rate
+    await self.wtr.drain()
+    await uasyncio.sleep_ms(50)
+    self._uart_setup(baudrate)
+    self.interactqueue.clear()
+    if await self._probe(3):
+      return True
+    print("gsm: no answer at %d baud, falling back to %d" % (baudrate, old))
+    self._uart_setup(old)
+    self.interactqueue.clear()
+    if await self._probe() or await self._detect_baudrate() is not None:
+      return False
+    raise Exception("Modem lost after switching to %d baud" % baudrate)
+
+
+  async def set_flowcontrol(self, enable):
+    """
+    RTS/CTS hardware flow control (AT+IFC) on both sides, needs rts_pin and cts_pin
+    """
+    if enable and (self.rts_pin is None or self.cts_pin is None):
+      raise ValueError('RTS/CTS flow control needs rts_pin and cts_pin')
+    await self.at('AT+IFC=%s' % ('2,2' if enable else '0,0'), 'OK', self.CMD_TIMEOUT)
+    await self.wtr.drain()
+    self.flow = enable
+    self._uart_setup(self.baudrate)
+
+
+  async def throughput(self, cmd='AT+CLAC', n=3):
+    """
+    received bytes per second over n runs of cmd, a command with a long answer
+    """
+    nbytes = 0
+    t = utime.ticks_ms()
+    for _ in range(n):
+      for l in await self.at(cmd, 'OK', self.CMD_TIMEOUT):
+        nbytes += len(l)
+    dt = utime.ticks_diff(utime.ticks_ms(), t)
+    return nbytes * 1000 / dt if dt else 0
+
+
+  async def init(self, cold=False):
+    """
+    reuse a modem that already answers AT (e.g. after a soft reset of the MCU),
+    power cycle it only when it does not or cold=True (e.g. after deinit()),
+    only the known rates are probed here, _power_on() sweeps the rest
+    """
+    self.timings = {}
+    t0 = t = utime.ticks_ms()
+    self.cache_invalidate()
+
+    if self.rdr is None: # streams attached before init(), e.g. simemu, are kept
+      if not self.uart:
+        self.uart = machine.UART(self.uart_num)
+        self.flow = False
+        self._uart_setup(self.baudrate or self.BAUDRATES[0])
+      self.attach(uasyncio.StreamReader(self.uart), uasyncio.StreamWriter(self.uart))
+
+    self.warm = False
+    if not cold:
+      self.warm = await self._detect_baudrate(False) is not None
+      t = self._phase('probe', t)
+    if not self.warm:
+      await self._power_on()
+      t = self._phase('power_on', t)
+      d("gsm: modem enabled")
+    else:
+      d("gsm: modem already running")
+
+    if self.BAUDRATE and self.baudrate != self.BAUDRATE:
+      await self.set_baudrate(self.BAUDRATE)
+    if self.rts_pin is not None and self.cts_pin is not None and not self.flow:
+      await self.set_flowcontrol(True)
+    t = self._phase('uart', t)
+
+    await self.at('AT+CMGF=%d' % (0 if self.SMS_PDU else 1), 'OK', self.CMD_TIMEOUT) # SMS mode PDU/text
+    await self.at('AT+CNMI=2,1,0,0,0', ['OK', 'ERROR'], self.CMD_TIMEOUT) # +CMTI for new SMS
+    await self.at('AT+CREG=2', 'OK', self.CMD_TIMEOUT) # registration URCs with location
+    await self.at('AT+CEREG=2', ['OK', 'ERROR'], self.CMD_TIMEOUT)
+    if self.warm:
+      await self.get_netreg()
+    t = self._phase('setup', t)
+    self._phase('init', t0)
+    return self.warm
+
+
+  async def deinit(self):
+    await self.wtr.drain()
+    await self.detach()
+    if self.uart:
+      self.uart.deinit()
+      self.uart = None
     await uasyncio.sleep_ms(100)
     await self.signal_reset()
     await uasyncio.sleep_ms(100)
@@ -231,119 +1751,395 @@ class SIM:
       elif l:
         await self.wtr.awrite(l.encode() + b"\r\n")
 
-    rt.cancel()
+    rt.cancel()
+
+
+  # final result codes that end a command with a failure, see ATError,
+  # whole lines so that e.g. an SMS text starting with BUSY does not match
+  FINAL_ERRORS = (b'ERROR', b'SEND FAIL', b'NO CARRIER', b'BUSY', b'NO ANSWER', b'NO DIALTONE')
+  FINAL_ERROR_CODES = (b'+CME ERROR:', b'+CMS ERROR:')
+
+  @classmethod
+  def _failed(cls, l):
+    """
+    True for a stripped line that is a final error result code
+    """
+    if l in cls.FINAL_ERRORS:
+      return True
+    for c in cls.FINAL_ERROR_CODES: # MicroPython startswith() takes no tuple
+      if l.startswith(c):
+        return True
+    return False
+
+
+  _matchers = {} # (expectend, partialend) -> (exact lines, substring or None)
+  @classmethod
+  def _matcher(cls, expectend, partialend):
+    """
+    expectend is a str or a list/set of str, compiled to bytes once per distinct value
+    """
+    k = (expectend if type(expectend) is str else tuple(expectend), partialend)
+    m = cls._matchers.get(k)
+    if m is None:
+      if type(expectend) is str:
+        exact = (expectend.encode(),)
+        m = (exact, exact[0] if partialend else None)
+      else:
+        m = (tuple(e.encode() for e in expectend), None)
+      cls._matchers[k] = m
+    return m
+
+
+  async def _at(self, cmd, expectend, partialend=False):
+    """
+    returns array of byte arrays (lines) up to the one matching expectend,
+    raises ATError on a final error result code unless it is expected
+    """
+    exact, partial = self._matcher(expectend, partialend)
+    if DEBUG:
+      d("gsm< %s" % cmd)
+    self.solicit = self._solicit(cmd)
+    if type(cmd) is bytes:
+      await self.wtr.awrite(cmd)
+    else:
+      await self.wtr.awrite(cmd.encode() + b"\r\n")
+    r = []
+    while True:
+      rl = await self.interactqueue.get()
+      r.append(rl)
+
+      l = rl.strip()
+      if l in exact or (partial is not None and partial in l):
+        if DEBUG:
+          d("gsm> %s" % str(r))
+        return r
+      if self._failed(l):
+        raise ATError(cmd, l)
+
+
+  async def _begin(self, prio):
+    """
+    wait for the turn of a command, returns (ticks queued, ticks dispatched),
+    a sleeping modem is woken first
+    """
+    tq = utime.ticks_ms()
+    while self.asleep: # e.g. SMSOutbox or a shell command between uplink cycles
+      await self.wake()
+    await self.cmdq.acquire(prio)
+    # lines left over from an earlier command that timed out
+    self.interactqueue.clear()
+    return tq, utime.ticks_ms()
+
+
+  def _end(self, cmd, tq, t, tx, rx, st):
+    """
+    release the modem after a command started by _begin(), st is a Metrics status or None
+    """
+    self.solicit = None
+    self.cmdq.release()
+    if self.metrics is not None and st is not None:
+      self.metrics.record(cmd, utime.ticks_diff(utime.ticks_ms(), t), tx, rx, st, utime.ticks_diff(t, tq))
+
+
+  async def _exclusive(self, cmd, coro, timeout, prio, tx):
+    """
+    run command coroutine coro with exactly one command in flight, the timeout
+    starts when the command is dispatched, not while it waits for its turn
+    """
+    try:
+      tq, t = await self._begin(prio)
+    except BaseException:
+      coro.close()
+      raise
+    m = self.metrics
+    st = None
+    rx = 0
+    try:
+      r = await uasyncio.wait_for(coro, timeout)
+      if m is not None:
+        for l in r:
+          rx += len(l)
+        st = m.ERROR if r and self._failed(r[-1].strip()) else m.OK
+      return r
+    except uasyncio.TimeoutError:
+      st = Metrics.TIMEOUT
+      raise
+    except Exception:
+      st = Metrics.ERROR
+      raise
+    finally:
+      self._end(cmd, tq, t, tx, rx, st)
+
+
+  async def at(self, cmd, expectend, timeout=5, partialend=False, prio=PRIO_NORMAL):
+    return await self._exclusive(cmd, self._at(cmd, expectend, partialend), timeout, prio, len(cmd) + 2)
+
+
+  def at_iter(self, cmd, expectend='OK', timeout=5, partialend=False, prio=PRIO_NORMAL):
+    """
+    like at(), but an async iterator handing out the lines as they arrive, see ATStream
+    """
+    return ATStream(self, cmd, expectend, timeout, partialend, prio)
+
+
+  async def _at_data(self, cmd, data):
+    """
+    send cmd, wait for the '>' prompt, send data and wait for the final result code
+    returns array of byte arrays (lines)
+    """
+
+    if DEBUG:
+      d("gsm< %s" % cmd)
+    self.prompting = True
+    try:
+      return await self._at_data_rsp(cmd, data)
+    finally:
+      self.prompting = False
+
+
+  async def _at_data_rsp(self, cmd, data):
+    await self.wtr.awrite(cmd.encode() + b"\r\n")
+    r = []
+    while True:
+      rl = await self.interactqueue.get()
+      if rl == self.PROMPT:
+        if DEBUG:
+          d("gsm< %d bytes" % len(data))
+        await self.wtr.awrite(data)
+        continue
+      r.append(rl)
+
+      l = rl.strip()
+      if l == b'OK':
+        if DEBUG:
+          d("gsm> %s" % str(r))
+        return r
+      if self._failed(l):
+        raise ATError(cmd, l)
+
+
+  async def at_data(self, cmd, data, timeout=5, prio=PRIO_NORMAL):
+    return await self._exclusive(cmd, self._at_data(cmd, data), timeout, prio, len(cmd) + 2 + len(data))
+
+
+  def metrics_stats(self):
+    return self.metrics.todict() if self.metrics else {}
+
+
+  async def atcsv_multi(self, cmd, expectend, keystr, timeout=5, partialend=False, prio=PRIO_NORMAL):
+    """
+    cmd: 'string or byte array'
+    expectend: 'OK or something to distingusih the last line'
+    keystr: 'string to match in the output line, i.e. +CSI on line like +CSI: 1,2,3'
+    """
+
+    lns = await self.at(cmd, expectend, timeout, partialend, prio)
+
+    key = keystr.encode()
+    res = []
+    for rl in lns:
+      i = csvstart(rl, key)
+      if i >= 0:
+        n = splitcsv(rl, i)
+        res.append([rl[_spans[2*j]:_spans[2*j+1]].decode() for j in range(n)])
+
+    return res
+
+
+  def atcsv_iter(self, cmd, expectend, keystr, timeout=5, partialend=False, prio=PRIO_NORMAL):
+    """
+    like atcsv_multi(), but an async iterator handing out each parsed line as it arrives
+    """
+    return ATStream(self, cmd, expectend, timeout, partialend, prio, keystr.encode())
+
+
+  async def atcsv(self, cmd, expectend, keystr, timeout=5, partialend=False):
+    res = await self.atcsv_multi(cmd, expectend, keystr, timeout, partialend)
+    if res:
+      return res[0]
+    else:
+      raise ValueError('Can not parse modem output: %s' % str(res))
+
+
+  async def atrec(self, cmd, expectend, keystr, cls, timeout=5, partialend=False):
+    """
+    like atcsv, but returns the first matching line parsed into Record subclass cls
+    """
+    lns = await self.at(cmd, expectend, timeout, partialend)
+
+    key = keystr.encode()
+    for rl in lns:
+      i = csvstart(rl, key)
+      if i >= 0:
+        return cls.parse(rl, i)
+    raise ValueError('Can not parse modem output: %s' % str(lns))
+
+
+  # seconds a cached query result stays valid, see _cached()
+  CACHE_TTL = {'netinfo': 30, 'signal': 30, 'netreg': 30, 'appstatus': 60, 'connstatus': 60}
+  async def _cached(self, key, cached, query, *args):
+    """
+    cached=False runs the query, cached=True returns the last result if it is younger than cache_ttl[key]
+    """
+    if cached:
+      e = self.cache.get(key)
+      if e and utime.ticks_diff(utime.ticks_ms(), e[0]) < self.cache_ttl.get(key, 0) * 1000:
+        self.cache_hits += 1
+        return e[1]
+      self.cache_misses += 1
+    r = await query(*args)
+    self.cache[key] = (utime.ticks_ms(), r)
+    return r
+
+
+  def cache_invalidate(self, *keys):
+    """
+    drop the given cached queries, all of them when called without arguments
+    """
+    if not keys:
+      self.cache.clear()
+    for k in keys:
+      self.cache.pop(k, None)
+
 
+  def cache_stats(self):
+    return {'hits': self.cache_hits, 'misses': self.cache_misses, 'entries': len(self.cache)}
 
-  async def _at(self, cmd, expectend, partialend=False):
-    """
-    returns array of byte arrays (lines)
-    """
 
-    d("gsm< %s" % cmd)
-    if type(cmd) is bytes:
-      await self.wtr.awrite(cmd)
-    else:
-      await self.wtr.awrite(cmd.encode() + b"\r\n")
-    r = []
-    while True:
-      rl = await self.interactqueue.get()
-      try:
-        l = rl.decode()
-      except UnicodeError:
-        l = str(rl)
-      r.append(rl)
+  def _cmgl(self):
+    return 'AT+CMGL=4' if self.SMS_PDU else 'AT+CMGL="ALL"'
 
-      if isinstance(expectend, list) or isinstance(expectend, set):
-        if l.strip() in expectend:
-          d("gsm> %s" % str(r))
-          return r
-      else:
-        if l.strip() == expectend or (partialend and expectend in l.strip()):
-          d("gsm> %s" % str(r))
-          return r
 
+  async def get_sms(self, prio=PRIO_NORMAL):
+    return await self.atcsv_multi(self._cmgl(), 'OK', '+CMGL:', self.CMD_TIMEOUT, prio=prio)
 
-  async def at(self, cmd, expectend, timeout=5, partialend=False):
-    return await uasyncio.wait_for(self._at(cmd, expectend, partialend), timeout)
 
+  def get_sms_iter(self, prio=PRIO_NORMAL):
+    """
+    streaming get_sms(): async iterator of (fields, text) per message, fields as
+    in get_sms(), so a full inbox never has to be held in RAM at once
+    (in PDU mode the text is the PDU, see pdu.decode()). No AT commands
+    inside the loop, see ATStream, e.g. delete after it:
+
+      async with sim.get_sms_iter() as msgs:
+        async for fields, text in msgs:
+          ...
+    """
+    return SMSStream(self.at_iter(self._cmgl(), 'OK', self.CMD_TIMEOUT, prio=prio))
 
-  DELIM = ','
-  QUOTES = ["'", '"']
-  @classmethod
-  def _splitcsv(cls, l):
-    acc = ''
-    quote = None
-    for c in l:
-      if quote:
-        acc += c
-        if c == quote:
-          quote = None
-      else:
-        if c == cls.DELIM:
-          yield acc
-          acc = ''
-        elif c in cls.QUOTES:
-          acc += c
-          quote = c
+
+  async def read_sms(self, index, prio=PRIO_NORMAL):
+    """
+    AT+CMGR=<index>, returns SMS or None when the index is empty
+    text mode: +CMGR: <stat>,<oa>,[<alpha>],<scts> followed by the text
+    PDU mode: +CMGR: <stat>,[<alpha>],<length> followed by the PDU
+    """
+    stat = sender = time = None
+    body = None
+    async with self.at_iter('AT+CMGR=%d' % index, 'OK', self.CMD_TIMEOUT, prio=prio) as it:
+      async for l in it:
+        if body is None:
+          i = csvstart(l, b'+CMGR:')
+          if i < 0:
+            continue
+          n = splitcsv(l, i)
+          if self.SMS_PDU:
+            stat = csvint(l, _spans[0], _spans[1])
+            stat = SMS.STATS[stat] if stat is not None and stat < 4 else stat
+          elif n > 3:
+            stat = csvstr(l, _spans[0], _spans[1])
+            sender = csvstr(l, _spans[2], _spans[3])
+            time = l[_spans[6]:l.rfind(b'"')].strip(b'"').decode() if n > 4 else csvstr(l, _spans[6], _spans[7])
+          body = []
         else:
-          acc += c
-    if acc:
-      yield acc
+          body.append(l)
+    if body is None:
+      return None
+    if self.SMS_PDU:
+      import pdu
+      sender, time, text, ref, part, parts = pdu.decode(body[0])
+      return SMS(index, stat, sender, time, text, ref, part, parts, [index])
+    return SMS(index, stat, sender, time, b''.join(body).rstrip(b'\r\n').decode(), None, 1, 1, [index])
 
 
-  async def atcsv_multi(self, cmd, expectend, keystr, timeout=5, partialend=False):
+  async def del_sms(self, smsid, prio=PRIO_NORMAL):
+    return await self.at('AT+CMGD=%d' % smsid, 'OK', self.CMD_TIMEOUT, prio=prio)
+
+
+  SMS_TIMEOUT = 60
+  async def send_sms(self, tel, msg, prio=PRIO_NORMAL):
     """
-    cmd: 'string or byte array'
-    expectend: 'OK or something to distingusih the last line'
-    keystr: 'string to match in the output line, i.e. +CSI on line like +CSI: 1,2,3'
+    AT+CMGS=<da>[,<toda>]<CR>textisentered<ctrl-Z/ESC>
     """
+    if not self.SMS_PDU:
+      return await self.at_data('AT+CMGS="%s"' % tel, msg.encode() + b'\x1a', self.SMS_TIMEOUT, prio)
+    # AT+CMGS=<length><CR>PDU<ctrl-Z>, one command per part of a long text
+    import pdu
+    self.smsref = (self.smsref + 1) & 0xff
+    r = []
+    for n, p in pdu.encode(tel, msg, self.smsref):
+      r += await self.at_data('AT+CMGS=%d' % n, p + b'\x1a', self.SMS_TIMEOUT, prio)
+    return r
 
-    lns = await self.at(cmd, expectend, timeout, partialend)
-
-    res = []
-    for rl in lns:
-      if rl:
-        l = rl.decode().strip()
-        if l.startswith(keystr):
-          g = list(self._splitcsv(l))
-          g[0] = g[0].split(':', 1)[1].lstrip()
-          res.append(g)
 
-    return res
+  async def send_sms_batch(self, msgs, prio=PRIO_NORMAL):
+    """
+    send [tel, msg, ...] items with AT+CMMS=1 keeping the link to the SMSC
+    open in between, returns the items that failed
+    """
+    failed = []
+    await self.at('AT+CMMS=1', ['OK', 'ERROR'], self.CMD_TIMEOUT, prio=prio)
+    try:
+      for m in msgs:
+        try:
+          await self.send_sms(m[0], m[1], prio)
+        except (ATError, uasyncio.TimeoutError) as e:
+          d("gsm: SMS to %s failed: %s" % (m[0], str(e)))
+          failed.append(m)
+    finally:
+      await self.at('AT+CMMS=0', ['OK', 'ERROR'], self.CMD_TIMEOUT, prio=prio)
+    return failed
 
 
-  async def atcsv(self, cmd, expectend, keystr, timeout=5, partialend=False):
-    res = await self.atcsv_multi(cmd, expectend, keystr, timeout, partialend)
-    if res:
-      return res[0]
-    else:
-      raise ValueError('Can not parse modem output: %s' % str(res))
+  def start_sms(self, handler=None):
+    """
+    start the URC driven SMSInbox (see there for handler) and the SMSOutbox
+    """
+    if self.inbox is None:
+      self.inbox = SMSInbox(self, handler)
+      self.outbox = SMSOutbox(self)
+    self.inbox.start()
+    self.outbox.start()
+    return self.inbox
 
 
-  async def get_sms(self):
-    return await self.atcsv_multi('AT+CMGL="ALL"', 'OK', '+CMGL:', self.CMD_TIMEOUT)
+  def stop_sms(self):
+    if self.inbox:
+      self.inbox.stop()
+      self.outbox.stop()
 
 
-  async def del_sms(self, smsid):
-    return await self.at('AT+CMGD=%d' % smsid, 'OK', self.CMD_TIMEOUT)
+  def sms_stats(self):
+    if self.inbox is None:
+      return None
+    return {'inbox': self.inbox.stats(), 'outbox': self.outbox.stats(), 'new': self.smsnew.stats()}
 
 
-  async def send_sms(self, tel, msg):
+  async def get_bearer(self):
     """
-    AT+CMGS=<da>[,<toda>]<CR>textisentered<ctrl-Z/ESC>
+    +SAPBR: <cid>,<status>,<ip>
+    <status> 0 connecting, 1 connected, 2 closing, 3 closed
     """
-    bmsg = msg.encode()
-    await self.wtr.awrite(('AT+CMGS="%s"\r\n' % tel).encode())
-    await uasyncio.sleep(1)
-    await self.wtr.awrite(bmsg+b'\x21')
-    while True:
-      ret = (await uasyncio.wait_for(self.interactqueue.get(), self.CMD_TIMEOUT)).decode().strip()
-      if ret == 'OK':
-        return
+    return await self.atcsv('AT+SAPBR=2,1', 'OK', '+SAPBR', self.CMD_TIMEOUT)
 
 
   async def connect_apn(self, apn, user=None, password=None):
     self.apn = apn
+    if self.warm:
+      st = await self.get_bearer()
+      if st[1] == '1':
+        d("gsm: reusing bearer %s" % st[2])
+        return st
     await self.at("AT+CNMP=2", "OK", self.CMD_TIMEOUT) # autoselect GSM/LTE
     await self.at("AT+CMNB=3", "OK", self.CMD_TIMEOUT) # CAT-M or NB-IoT mode
     await self.at('AT+SAPBR=3,1,"APN","%s"' % self.apn, "OK", self.CMD_TIMEOUT)
@@ -360,10 +2156,10 @@ class SIM:
     """
     await self.at('AT+CNTPCID=1', 'OK', self.CMD_TIMEOUT)
     await self.at('AT+CNTP="%s",%d,1' % (ntpserver, tzoffset*4), 'OK', self.CMD_TIMEOUT)
-    return await self.atcsv('AT+CNTP', '+CNTP:', '+CNTP', self.CMD_TIMEOUT, True)
+    return await self.atrec('AT+CNTP', '+CNTP:', '+CNTP', NTPResult, self.CMD_TIMEOUT, True)
 
 
-  async def get_netinfo(self):
+  async def get_netinfo(self, cached=False):
     """
 +CPSI: <System Mode>,<Operation Mode>,<MCC>-<MNC>,<TAC>,<SCellID>,<PCellID>,<Frequency Band>,<earfcn>,<dlbw>,<ulbw>,<RSRQ>,<RSRP>,<RSSI>,<RSSNR>
 
@@ -397,10 +2193,10 @@ ng cell The value of SINR can be calculated according to <RSSNR>,the formula is
 SINR = 2 * <RSSNR> - 20
 The range of SINR is from -20 to 30
     """
-    return await self.atcsv('AT+CPSI?', 'OK', '+CPSI', self.CMD_TIMEOUT)
+    return await self._cached('netinfo', cached, self.atrec, 'AT+CPSI?', 'OK', '+CPSI', NetInfo, self.CMD_TIMEOUT)
 
 
-  async def get_signalinfo(self):
+  async def get_signalinfo(self, cached=False):
     """
 +CSQ: <rssi>,<ber>
 
@@ -414,10 +2210,10 @@ The range of SINR is from -20 to 30
 0...7 As RXQUAL values in the table in GSM 05.08 [20] subclause 7.2.4
 99 Not known or not detectable
     """
-    return await self.atcsv('AT+CSQ', 'OK', '+CSQ', 5)
+    return await self._cached('signal', cached, self.atrec, 'AT+CSQ', 'OK', '+CSQ', SignalInfo, 5)
 
 
-  async def get_netreg(self):
+  async def get_netreg(self, cached=False):
     """
     CREG: <n>,<stat>[,<lac>,<ci>,<netact>]
     n: 
@@ -437,24 +2233,35 @@ support GPRS.)
     4 Unknown
     5 Registered, roaming
     """
-    return await self.atcsv('AT+CREG?', 'OK', '+CREG', 5)
+    r = await self._cached('netreg', cached, self.atrec, 'AT+CREG?', 'OK', '+CREG', NetReg, 5)
+    self.reg.update('creg', r.stat, r.lac, r.ci, r.act)
+    return r
 
 
   NETREG_TIMEOUT = 120
-  async def wait_for_netreg(self):
+  NETREG_POLL = 30 # fallback AT+CREG? in case a URC got lost
+  async def wait_for_netreg(self, timeout=None):
     """
-      wait until registered to network or timeout (120 sec) is reached
+      wait until registered to network (home or roaming) or timeout (120 sec) is reached
+      registration changes come as +CREG/+CEREG URCs that set self.reg.event
       when registered return
       when timeout raise Exception()
     """
-    i = 0
-    while i < self.NETREG_TIMEOUT:
-      rs = await self.get_netreg()
-      if int(rs[1]) == 1:
+    if timeout is None:
+      timeout = self.NETREG_TIMEOUT
+    deadline = utime.ticks_add(utime.ticks_ms(), timeout * 1000)
+    while True:
+      await self.get_netreg()
+      if self.reg.registered:
         return
-      await uasyncio.sleep(1)
-    else:
-      raise Exception("Can not register to the network in timeout %d" % self.NETREG_TIMEOUT)
+      left = utime.ticks_diff(deadline, utime.ticks_ms())
+      if left <= 0:
+        raise Exception("Can not register to the network in timeout %d" % timeout)
+      try:
+        await uasyncio.wait_for_ms(self.reg.event.wait(), min(left, self.NETREG_POLL * 1000))
+        return
+      except uasyncio.TimeoutError:
+        pass
 
 
   async def get_time(self):
@@ -481,11 +2288,54 @@ support GPRS.)
 Ground>,<Course Over Ground>,<Fix Mode>,<Reserved1>,<HDOP>,<PDOP>,<VDOP>,<Reserved2>,<GNSS Satellites in View>,<GNSS Satellites Used>,<GLONASS Satellites Used>,<Reserved3>,<C/N0 max>,<HPA>,<VPA>
 
     """
-    return await self.atcsv('AT+CGNSINF', 'OK', '+CGNSINF', self.CMD_TIMEOUT)
+    return await self.atrec('AT+CGNSINF', 'OK', '+CGNSINF', GNSSInfo, self.CMD_TIMEOUT)
+
+
+  TRACK_SIZE = 256 # fixes
+  async def gnss_track(self, interval=1, size=None):
+    """
+    AT+CGNSURC=<n>: the modem reports every n-th fix as +UGNSINF (fields as
+    +CGNSINF), valid fixes go to self.track, a gnss.Track, interval 0 stops it
+    """
+    import gnss
+    if self.track is None:
+      self.track = gnss.Track(size or self.TRACK_SIZE)
+      self.urc.register(b'+UGNSINF:', self._urc_ugnsinf)
+    await self.at('AT+CGNSURC=%d' % interval, 'OK', self.CMD_TIMEOUT)
+    return self.track
+
+
+  def _urc_ugnsinf(self, l):
+    n = splitcsv(l, csvstart(l, b'+UGNSINF:'))
+    s = _spans
+    if n < 7 or csvint(l, s[2], s[3]) != 1: # no fix
+      return
+    a = s[4]
+    if s[5] - a < 14:
+      return
+    import gnss
+    t = gnss.seconds(csvint(l, a, a+4), csvint(l, a+4, a+6), csvint(l, a+6, a+8),
+                     csvint(l, a+8, a+10), csvint(l, a+10, a+12), csvint(l, a+12, a+14))
+    lat = csvfixed(l, s[6], s[7], 6)
+    lon = csvfixed(l, s[8], s[9], 6)
+    if lat is None or lon is None:
+      return
+    alt = csvfixed(l, s[10], s[11], 0) or 0
+    speed = csvfixed(l, s[12], s[13], 1) or 0
+    self.track.add(t, lat, lon, alt, speed)
 
 
   async def mqtt_connect(self, host, user, passwd, clientid, port=1883):
-    await self.at('AT+CNACT=1,"%s"' % self.apn, 'OK', self.CMD_TIMEOUT)
+    if self.warm:
+      if (await self.mqtt_getconnstatus())[0] == '1':
+        d("gsm: reusing MQTT session")
+        return
+      if (await self.mqtt_getappstatus())[0] == '1':
+        d("gsm: reusing app network")
+      else:
+        await self.at('AT+CNACT=1,"%s"' % self.apn, 'OK', self.CMD_TIMEOUT)
+    else:
+      await self.at('AT+CNACT=1,"%s"' % self.apn, 'OK', self.CMD_TIMEOUT)
     await self.at('AT+SMCONF="CLIENTID",%s' % clientid, 'OK', self.CMD_TIMEOUT)
     await self.at('AT+SMCONF="URL","%s","%d"' % (host, port), 'OK', self.CMD_TIMEOUT)
     await self.at('AT+SMCONF="USERNAME","%s"' % user, 'OK', self.CMD_TIMEOUT)
@@ -493,8 +2343,43 @@ Ground>,<Course Over Ground>,<Fix Mode>,<Reserved1>,<HDOP>,<PDOP>,<VDOP>,<Reserv
     await self.at('AT+SMCONF="KEEPTIME",60', 'OK', self.CMD_TIMEOUT)
     await self.at('AT+SMCONF="RETAIN",1', 'OK', self.CMD_TIMEOUT)
     await self.at('AT+SMCONN', 'OK', self.CMD_TIMEOUT)
+    self.cache_invalidate('appstatus', 'connstatus')
 
 
+  async def mqtt_reconnect(self):
+    """
+    reconnect the MQTT session with the configuration from mqtt_connect()
+    """
+    await self.at('AT+SMDISC', ['OK', 'ERROR'], self.CMD_TIMEOUT)
+    await self.at('AT+SMCONN', 'OK', self.CMD_TIMEOUT)
+    self.cache_invalidate('connstatus')
+
+
+  async def bearer_reconnect(self):
+    """
+    re-activate the SAPBR bearer and the CNACT app network, then reconnect MQTT
+    """
+    await self.at('AT+SMDISC', ['OK', 'ERROR'], self.CMD_TIMEOUT)
+    await self.at('AT+CNACT=0', ['OK', 'ERROR'], self.CMD_TIMEOUT)
+    await self.at('AT+SAPBR=0,1', ['OK', 'ERROR'], self.CMD_TIMEOUT)
+    self.cache_invalidate('appstatus', 'connstatus')
+    await self.at('AT+SAPBR=1,1', 'OK', self.CMD_TIMEOUT)
+    await self.at('AT+CNACT=1,"%s"' % self.apn, 'OK', self.CMD_TIMEOUT)
+    await self.at('AT+SMCONN', 'OK', self.CMD_TIMEOUT)
+
+
+  CFUN_TIMEOUT = 10
+  async def reregister(self):
+    """
+    switch the radio off and on and wait for the network registration
+    """
+    await self.at('AT+CFUN=0', 'OK', self.CFUN_TIMEOUT)
+    await self.at('AT+CFUN=1', 'OK', self.CFUN_TIMEOUT)
+    self.cache_invalidate()
+    await self.wait_for_netreg()
+
+
+  MQTT_MAX_PAYLOAD = 512
   async def mqtt_pub(self, topic, msg, qos=1, retain=1):
     """
     +SMPUB: <topic>,<content length>,<qos>,<retain>
@@ -505,18 +2390,17 @@ Ground>,<Course Over Ground>,<Fix Mode>,<Reserved1>,<HDOP>,<PDOP>,<VDOP>,<Reserv
       2 = exactly once
     <content length>Message length,  range: 0~512
     <retain>Server hold message range: 0~1
+
+    msg is str or bytes, longer payloads have to be split, see codec.chunks()
     """
-    bmsg = msg.encode()
-    await self.wtr.awrite(('AT+SMPUB="%s",%d,%d,%d\r\n' % (topic, len(bmsg), qos, retain)).encode())
-    await uasyncio.sleep(1)
-    await self.wtr.awrite(bmsg+b'\r\n')
-    while True:
-      ret = (await uasyncio.wait_for(self.interactqueue.get(), self.CMD_TIMEOUT)).decode().strip()
-      if ret == 'OK':
-        return
+    bmsg = msg.encode() if type(msg) is str else msg
+    if len(bmsg) > self.MQTT_MAX_PAYLOAD:
+      raise ValueError('MQTT payload of %d B exceeds %d B' % (len(bmsg), self.MQTT_MAX_PAYLOAD))
+    return await self.at_data('AT+SMPUB="%s",%d,%d,%d' % (topic, len(bmsg), qos, retain), bmsg,
+                              self.CMD_TIMEOUT, self.PRIO_PUBLISH)
 
 
-  async def mqtt_getconnstatus(self):
+  async def mqtt_getconnstatus(self, cached=False):
     """
     Response
     +SMSTATE: <status>
@@ -527,55 +2411,498 @@ Ground>,<Course Over Ground>,<Fix Mode>,<Reserved1>,<HDOP>,<PDOP>,<VDOP>,<Reserv
     0      Expression MQTT disconnect state
     1      Expression MQTT on-line state
     """
-    return await self.atcsv('AT+SMSTATE?', 'OK', '+SMSTATE', self.CMD_TIMEOUT)
+    return await self._cached('connstatus', cached, self.atcsv, 'AT+SMSTATE?', 'OK', '+SMSTATE', self.CMD_TIMEOUT)
 
 
-  async def mqtt_getappstatus(self):
+  async def mqtt_getappstatus(self, cached=False):
     """
     +CNACT: <status>,<ip_addr>
     <status> 0 Deactived
              1 Actived
              2 Inoperation
     """
-    return await self.atcsv('AT+CNACT?', 'OK', '+CNACT', self.CMD_TIMEOUT)
+    return await self._cached('appstatus', cached, self.atcsv, 'AT+CNACT?', 'OK', '+CNACT', self.CMD_TIMEOUT)
 
 
   async def mqtt_disconnect(self):
-    await self.at('AT+SMDISC', 'OK', self.CMD_TIMEOUT)
-    await self.at('AT+CNACT=0', 'OK', self.CMD_TIMEOUT)
+    try:
+      await self.at('AT+SMDISC', 'OK', self.CMD_TIMEOUT)
+      await self.at('AT+CNACT=0', 'OK', self.CMD_TIMEOUT)
+    finally:
+      self.cache_invalidate('appstatus', 'connstatus')
 
 
-  async def mqtt_sub(self, topic, qos=1):
-    await self.at('AT+SMUNSUB="%s"' % topic, ['OK', 'ERROR'], self.CMD_TIMEOUT)
+  async def mqtt_sub(self, topic, qos=1, handler=None):
+    """
+    subscribe topic (a filter with + and # wildcards) and route its messages
+    to handler, a callable handler(topic, payload) or a Queue; without handler
+    the subscription gets a Queue of MQTTQUEUE_SIZE, an existing one is reused
+    after a reconnect, returns the handler
+    """
+    try:
+      await self.at('AT+SMUNSUB="%s"' % topic, 'OK', self.CMD_TIMEOUT)
+    except ATError:
+      pass # was not subscribed
     await self.at('AT+SMSUB="%s",%d' % (topic, qos), 'OK', self.CMD_TIMEOUT)
+    if handler is None:
+      handler = self.router.queue(topic)
+      if handler is not None:
+        return handler
+      handler = Queue(self.MQTTQUEUE_SIZE, Queue.DROP_OLDEST)
+    self.router.add(topic, handler)
+    return handler
 
 
   async def mqtt_unsub(self, topic):
+    self.router.remove(topic)
     await self.at('AT+SMUNSUB="%s"' % topic, 'OK', self.CMD_TIMEOUT)
 
 
   async def mqtt_getmsg(self, topic):
-    # ignoring topic, sorry
-    #return list(self._splitcsv((await self.mqttqueue.get()))
-    return str(await self.mqttqueue.get())
+    """
+    next payload (bytes) from the queue of subscription topic
+    """
+    q = self.router.queue(topic)
+    if q is None:
+      raise ValueError('Not subscribed to %s' % topic)
+    return (await q.get())[1]
+
+
+  # Power saving between uplink cycles
+  #
+  # PSM (AT+CPSMS) lets the modem drop the radio after PSM_ACTIVE (T3324) in
+  # idle while staying registered until PSM_TAU (T3412), eDRX (AT+CEDRXS)
+  # stretches the paging cycle to EDRX_VALUE. With a DTR pin AT+CSCLK=1 lets
+  # the modem sleep while DTR is high. Timer values are the bit strings of
+  # 3GPP TS 24.008 (GPRS timer 2/3) and TS 24.008 10.5.5.32 (eDRX).
+  PSM_TAU = '00100001' # 1 h
+  PSM_ACTIVE = '00000101' # 10 s
+  EDRX_ACT = 4 # 4 = LTE Cat-M1, 5 = NB-IoT
+  EDRX_VALUE = '0101' # 81.92 s
+  EDRX_PTW = 1.28 # seconds of paging time window per eDRX cycle, for the estimate
+  WAKE_TIMEOUT = 10 # seconds
+  WAKE_GRACE = 3 # seconds of probing before PWRKEY when there is no status_pin
+
+  T3412_UNITS = (600, 3600, 36000, 2, 30, 60, 1152000, None)
+  T3324_UNITS = (2, 60, 360, None, None, None, None, None)
+  EDRX_CYCLES = (5.12, 10.24, 20.48, 40.96, 61.44, 81.92, 102.4, 122.88, 143.36,
+                 163.84, 327.68, 655.36, 1310.72, 2621.44, 5242.88, 10485.76)
+
+  @staticmethod
+  def timer_s(bits, units):
+    """
+    seconds of a 3GPP GPRS timer bit string, None when deactivated
+    """
+    v = int(bits, 2)
+    u = units[v >> 5]
+    return None if u is None else u * (v & 0x1f)
+
+
+  async def power_save(self, mode):
+    """
+    mode is None (always on), 'psm' or 'edrx'
+    """
+    if mode == 'psm':
+      await self.at('AT+CEDRXS=0', ['OK', 'ERROR'], self.CMD_TIMEOUT)
+      await self.at('AT+CPSMS=1,,,"%s","%s"' % (self.PSM_TAU, self.PSM_ACTIVE), 'OK', self.CMD_TIMEOUT)
+    elif mode == 'edrx':
+      await self.at('AT+CPSMS=0', ['OK', 'ERROR'], self.CMD_TIMEOUT)
+      await self.at('AT+CEDRXS=1,%d,"%s"' % (self.EDRX_ACT, self.EDRX_VALUE), 'OK', self.CMD_TIMEOUT)
+    elif mode is None:
+      await self.at('AT+CPSMS=0', ['OK', 'ERROR'], self.CMD_TIMEOUT)
+      await self.at('AT+CEDRXS=0', ['OK', 'ERROR'], self.CMD_TIMEOUT)
+    else:
+      raise ValueError('Unknown power save mode %s' % str(mode))
+    if self.dtr_pin:
+      await self.at('AT+CSCLK=%d' % (0 if mode is None else 1), 'OK', self.CMD_TIMEOUT)
+    self.psmode = mode
+
+
+  async def sleep(self):
+    """
+    let the modem sleep until wake(), a command issued meanwhile calls wake() first
+    """
+    await self.wtr.drain()
+    now = utime.ticks_ms()
+    self.lastawake = utime.ticks_diff(now, self.awake_since)
+    self.slept_at = now
+    self.asleep = True
+    if self.dtr_pin:
+      self.dtr_pin.on()
+    d("gsm: sleeping, awake for %d ms" % self.lastawake)
+
+
+  async def _probe_for(self, s):
+    """
+    probe until the modem answers or s seconds pass, returns True when it answered
+    """
+    deadline = utime.ticks_add(utime.ticks_ms(), int(s * 1000))
+    while not await self._probe(1):
+      if utime.ticks_diff(deadline, utime.ticks_ms()) <= 0:
+        return False
+    return True
+
+
+  async def _needs_pwrkey(self):
+    """
+    True when a modem that did not answer the wake probe is in PSM, PWRKEY
+    would power off one that is up but slow: the STATUS pin (low in PSM)
+    decides, without it the probe gets WAKE_GRACE more seconds
+    """
+    if self.psmode != 'psm':
+      return False
+    if self.status_pin is not None:
+      return not self.status_pin.value()
+    return not await self._probe_for(self.WAKE_GRACE)
+
+
+  async def wake(self):
+    """
+    pull DTR low and probe, a modem in PSM has the UART off and needs PWRKEY
+    """
+    if self.dtr_pin:
+      self.dtr_pin.off()
+      await uasyncio.sleep_ms(100)
+    if not await self._probe():
+      if await self._needs_pwrkey():
+        self.power['pwrkey_wakes'] += 1
+        await self.signal_pwr()
+      if not await self._probe_for(self.WAKE_TIMEOUT):
+        raise Exception("Modem does not wake up")
+    self.interactqueue.clear()
+    self.asleep = False
+    now = utime.ticks_ms()
+    if self.slept_at is not None:
+      slept = utime.ticks_diff(now, self.slept_at)
+      self.slept_at = None
+      on = self.lastawake + self._radio_on_asleep(slept)
+      self.power['cycles'] += 1
+      self.power['sleep_ms'] += slept
+      self.power['radio_on_ms'] += on
+      self.power['last_radio_on_ms'] = on
+    self.awake_since = now
+    self.cache_invalidate()
+
+
+  def _radio_on_asleep(self, ms):
+    """
+    estimated ms of radio activity during ms of sleep
+    """
+    if self.psmode == 'psm':
+      act = self.timer_s(self.PSM_ACTIVE, self.T3324_UNITS)
+      return ms if act is None else min(ms, act * 1000)
+    if self.psmode == 'edrx':
+      return int(ms * min(1, self.EDRX_PTW / self.EDRX_CYCLES[int(self.EDRX_VALUE, 2)]))
+    return ms
+
+
+  async def session_check(self):
+    """
+    after wake(): check the MQTT session and re-establish only the lost layers,
+    returns None when the session survived, else 'mqtt', 'bearer' or 'netreg'
+    """
+    if (await self.mqtt_getconnstatus())[0] == '1':
+      return None
+    if (await self.get_netreg()).registered:
+      if (await self.mqtt_getappstatus())[0] == '1':
+        await self.mqtt_reconnect()
+        return 'mqtt'
+      await self.bearer_reconnect()
+      return 'bearer'
+    await self.reregister()
+    await self.bearer_reconnect()
+    return 'netreg'
+
+
+  def power_stats(self):
+    """
+    radio_on_ms is estimated as the awake time plus the radio activity
+    expected from the power save mode while asleep
+    """
+    res = dict(self.power)
+    res['mode'] = self.psmode
+    res['asleep'] = self.asleep
+    return res
+
+
+
+
+class Backoff:
+  """
+  Bounded exponential backoff with jitter: the n-th delay is drawn
+  from [d/2, d] where d = min(cap, base * 2**n)
+  """
+  def __init__(self, base, cap):
+    self.base = base
+    self.cap = cap
+    self.n = 0
+
+
+  def next(self):
+    dl = min(self.cap, self.base * (1 << min(self.n, 16)))
+    self.n += 1
+    return dl / 2 + dl / 2 * urandom.getrandbits(16) / 65535
 
 
+  def reset(self):
+    self.n = 0
+
+
+class Scheduler:
+  """
+  Per-key publish deadlines served by a single timer. wait() sleeps until
+  the earliest deadline and returns all keys due within coalesce seconds
+  of it, so close deadlines share one radio wake-up.
+  """
+  def __init__(self, interval, intervals=None, min_intervals=None, max_intervals=None, coalesce=0, jitter=0):
+    self.interval = interval
+    self.intervals = intervals or {}
+    self.min_intervals = min_intervals or {}
+    self.max_intervals = max_intervals or {}
+    self.coalesce = coalesce
+    self.jitter = jitter
+    self.due = {} # key -> ticks_ms deadline
+    self.last = {} # key -> ticks_ms of the last publish
+    self.urgents = 0
+    self.event = uasyncio.Event()
+
+
+  def add(self, key):
+    """
+    schedule a new key, its first deadline is drawn from [now, now + jitter]
+    """
+    if key not in self.due:
+      self.due[key] = utime.ticks_add(utime.ticks_ms(),
+                                      int(self.jitter * 1000 * urandom.getrandbits(16) / 65535))
+      self.event.set()
+
+
+  def sync(self, keys):
+    """
+    schedule exactly keys: add the new ones, drop the ones no longer there
+    """
+    for k in [k for k in self.due if k not in keys]:
+      self.remove(k)
+      self.last.pop(k, None)
+    for k in keys:
+      self.add(k)
+
+
+  def urgent(self, key):
+    """
+    make key due now, or as soon as its minimal interval allows
+    """
+    now = utime.ticks_ms()
+    t = now
+    last = self.last.get(key)
+    mi = self.min_intervals.get(key, 0) * 1000
+    if last is not None and utime.ticks_diff(now, last) < mi:
+      t = utime.ticks_add(last, int(mi))
+    cur = self.due.get(key)
+    if cur is None or utime.ticks_diff(t, cur) < 0:
+      self.due[key] = t
+    self.urgents += 1
+    self.event.set()
+
+
+  def next_in(self):
+    """
+    ms until the earliest deadline, None when nothing is scheduled
+    """
+    if not self.due:
+      return None
+    now = utime.ticks_ms()
+    return max(0, min(utime.ticks_diff(t, now) for t in self.due.values()))
+
+
+  async def doze(self, ms):
+    """
+    sleep ms or until a key is made urgent or added
+    """
+    self.event.clear()
+    try:
+      await uasyncio.wait_for_ms(self.event.wait(), ms)
+    except uasyncio.TimeoutError:
+      pass
+
+
+  async def wait(self):
+    """
+    sleep until a deadline passes, returns the list of due keys
+    """
+    while True:
+      dl = self.next_in()
+      if dl is None or dl > 0:
+        self.event.clear()
+        try:
+          if dl is None:
+            await self.event.wait()
+          else:
+            await uasyncio.wait_for_ms(self.event.wait(), dl)
+        except uasyncio.TimeoutError:
+          pass
+        continue
+      horizon = utime.ticks_add(utime.ticks_ms(), int(self.coalesce * 1000))
+      return [k for k in self.due if utime.ticks_diff(self.due[k], horizon) <= 0]
+
+
+  def done(self, keys):
+    """
+    move the deadlines of keys handled in this cycle one interval ahead
+    """
+    now = utime.ticks_ms()
+    for k in keys:
+      iv = max(self.intervals.get(k, self.interval), self.min_intervals.get(k, 0))
+      self.due[k] = utime.ticks_add(now, int(iv * 1000))
+
+
+  def remove(self, key):
+    """
+    unschedule key, add() schedules it again
+    """
+    self.due.pop(key, None)
+
+
+  def sent(self, key):
+    self.last[key] = utime.ticks_ms()
+
+
+  def stale(self, key):
+    """
+    True when key has not been published for its maximal interval
+    """
+    mx = self.max_intervals.get(key)
+    if not mx:
+      return False
+    last = self.last.get(key)
+    return last is None or utime.ticks_diff(utime.ticks_ms(), last) >= mx * 1000
+
+
+  def todict(self):
+    now = utime.ticks_ms()
+    return {'next': dict((k, utime.ticks_diff(self.due[k], now) // 1000) for k in self.due),
+            'urgent': self.urgents}
+
+
+  def upcoming(self, n):
+    """
+    seconds until the deadline of the n keys due first, as a dict
+    """
+    now = utime.ticks_ms()
+    ks = sorted(self.due, key=lambda k: utime.ticks_diff(self.due[k], now))[:n]
+    return dict((k, utime.ticks_diff(self.due[k], now) // 1000) for k in ks)
 
 
 class MQTTUplink:
   ENABLE_GNSS = False
   PUB_INTERVAL = 600 # seconds
-  RESTART_INTERVAL = 120 # seconds
+  RESTART_INTERVAL = 120 # seconds, upper bound of the backoff before a power-cycle restart
   MAX_REPEATS = 5
   NAME = 'beetle'
 
+  # recovery ladder for failures in the publish loop, every consecutive
+  # failure escalates one tier, a successful publish goes back to TIER_RETRY
+  TIER_RETRY = 0 # just retry the publish
+  TIER_MQTT = 1 # reconnect MQTT (AT+SMCONN)
+  TIER_BEARER = 2 # re-activate CNACT/SAPBR and reconnect MQTT
+  TIER_NETREG = 3 # radio off/on, wait for registration, then as above
+  TIER_POWER = 4 # deinit and cold init of the modem
+  TIER_NAMES = ('retry', 'mqtt', 'bearer', 'netreg', 'power')
+  BACKOFF_BASE = 2 # seconds
+  BACKOFF_MAX = 60 # seconds
+
+  # store-and-forward: snapshots of data taken while the uplink is down are
+  # kept in a flash journal and replayed to <NAME>/journal after reconnect,
+  # one batch per scheduler cycle of the 'journal' key
+  JOURNAL_DIR = None # e.g. '/journal', None disables the journal
+  SAMPLE_INTERVAL = 60 # seconds between snapshots while offline
+  JOURNAL_DRAIN_RATE = 2 # replayed messages per second
+  JOURNAL_BATCH = 8 # records replayed per cycle
+  JOURNAL_INTERVAL = 10 # seconds between replay batches, unless set in INTERVALS
+
+  # change-only publishing: a key of data is published only when its
+  # serialized value changed, or for numbers in DEADBANDS when it moved
+  # by at least the deadband since the last published value
+  FULL_REFRESH = 0 # publish all keys every N-th cycle, 0 = never
+  DEADBANDS = {} # key -> minimal absolute change of a numeric value
+
+  # payload encoding, CODECS overrides CODEC for single keys of data
+  # and for 'loc' and 'status', see codec.py
+  CODEC = codec.JSON
+  CODECS = {}
+
+  # batch mode: changed keys, loc and status go out together as {'ts': ..., key: value, ...}
+  # on <NAME>/batch, split by keys into several messages when over the modem limit,
+  # batch messages are encoded with CODEC (CODECS does not apply)
+  BATCH = False
+  BATCH_EXCLUDE = () # keys (incl. 'loc', 'status') kept on their own <NAME>/<key> topic
+
+  # publish scheduling per key of data and for 'loc' and 'status', keys
+  # without an entry in INTERVALS go out every PUB_INTERVAL, see Scheduler
+  INTERVALS = {} # key -> seconds between publishes
+  MIN_INTERVALS = {} # key -> minimal seconds between publishes, bounds urgent() too
+  MAX_INTERVALS = {} # key -> publish even an unchanged value after this many seconds
+  COALESCE = 30 # seconds, keys due this close to the earliest deadline go out with it
+  START_JITTER = 10 # seconds, the first deadline of a key is random in [0, START_JITTER]
+
+  # modem power saving between publishes, see SIM.power_save()
+  POWER_SAVE = None # None, 'psm' or 'edrx'
+  SLEEP_MIN = 30 # seconds, shorter gaps between deadlines are spent awake
+  WAKE_AHEAD = 5 # seconds, wake the modem this long before the next deadline
+
+  # publish SIM.metrics_stats() on <NAME>/metrics, scheduled as key 'metrics'
+  PUB_METRICS = False
+  # publish get_diag() on <NAME>/diag, scheduled as key 'diag', the 'diag'
+  # command on <NAME>/cmd publishes it once
+  PUB_DIAG = False
+
+  # GNSS track instead of 'loc' polling: with ENABLE_GNSS the modem reports
+  # every TRACK_FIX_INTERVAL-th fix as URC, the collected track simplified to
+  # TRACK_TOLERANCE goes out packed on <NAME>/track, scheduled as key
+  # 'track', see gnss.py
+  TRACK = False
+  TRACK_SIZE = 256 # fixes kept on the device
+  TRACK_FIX_INTERVAL = 10
+  TRACK_TOLERANCE = 10 # metres
+
   def __init__(self, config):
     self.config = config
     self.sim = None
+    self.timings = {}
+    self.t0 = None
+    self.t = None
     self.running = False
     self.outt = None
     self.cmdrt = None
     self.restarts = 0
+    self.cold = False # the modem was powered off by deinit()
+    self.recoveries = [0] * len(self.TIER_NAMES)
+    self.backoff = Backoff(self.BACKOFF_BASE, self.BACKOFF_MAX)
+    self.restart_backoff = Backoff(self.BACKOFF_BASE, self.RESTART_INTERVAL)
+    self.online = False
+    self.journal = None
+    self.samplert = None
+    self.replayed = 0
+    self.replay_rate = 0
+    self.lasthash = {} # key -> hash of the last published payload
+    self.lastnum = {} # key -> last published number for keys in DEADBANDS
+    self.cycles = 0
+    self.pubstats = {}
+    self.lastcycle = {}
+    self.msgid = 0
+    self.chunked = 0
+    intervals = dict(self.INTERVALS)
+    intervals.setdefault('journal', self.JOURNAL_INTERVAL)
+    self.sched = Scheduler(self.PUB_INTERVAL, intervals, self.MIN_INTERVALS,
+                           self.MAX_INTERVALS, self.COALESCE, self.START_JITTER)
+    self.resumes = {}
+
+
+  def _phase(self, name, t):
+    now = utime.ticks_ms()
+    self.timings[name] = utime.ticks_diff(now, t)
+    d("uplink: %s took %d ms" % (name, self.timings[name]))
+    return now
 
 
   async def _cmd(self):
@@ -586,9 +2913,12 @@ class MQTTUplink:
 
         print("RECEIVED COMMAND: %s" % scmd)
         if scmd == 'reset':
+          self.sim.transcript_flush()
           machine.reset()
+        elif scmd == 'diag':
+          await self._pub('%s/diag' % self.NAME, self._encode('diag', self.get_diag()))
         elif scmd == 'uplinkstop':
-          self.stop()
+          uasyncio.create_task(self.stop()) # stop() cancels this task
 
       except uasyncio.CancelledError:
         break 
@@ -597,76 +2927,365 @@ class MQTTUplink:
         usys.print_exception(e)
 
 
-  async def _run(self, data):
+  async def _bringup(self):
     c = self.config
-    self.running = True
-    while self.running:
-      try:
-        self.sim = SIM(c['MODEM_POWER_PIN'], c['MODEM_RESET_PIN'], c['MODEM_RX_PIN'], c['MODEM_TX_PIN'])
-
-        await self.sim.signal_reset()
-        d('sim.init:')
-        d(await self.sim.init())
-        d(await self.sim.wait_for_netreg())
-        d(await self.sim.connect_apn(c['MQTT_APN']))
-        uasyncio.sleep(10)
-        d('sim.get_netinfo:')
-        d(await self.sim.get_netinfo())
-        d('sim.get_signalinfo:')
-        d(await self.sim.get_signalinfo())
-        d('sim.get_inetreg:')
-        d(await self.sim.get_netreg())
-        d('sim.get_ntp:')
-        d(await self.sim.get_ntp(c['NTP_SERVER']))
-        if self.ENABLE_GNSS:
-          d(await self.sim.enable_gnss())
-
-        d('sim.mqtt_connect:')
-        await self.sim.mqtt_connect(c['MQTT_BROKER'], c['MQTT_USER'], c['MQTT_PASS'], c['MQTT_CLIENTID'])
-
-        connc = 0
-        while True:
-          await uasyncio.sleep(5)
-          d('sim.mqtt_getconnstatus:')
-          cstatus = int((await self.sim.mqtt_getconnstatus())[0])
-          if cstatus == 1:
-            break
-          else:
-            connc += 1
-            if connc > self.MAX_REPEATS:
-              raise Exception("Can not connect to MQTT.")
- 
-        d('subscribing to %s/cmd' % self.NAME)
-        await self.sim.mqtt_sub('%s/cmd' % self.NAME)
-        self.cmdrt = uasyncio.create_task(self._cmd())
+    self.sim = SIM(c['MODEM_POWER_PIN'], c['MODEM_RESET_PIN'], c['MODEM_RX_PIN'], c['MODEM_TX_PIN'],
+                   dtr_pin=c.get('MODEM_DTR_PIN'), rts_pin=c.get('MODEM_RTS_PIN'), cts_pin=c.get('MODEM_CTS_PIN'),
+                   status_pin=c.get('MODEM_STATUS_PIN'))
+    self.t0 = t = utime.ticks_ms()
+    self.timings = {}
+
+    d('sim.init:')
+    d(await self.sim.init(cold=self.cold))
+    self.cold = False
+    t = self._phase('init', t)
+    d(await self.sim.wait_for_netreg())
+    t = self._phase('netreg', t)
+    d(await self.sim.connect_apn(c['MQTT_APN']))
+    t = self._phase('apn', t)
+    d('sim.get_netinfo:')
+    d(await self.sim.get_netinfo())
+    d('sim.get_signalinfo:')
+    d(await self.sim.get_signalinfo())
+    d('sim.get_inetreg:')
+    d(await self.sim.get_netreg())
+    d('sim.get_ntp:')
+    d(await self.sim.get_ntp(c['NTP_SERVER']))
+    if self.ENABLE_GNSS:
+      d(await self.sim.enable_gnss())
+      if self.TRACK:
+        await self.sim.gnss_track(self.TRACK_FIX_INTERVAL, self.TRACK_SIZE)
+
+    d('sim.mqtt_connect:')
+    await self.sim.mqtt_connect(c['MQTT_BROKER'], c['MQTT_USER'], c['MQTT_PASS'], c['MQTT_CLIENTID'])
+    await self._wait_mqtt()
+    self.t = self._phase('mqtt', t)
+
+    d('subscribing to %s/cmd' % self.NAME)
+    await self.sim.mqtt_sub('%s/cmd' % self.NAME)
+    self.cmdrt = uasyncio.create_task(self._cmd())
+
+    if self.POWER_SAVE:
+      await self.sim.power_save(self.POWER_SAVE)
+
+    print("Uplink established")
+
+
+  async def _wait_mqtt(self):
+    connc = 0
+    while True:
+      d('sim.mqtt_getconnstatus:')
+      cstatus = int((await self.sim.mqtt_getconnstatus())[0])
+      if cstatus == 1:
+        break
+      else:
+        connc += 1
+        if connc > self.MAX_REPEATS:
+          raise Exception("Can not connect to MQTT.")
+      await uasyncio.sleep(5)
 
-        print("Uplink established")
 
-        inexs = 0
-        while self.running:
-          try:
-            ts = await self.sim.get_time()
+  async def _publish(self, data, due=None):
+    """
+    publish the keys in due (keys of data, 'loc', 'track', 'status', 'metrics', 'diag'), all keys when None,
+    the 'journal' key is replayed by _drain() in the publish loop
+    """
+    ts = await self.sim.get_time()
+
+    out = [] # (key, value, encoded) to publish in this cycle
+    if self.ENABLE_GNSS and not self.TRACK and (due is None or 'loc' in due):
+      loc = (await self.sim.get_gnss()).todict()
+      out.append(('loc', loc, self._encode('loc', loc)))
+
+    self.cycles += 1
+    full = self.FULL_REFRESH and self.cycles % self.FULL_REFRESH == 0
+    cyc = {'sent': 0, 'sent_bytes': 0, 'saved': 0, 'saved_bytes': 0, 'msgs': 0}
+    changed = []
+    for k in data:
+      if due is not None and k not in due:
+        continue
+      v = data[k]
+      msg = self._encode(k, v)
+      if full or self.sched.stale(k) or self._changed(k, v, msg):
+        changed.append((k, v, msg))
+        cyc['sent'] += 1
+        cyc['sent_bytes'] += len(self.NAME) + len(k) + 1 + len(msg)
+      else:
+        cyc['saved'] += 1
+        cyc['saved_bytes'] += len(self.NAME) + len(k) + 1 + len(msg)
+    out.extend(changed)
+
+    if due is None or 'status' in due:
+      status = [ts, await self.get_status()]
+      out.append(('status', status, self._encode('status', status)))
+    if self.PUB_METRICS and (due is None or 'metrics' in due):
+      m = self.sim.metrics_stats()
+      out.append(('metrics', m, self._encode('metrics', m)))
+    if self.PUB_DIAG and (due is None or 'diag' in due):
+      m = self.get_diag()
+      out.append(('diag', m, self._encode('diag', m)))
+
+    if self.BATCH:
+      batch = []
+      for k, v, msg in out:
+        if k in self.BATCH_EXCLUDE:
+          cyc['msgs'] += await self._pub('%s/%s' % (self.NAME, k), msg)
+        else:
+          batch.append((k, v, msg))
+      for g in self._groups(batch, ts):
+        for p in self._batches(g, ts):
+          cyc['msgs'] += await self._pub('%s/batch' % self.NAME, p)
+    else:
+      for k, v, msg in out:
+        cyc['msgs'] += await self._pub('%s/%s' % (self.NAME, k), msg)
+
+    tr = self.sim.track
+    if self.TRACK and tr is not None and (due is None or 'track' in due):
+      # packed binary, neither batched nor encoded by a codec
+      if len(tr):
+        mark = tr.mark()
+        cyc['msgs'] += await self._pub('%s/track' % self.NAME, tr.pack(tr.simplify(self.TRACK_TOLERANCE)))
+        tr.release(mark)
+      self.sched.sent('track')
+
+    for k, v, msg in changed:
+      self._published(k, v, msg)
+    for k, v, msg in out:
+      self.sched.sent(k)
+    for c in cyc:
+      self.pubstats[c] = self.pubstats.get(c, 0) + cyc[c]
+    self.lastcycle = cyc
+    d("uplink: published %d keys (%d B) in %d messages, unchanged %d keys (%d B)" %
+      (cyc['sent'], cyc['sent_bytes'], cyc['msgs'], cyc['saved'], cyc['saved_bytes']))
+
+    if self.t0 is not None:
+      self._phase('first_pub', self.t)
+      self._phase('boot_to_pub', self.t0)
+      self.t0 = None
+    # TODO: singal that that has been uplinked
+    # if self.dataup_signal:
+    #   self.dataup_signal()
+
+
+  BATCH_OVERHEAD = 8 # container bytes a merged map may need beyond its single-item encodings
+  def _groups(self, items, ts):
+    """
+    pack (key, value, encoded) items into groups that should encode under the modem
+    limit with the 'ts' entry, estimated from the single-item encodings
+    """
+    limit = self.sim.MQTT_MAX_PAYLOAD - len(self.CODEC.encode({'ts': ts})) - self.BATCH_OVERHEAD
+    g = []
+    size = 0
+    for it in items:
+      n = len(self.CODEC.encode({it[0]: it[1]}))
+      if g and size + n > limit:
+        yield g
+        g = []
+        size = 0
+      g.append(it)
+      size += n
+    if g:
+      yield g
+
+
+  def _batches(self, g, ts):
+    """
+    encoded batch messages of group g, halved until each fits the modem limit,
+    only a single item too big on its own goes out as chunks
+    """
+    m = {'ts': ts}
+    for k, v, _ in g:
+      m[k] = v
+    p = self.CODEC.encode(m)
+    if len(p) <= self.sim.MQTT_MAX_PAYLOAD or len(g) < 2:
+      return [p]
+    h = len(g) // 2
+    return self._batches(g[:h], ts) + self._batches(g[h:], ts)
+
+
+  def _encode(self, k, v):
+    return self.CODECS.get(k, self.CODEC).encode(v)
+
+
+  async def _pub(self, topic, payload):
+    """
+    publish bytes, payloads over the modem limit go out as chunks with a sequence header
+    """
+    frames = codec.chunks(payload, self.sim.MQTT_MAX_PAYLOAD, self.msgid)
+    if len(frames) > 1 or frames[0] is not payload:
+      self.msgid = (self.msgid + 1) & 0xffff
+      self.chunked += 1
+    for f in frames:
+      await self.sim.mqtt_pub(topic, f)
+    return len(frames)
+
+
+  def _changed(self, k, v, msg):
+    db = self.DEADBANDS.get(k)
+    if db is not None and type(v) in (int, float):
+      last = self.lastnum.get(k)
+      return last is None or abs(v - last) >= db
+    return self.lasthash.get(k) != hash(msg)
+
+
+  def _published(self, k, v, msg):
+    self.lasthash[k] = hash(msg)
+    if k in self.DEADBANDS:
+      self.lastnum[k] = v
+
+
+  def _journal_sample(self, data):
+    if self.journal is not None:
+      self.journal.append(utime.time(), ujson.dumps(data))
+
+
+  async def _sampler(self, data):
+    try:
+      while True:
+        await uasyncio.sleep(self.SAMPLE_INTERVAL)
+        if not self.online:
+          self._journal_sample(data)
+    except uasyncio.CancelledError:
+      pass
+
+
+  async def _drain(self):
+    """
+    replay one batch of journaled samples as [ts, data], a record is acknowledged
+    in the journal only after its mqtt_pub returned OK, returns True while
+    records are left for the next cycle
+    """
+    j = self.journal
+    if j is None or not len(j):
+      return False
+    recs = j.read(self.JOURNAL_BATCH)
+    t = utime.ticks_ms()
+    n = 0
+    last = None
+    try:
+      for seq, ts, p in recs:
+        await self._pub('%s/journal' % self.NAME, ('[%d,' % ts).encode() + p + b']')
+        last = seq
+        n += 1
+        self.replayed += 1
+        await uasyncio.sleep(1 / self.JOURNAL_DRAIN_RATE)
+    finally:
+      if last is not None:
+        j.ack(last)
+      dt = utime.ticks_diff(utime.ticks_ms(), t)
+      if dt > 0:
+        self.replay_rate = n * 1000 / dt
+    return bool(recs) and len(j) > 0
+
+
+  async def _recover(self, tier):
+    """
+    repair the uplink state at the given tier of the recovery ladder
+    """
+    self.recoveries[tier] += 1
+    print("Uplink recovery: %s" % self.TIER_NAMES[tier])
+    if tier == self.TIER_RETRY:
+      return
+    if tier >= self.TIER_NETREG:
+      await self.sim.reregister()
+    if tier >= self.TIER_BEARER:
+      await self.sim.bearer_reconnect()
+    else:
+      await self.sim.mqtt_reconnect()
+    await self._wait_mqtt()
+    await self.sim.mqtt_sub('%s/cmd' % self.NAME)
 
-            if self.ENABLE_GNSS:
-              loc = await self.sim.get_gnss()
-              await self.sim.mqtt_pub('%s/loc' % self.NAME, ujson.dumps(loc))
 
-            for k in data:
-              await self.sim.mqtt_pub('%s/%s' % (self.NAME, k), ujson.dumps(data[k]))
+  async def _doze(self):
+    """
+    sleep the modem until WAKE_AHEAD before the next deadline or an urgent key,
+    then repair whatever the network dropped meanwhile
+    """
+    dl = self.sched.next_in()
+    if dl is None or dl < (self.SLEEP_MIN + self.WAKE_AHEAD) * 1000:
+      return
+    await self.sim.sleep()
+    try:
+      await self.sched.doze(dl - self.WAKE_AHEAD * 1000)
+    finally:
+      await self.sim.wake()
+    lost = await self.sim.session_check()
+    if lost:
+      print("Uplink resumed after sleep, re-established %s" % lost)
+      self.resumes[lost] = self.resumes.get(lost, 0) + 1
+      await self._wait_mqtt()
+      await self.sim.mqtt_sub('%s/cmd' % self.NAME)
+
+
+  def urgent(self, key):
+    """
+    publish key ('loc', 'status' or a key of data) right away,
+    subject to its MIN_INTERVALS entry
+    """
+    self.sched.urgent(key)
 
-            await self.sim.mqtt_pub('%s/status' % (self.NAME,), ujson.dumps([ts, await self.get_status()]))
-            # TODO: singal that that has been uplinked
-            # if self.dataup_signal:
-            #   self.dataup_signal()
 
-            await uasyncio.sleep(self.PUB_INTERVAL)
-            inexs = 0
+  async def _publish_loop(self, data):
+    tier = self.TIER_RETRY
+    due = None
+    while self.running:
+      try:
+        if due is None:
+          keys = list(data)
+          keys.append('status')
+          if self.ENABLE_GNSS:
+            keys.append('track' if self.TRACK else 'loc')
+          if self.PUB_METRICS:
+            keys.append('metrics')
+          if self.PUB_DIAG:
+            keys.append('diag')
+          if self.journal is not None and len(self.journal):
+            keys.append('journal')
+          self.sched.sync(keys)
+          if self.POWER_SAVE:
+            await self._doze()
+          due = await self.sched.wait()
+        drain = 'journal' in due
+        if not drain or len(due) > 1:
+          await self._publish(data, due)
+        self.sched.done(due)
+        due = None
+        self.online = True
+        tier = self.TIER_RETRY
+        self.backoff.reset()
+        self.restart_backoff.reset()
+        if drain and not await self._drain():
+          self.sched.remove('journal')
+      except uasyncio.CancelledError:
+        raise
+      except Exception as e:
+        print("Internal exception inside uplink run publish loop:")
+        usys.print_exception(e)
+        if self.online:
+          self.online = False
+          self._journal_sample(data)
+        while self.running:
+          if tier >= self.TIER_POWER:
+            raise Exception("Uplink recovery ladder exhausted")
+          await uasyncio.sleep(self.backoff.next())
+          try:
+            await self._recover(tier)
+            tier += 1
+            break
+          except uasyncio.CancelledError:
+            raise
           except Exception as e:
-            inexs += 1
-            print("Internal exception inside uplink run publish loop:")
+            print("Uplink recovery %s failed:" % self.TIER_NAMES[tier])
             usys.print_exception(e)
-            if inexs > 5:
-              raise
+            tier += 1
+
+
+  async def _run(self, data):
+    self.running = True
+    while self.running:
+      try:
+        await self._bringup()
+        await self._publish_loop(data)
 
         d('unsubscribing to %s/cmd' % self.NAME)
         await self.sim.mqtt_unsub('%s/cmd' % self.NAME)
@@ -677,7 +3296,9 @@ class MQTTUplink:
       except Exception as e:
         print("Exception in uplink run loop:")
         usys.print_exception(e)
+        self.recoveries[self.TIER_POWER] += 1
       finally:
+        self.online = False
         self.restarts += 1
         d("Uplink cleanup...")
         if self.cmdrt:
@@ -685,15 +3306,22 @@ class MQTTUplink:
           await self.cmdrt
           self.cmdrt = None
         if self.sim:
-          await self.sim.deinit()
-          self.sim = None
+          sim, self.sim = self.sim, None
+          await sim.deinit()
+          self.cold = True
 
       if self.running:
-        print("Uplink will be restarted after %d s" % self.RESTART_INTERVAL)
-        await uasyncio.sleep(self.RESTART_INTERVAL)
+        dl = self.restart_backoff.next()
+        print("Uplink will be restarted after %d s" % dl)
+        await uasyncio.sleep(dl)
 
 
   def start(self, data):
+    if self.JOURNAL_DIR and self.journal is None:
+      import journal
+      self.journal = journal.Journal(self.JOURNAL_DIR)
+    if self.journal is not None and not self.samplert:
+      self.samplert = uasyncio.create_task(self._sampler(data))
     self.outt = uasyncio.create_task(self._run(data))
 
 
@@ -703,18 +3331,70 @@ class MQTTUplink:
       self.cmdrt.cancel()
       await self.cmdrt
       self.cmdrt = None
+    if self.samplert:
+      self.samplert.cancel()
+      await self.samplert
+      self.samplert = None
     d('waiting for uplink tasks to stop')
     await self.outt
+    if self.journal is not None:
+      self.journal.flush()
 
 
+  STATUS_NEXT = 4 # deadlines in the status, the full schedule is in get_diag()
   async def get_status(self):
+    """
+    compact status for <NAME>/status, it has to fit one MQTT message,
+    the diagnostics are in get_diag()
+    """
     res = {'running': self.running,
-           'restarts': self.restarts }
-    if self.running and self.sim:
-      res['connected'] = await self.sim.get_netinfo()
-      res['signal'] = await self.sim.get_signalinfo()
-      res['app'] = await self.sim.mqtt_getappstatus()
-      res['mqtt'] = await self.sim.mqtt_getconnstatus()
+           'restarts': self.restarts,
+           'recoveries': list(self.recoveries), # per tier, in TIER_NAMES order
+           'next': self.sched.upcoming(self.STATUS_NEXT) }
+    if self.journal is not None:
+      res['journal'] = {'depth': len(self.journal), 'rate': round(self.replay_rate, 1)}
+    if self.running and self.sim and not self.sim.asleep:
+      res['connected'] = (await self.sim.get_netinfo(True)).todict()
+      res['signal'] = (await self.sim.get_signalinfo(True)).todict()
+      res['app'] = await self.sim.mqtt_getappstatus(True)
+      res['mqtt'] = await self.sim.mqtt_getconnstatus(True)
+
+    return res
+
+
+  def get_diag(self):
+    """
+    driver and uplink diagnostics for <NAME>/diag and the shell
+    """
+    res = {'recoveries': dict(zip(self.TIER_NAMES, self.recoveries)),
+           'timings': self.timings }
+    res['pub'] = {'cycles': self.cycles, 'total': self.pubstats, 'last': self.lastcycle, 'chunked': self.chunked}
+    res['sched'] = self.sched.todict()
+    if self.sim:
+      res['power'] = self.sim.power_stats()
+      res['power']['resumes'] = self.resumes
+      msgs = self.pubstats.get('msgs', 0)
+      if msgs:
+        res['power']['radio_on_ms_per_msg'] = res['power']['radio_on_ms'] // msgs
+    if self.sim and self.sim.inbox is not None:
+      res['sms'] = self.sim.sms_stats()
+    if self.sim and self.sim.track is not None:
+      res['track'] = self.sim.track.stats()
+    if self.journal is not None:
+      res['journal'] = self.journal.stats()
+      res['journal']['replayed'] = self.replayed
+      res['journal']['replay_rate'] = self.replay_rate
+    if self.sim:
+      res['queues'] = {'interact': self.sim.interactqueue.stats(),
+                       'mqtt': self.sim.router.stats(),
+                       'cmd': self.sim.cmdq.stats()}
+      res['urc'] = self.sim.urc_stats()
+      res['cache'] = self.sim.cache_stats()
+      res['reg'] = self.sim.reg.todict()
+      if self.sim.recorder:
+        res['transcript'] = self.sim.recorder.stats()
+      res['init'] = {'warm': self.sim.warm, 'timings': self.sim.timings,
+                     'baudrate': self.sim.baudrate, 'flow': self.sim.flow}
 
     return res
 
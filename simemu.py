@@ -0,0 +1,463 @@
+"""
+simemu.py
+
+Copyright (C) 2020-2021 Tomas Hlavacek (tmshlvck@gmail.com)
+
+Scripted SIM7000 stand-in for the UART streams used by sim.SIM
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import uasyncio
+import urandom
+
+
+# answers of a registered, MQTT-connected SIM7000G
+DEFAULT_SCRIPT = {
+  'AT': 'OK',
+  'AT+CPSI?': '+CPSI: LTE CAT-M1,Online,230-03,0x0B4C,27458329,347,EUTRAN-BAND20,6300,3,3,-10,-97,-69,13\nOK',
+  'AT+CSQ': '+CSQ: 20,99\nOK',
+  'AT+CREG?': '+CREG: 2,1,"0B4C","01A2B3C4",7\nOK',
+  'AT+SAPBR=2,1': '+SAPBR: 1,1,"10.0.0.1"\nOK',
+  'AT+CNACT?': '+CNACT: 1,"10.0.0.2"\nOK',
+  'AT+SMSTATE?': '+SMSTATE: 1\nOK',
+  'AT+CCLK?': '+CCLK: "21/05/10,22:10:39+08"\nOK',
+  'AT+CNTP': 'OK\n+CNTP: 1',
+  'AT+CNTP=': 'OK',
+  'AT+CGNSINF': '+CGNSINF: 1,1,20210510221039.000,50.087451,14.420671,235.400,0.00,0.0,1,,1.1,1.4,0.9,,12,8,3,,38,,\nOK',
+  'AT+CMGF=': 'OK',
+  'AT+CMMS=': 'OK',
+  'AT+CNMI=': 'OK',
+  'AT+CREG=': 'OK',
+  'AT+CEREG=': 'OK',
+  'AT+CFUN=': 'OK',
+  'AT+CGNSPWR=': 'OK',
+  'AT+SAPBR=': 'OK',
+  'AT+CNACT=': 'OK',
+  'AT+SMCONF=': 'OK',
+  'AT+CPSMS=': 'OK',
+  'AT+CEDRXS=': 'OK',
+  'AT+CSCLK=': 'OK',
+  'AT+IFC=': 'OK',
+  'AT+CLAC': '\n'.join(['AT&C', 'AT&D', 'AT&F', 'AT&V', 'AT&W', 'ATE', 'ATI', 'ATQ', 'ATV', 'ATZ',
+                         'AT+CGMI', 'AT+CGMM', 'AT+CGMR', 'AT+CGSN', 'AT+CSCS', 'AT+CIMI', 'AT+CLCK',
+                         'AT+CPAS', 'AT+CFUN', 'AT+CPIN', 'AT+CSQ', 'AT+CPOL', 'AT+COPS', 'AT+CREG',
+                         'AT+CEREG', 'AT+CGATT', 'AT+CGACT', 'AT+CGDCONT', 'AT+CPSMS', 'AT+CEDRXS',
+                         'AT+CMGF', 'AT+CMGL', 'AT+CMGR', 'AT+CMGS', 'AT+CMGD', 'AT+CNMI', 'AT+IPR',
+                         'AT+IFC', 'AT+CSCLK', 'AT+CCLK', 'AT+CNTP', 'AT+CPSI', 'AT+CNACT', 'AT+SAPBR',
+                         'AT+SMCONF', 'AT+SMCONN', 'AT+SMPUB', 'AT+SMSUB', 'AT+SMUNSUB', 'AT+SMSTATE',
+                         'AT+SMDISC', 'AT+CGNSPWR', 'AT+CGNSINF', 'AT+CGNSURC', 'OK']),
+  }
+
+
+class ScriptedModem:
+  """
+  Acts as both reader and writer for SIM.attach(). Commands are answered
+  from self.script (command prefix -> response string or callable(cmd)
+  returning it, longest prefix wins), AT+SMPUB and AT+CMGS go through the
+  '>' data prompt like the real modem. The MQTT session state follows
+  SMCONN/SMDISC/SMSUB/SMUNSUB unless script overrides them, the SMS
+  storage follows sms() and CMGR/CMGL/CMGD in text and PDU mode.
+  AT+CGNSURC=<n> starts +UGNSINF reports every n * fix_ms of the fixes
+  from self.route, a callable(k) returning (lat, lon, alt, speed) of fix k.
+
+  latency_ms delays every answer, latencies (prefix -> ms) single commands.
+  With baudrate set, every byte costs the wire time of 10 bits and AT+IPR
+  switches the rate after its OK. fail()/hang() inject errors and lost
+  answers, error_rate answers that share of commands with +CME ERROR: 100
+  (seed makes it reproducible), urc() and message() inject URCs.
+  On CPython, pty() serves the modem on a pseudo terminal for machine.UART.
+  """
+
+  def __init__(self, script=None, latency_ms=0, baudrate=None, latencies=None, error_rate=0, seed=None):
+    self.script = dict(DEFAULT_SCRIPT)
+    self.script.update({'AT+SMCONN': self._smconn, 'AT+SMDISC': self._smdisc,
+                        'AT+SMSTATE?': self._smstate, 'AT+SMSUB=': self._smsub,
+                        'AT+SMUNSUB=': self._smunsub, 'AT+CMGF=': self._cmgf,
+                        'AT+CMGL=': self._cmgl, 'AT+CMGR=': self._cmgr, 'AT+CMGD=': self._cmgd,
+                        'AT+CGNSURC=': self._cgnsurc})
+    if script:
+      self.script.update(script)
+    self.latency_ms = latency_ms
+    self.latencies = latencies or {}
+    self.baudrate = baudrate
+    self.error_rate = error_rate
+    if seed is not None:
+      urandom.seed(seed)
+    self.faults = [] # [prefix, response or None for no answer, remaining count]
+    self.mqtt = 1
+    self.subs = set()
+    self.pdumode = False
+    self.smsstore = {} # index -> (stat, sender, time, text or hex PDU)
+    self.smsref = 0
+    self.fix_ms = 100 # one GNSS fix per fix_ms, 1 s on the real modem
+    self.route = self._route
+    self.gnsstask = None
+    self.fixes = 0
+    self.rx = b''
+    self.rxev = uasyncio.Event()
+    self.tx = b''
+    self.datalen = None # bytes expected after the prompt, -1 = until ctrl-Z
+    self.datacmd = None
+    self.cmds = [] # log of received commands
+    self.published = [] # (cmd, data) pairs received after the prompt
+
+
+  def feed(self, data):
+    """
+    queue bytes for the driver to read, used for responses and URC injection
+    """
+    if type(data) is str:
+      data = data.encode()
+    self.rx += data
+    self.rxev.set()
+
+
+  def urc(self, line, after_ms=0):
+    """
+    inject an unsolicited line, e.g. '+CREG: 1' or 'NORMAL POWER DOWN'
+    """
+    if after_ms:
+      async def later():
+        await uasyncio.sleep_ms(after_ms)
+        self.feed('\r\n%s\r\n' % line)
+      return uasyncio.create_task(later())
+    self.feed('\r\n%s\r\n' % line)
+
+
+  def message(self, topic, payload, after_ms=0):
+    """
+    inject an incoming MQTT message as +SMSUB URC
+    """
+    return self.urc('+SMSUB: "%s","%s"' % (topic, payload), after_ms)
+
+
+  def sms(self, sender, text, after_ms=0, time='21/05/10,22:10:39+08'):
+    """
+    store an incoming SMS and announce it with +CMTI, in PDU mode a long
+    text arrives as concatenated parts, each with its own +CMTI
+    """
+    if self.pdumode:
+      import pdu
+      import ubinascii
+      self.smsref += 1
+      texts = []
+      for _, h in pdu.encode(sender, text, self.smsref):
+        # SMS-SUBMIT -> SMS-DELIVER: no MR, no VP, a time stamp after DCS
+        b = ubinascii.unhexlify(h)[1:]
+        al = 2 + (b[2] + 1) // 2
+        ts = ubinascii.unhexlify(''.join(p[1] + p[0] for p in ('21', '05', '10', '22', '10', '39', '08')))
+        texts.append(ubinascii.hexlify(b'\x00' + bytes(((b[0] & 0x40) | 0x04,)) + b[2:2+al+2] + ts + b[2+al+2:]).decode().upper())
+    else:
+      texts = [text]
+    for t in texts:
+      idx = 0
+      while idx in self.smsstore:
+        idx += 1
+      self.smsstore[idx] = (0, sender, time, t)
+      self.urc('+CMTI: "SM",%d' % idx, after_ms)
+
+
+  def fail(self, prefix, resp='ERROR', times=1):
+    """
+    answer the next times commands starting with prefix with resp, None = no answer
+    """
+    self.faults.append([prefix, resp, times])
+
+
+  def hang(self, prefix, times=1):
+    self.fail(prefix, None, times)
+
+
+  def _fault(self, cmd):
+    for f in self.faults:
+      if cmd.startswith(f[0]):
+        f[2] -= 1
+        if f[2] <= 0:
+          self.faults.remove(f)
+        return True, f[1]
+    if self.error_rate and urandom.random() < self.error_rate:
+      return True, '+CME ERROR: 100'
+    return False, None
+
+
+  # MQTT session state
+  def _smconn(self, cmd):
+    self.mqtt = 1
+    return 'OK'
+
+
+  def _smdisc(self, cmd):
+    if not self.mqtt:
+      return 'ERROR'
+    self.mqtt = 0
+    self.subs.clear()
+    return 'OK'
+
+
+  def _smstate(self, cmd):
+    return '+SMSTATE: %d\nOK' % self.mqtt
+
+
+  def _smsub(self, cmd):
+    self.subs.add(cmd[9:].split(',')[0].strip('"'))
+    return 'OK'
+
+
+  def _smunsub(self, cmd):
+    t = cmd[11:].strip('"')
+    if t not in self.subs:
+      return 'ERROR'
+    self.subs.discard(t)
+    return 'OK'
+
+
+  # SMS storage
+  STATS = ('REC UNREAD', 'REC READ', 'STO UNSENT', 'STO SENT')
+
+  def _cmgf(self, cmd):
+    self.pdumode = cmd[8:].strip() == '0'
+    return 'OK'
+
+
+  def _smshead(self, cmd, idx):
+    st, sender, time, t = self.smsstore[idx]
+    pre = ('%d,' % idx) if cmd == '+CMGL:' else ''
+    if self.pdumode:
+      return '%s %s%d,,%d' % (cmd, pre, st, len(t) // 2 - 1)
+    return '%s %s"%s","%s",,"%s"' % (cmd, pre, self.STATS[st], sender, time)
+
+
+  def _cmgr(self, cmd):
+    idx = int(cmd[8:])
+    if idx not in self.smsstore:
+      return 'OK'
+    r = '%s\n%s\nOK' % (self._smshead('+CMGR:', idx), self.smsstore[idx][3])
+    st, sender, time, t = self.smsstore[idx]
+    self.smsstore[idx] = (1, sender, time, t)
+    return r
+
+
+  def _cmgl(self, cmd):
+    r = []
+    for idx in sorted(self.smsstore):
+      r.append(self._smshead('+CMGL:', idx))
+      r.append(self.smsstore[idx][3])
+    r.append('OK')
+    return '\n'.join(r)
+
+
+  def _cmgd(self, cmd):
+    self.smsstore.pop(int(cmd[8:].split(',')[0]), None)
+    return 'OK'
+
+
+  # GNSS reports
+  @staticmethod
+  def _route(k):
+    """
+    east at 36 km/h, turning north after 60 fixes
+    """
+    if k < 60:
+      return 50.087451, 14.420671 + k * 0.00014, 235.4, 36.0
+    return 50.087451 + (k - 60) * 0.00009, 14.420671 + 60 * 0.00014, 235.4, 36.0
+
+
+  def _cgnsurc(self, cmd):
+    n = int(cmd[11:])
+    if self.gnsstask:
+      self.gnsstask.cancel()
+      self.gnsstask = None
+    if n:
+      self.gnsstask = uasyncio.create_task(self._gnss(n))
+    return 'OK'
+
+
+  async def _gnss(self, n):
+    while True:
+      await uasyncio.sleep_ms(n * self.fix_ms)
+      self.fixes += n
+      lat, lon, alt, speed = self.route(self.fixes)
+      t = (22 * 3600 + 10 * 60 + 39 + self.fixes) % 86400
+      self.urc('+UGNSINF: 1,1,20210510%02d%02d%02d.000,%.6f,%.6f,%.3f,%.2f,0.0,1,,1.1,1.4,0.9,,12,8,3,,38,,'
+               % (t // 3600, t // 60 % 60, t % 60, lat, lon, alt, speed))
+
+
+  def respond(self, cmd):
+    best = None
+    for k in self.script:
+      if cmd.startswith(k) and (best is None or len(k) > len(best)):
+        best = k
+    if best is None:
+      return 'ERROR'
+    r = self.script[best]
+    if callable(r):
+      r = r(cmd)
+    return r
+
+
+  async def _delay(self, cmd):
+    ms = self.latency_ms
+    best = None
+    for k in self.latencies:
+      if cmd.startswith(k) and (best is None or len(k) > len(best)):
+        best = k
+    if best is not None:
+      ms = self.latencies[best]
+    if ms:
+      await uasyncio.sleep_ms(ms)
+
+
+  async def _reply(self, resp, cmd=''):
+    await self._delay(cmd)
+    resp = '\r\n' + '\r\n\r\n'.join(resp.split('\n')) + '\r\n'
+    await self._wire(len(resp))
+    self.feed(resp)
+
+
+  async def _wire(self, n):
+    if self.baudrate:
+      await uasyncio.sleep_ms(n * 10000 // self.baudrate)
+
+
+  async def _command(self, cmd):
+    self.cmds.append(cmd)
+    faulty, resp = self._fault(cmd)
+    if faulty:
+      if resp is not None:
+        await self._reply(resp, cmd)
+    elif cmd.startswith('AT+SMPUB='):
+      self.datalen = int(cmd.split(',')[1])
+      self.datacmd = cmd
+      await self._delay(cmd)
+      self.feed('\r\n> ')
+    elif cmd.startswith('AT+CMGS='):
+      self.datalen = -1
+      self.datacmd = cmd
+      await self._delay(cmd)
+      self.feed('\r\n> ')
+    elif cmd.startswith('AT+IPR='):
+      await self._reply('OK', cmd)
+      self.baudrate = int(cmd[7:]) or self.baudrate
+    else:
+      await self._reply(self.respond(cmd), cmd)
+
+
+  async def _data(self):
+    if self.datalen < 0:
+      i = self.tx.find(b'\x1a')
+      if i < 0:
+        return False
+      data = self.tx[:i]
+      self.tx = self.tx[i+1:]
+      resp = '+CMGS: %d\nOK' % len(self.published)
+    else:
+      if len(self.tx) < self.datalen:
+        return False
+      data = self.tx[:self.datalen]
+      self.tx = self.tx[self.datalen:]
+      resp = 'OK'
+    self.published.append((self.datacmd, data))
+    self.datalen = None
+    self.datacmd = None
+    await self._reply(resp)
+    return True
+
+
+  # writer side
+  async def awrite(self, data):
+    await self._wire(len(data))
+    self.tx += data
+    while self.tx:
+      if self.datalen is not None:
+        if not await self._data():
+          break
+        continue
+      i = self.tx.find(b'\r')
+      if i < 0:
+        break
+      cmd = self.tx[:i].strip()
+      self.tx = self.tx[i+1:].lstrip(b'\n')
+      if cmd:
+        await self._command(cmd.decode())
+
+
+  async def drain(self):
+    pass
+
+
+  # reader side
+  async def read(self, n):
+    while not self.rx:
+      self.rxev.clear()
+      await self.rxev.wait()
+    r = self.rx[:n]
+    self.rx = self.rx[n:]
+    return r
+
+
+  async def readline(self):
+    while self.rx.find(b'\n') < 0:
+      self.rxev.clear()
+      await self.rxev.wait()
+    i = self.rx.find(b'\n')
+    r = self.rx[:i+1]
+    self.rx = self.rx[i+1:]
+    return r
+
+
+  def close(self):
+    if self.gnsstask:
+      self.gnsstask.cancel()
+
+
+  def pty(self):
+    """
+    CPython only: serve the modem on a new pseudo terminal, returns the path
+    of its slave side for machine.UART.PORTS
+    """
+    return serve_pty(self)
+
+
+def serve_pty(stream):
+  """
+  CPython only: pump a reader/writer object like ScriptedModem or
+  transcript.Replayer to the master side of a new pseudo terminal,
+  returns the path of the slave side
+  """
+  import os
+  import pty
+  import tty
+  import asyncio
+  master, slave = pty.openpty()
+  tty.setraw(master)
+  tty.setraw(slave)
+  os.set_blocking(master, False)
+  inbox = asyncio.Queue()
+  def readable():
+    try:
+      inbox.put_nowait(os.read(master, 4096))
+    except OSError:
+      pass
+  async def pump_in():
+    while True:
+      await stream.awrite(await inbox.get())
+  async def pump_out():
+    while True:
+      data = await stream.read(4096)
+      while data:
+        try:
+          data = data[os.write(master, data):]
+        except BlockingIOError:
+          await asyncio.sleep(0.001)
+  asyncio.get_event_loop().add_reader(master, readable)
+  stream.ptytasks = (asyncio.create_task(pump_in()), asyncio.create_task(pump_out()), slave)
+  return os.ttyname(slave)
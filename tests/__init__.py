@@ -0,0 +1,30 @@
+"""
+tests
+
+Copyright (C) 2020-2021 Tomas Hlavacek (tmshlvck@gmail.com)
+
+Host tests for the sim driver, they run on CPython with the MicroPython
+stand-ins from host/:
+  python3 -m unittest discover -t . -s tests   (or python3 -m pytest tests)
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for _p in (_root, os.path.join(_root, 'host')):
+  if _p not in sys.path:
+    sys.path.insert(0, _p)
+
+import sim
+sim.DEBUG = False
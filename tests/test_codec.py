@@ -0,0 +1,53 @@
+import unittest
+
+import codec
+
+
+class TestChunks(unittest.TestCase):
+  def test_fits(self):
+    self.assertEqual(codec.chunks(b'{"a": 1}', 64, 1), [b'{"a": 1}'])
+
+
+  def test_reassembly(self):
+    payload = bytes(range(256)) * 3
+    frames = codec.chunks(payload, 100, 0x1234)
+    self.assertGreater(len(frames), 1)
+    self.assertTrue(all(len(f) <= 100 and f[0] == codec.CHUNK_MAGIC for f in frames))
+    r = codec.Reassembler()
+    res = [r.feed(f) for f in reversed(frames)] # any order
+    self.assertEqual(res[:-1], [None] * (len(frames) - 1))
+    self.assertEqual(res[-1], payload)
+    self.assertEqual(r.pending, {})
+
+
+  def test_magic_collision(self):
+    # a StructCodec payload may start with the chunk magic, it must go out framed
+    payload = codec.StructCodec('<h').encode(-2)
+    self.assertEqual(payload[0], codec.CHUNK_MAGIC)
+    frames = codec.chunks(payload, 64, 5)
+    self.assertEqual(len(frames), 1)
+    self.assertIsNot(frames[0], payload)
+    self.assertEqual(codec.Reassembler().feed(frames[0]), payload)
+
+
+  def test_interleaved(self):
+    a = codec.chunks(b'a' * 50, 20, 1)
+    b = codec.chunks(b'b' * 50, 20, 2)
+    r = codec.Reassembler(maxpending=1)
+    r.feed(a[0])
+    r.feed(b[0]) # evicts message 1
+    self.assertEqual(r.dropped, 1)
+    for f in b[1:]:
+      res = r.feed(f)
+    self.assertEqual(res, b'b' * 50)
+
+
+class TestCodecs(unittest.TestCase):
+  def test_cbor(self):
+    v = {'t': -12, 'ok': True, 'n': None, 'f': 1.5, 'l': [1, 'x', b'\x00'], 'big': 2 ** 40}
+    self.assertEqual(codec.CBOR.decode(codec.CBOR.encode(v)), v)
+
+
+  def test_struct(self):
+    c = codec.StructCodec('<hH')
+    self.assertEqual(c.decode(c.encode([-215, 512])), [-215, 512])
@@ -0,0 +1,45 @@
+import unittest
+
+import gnss
+
+
+class TestGNSS(unittest.TestCase):
+  def test_seconds(self):
+    self.assertEqual(gnss.seconds(2000, 1, 1, 0, 0, 0), 0)
+    self.assertEqual(gnss.seconds(2021, 5, 10, 22, 10, 39), 673999839)
+
+
+  def test_simplify(self):
+    # straight line with one 50 m detour in the middle
+    xs = [0, 10, 20, 30, 40, 50, 60]
+    ys = [0, 0.5, 0, 50, 0, -0.5, 0]
+    self.assertEqual(gnss.simplify(xs, ys, 5), [0, 2, 3, 4, 6])
+    self.assertEqual(gnss.simplify(xs[:2], ys[:2], 5), [0, 1])
+
+
+  def test_pack_unpack(self):
+    t = gnss.Track(8)
+    fixes = [(673913439 + 10 * i, 50087000 + 37 * i * (-1) ** i, 14420000 - 51 * i, 230 - 3 * i, 10 * i)
+             for i in range(6)]
+    for f in fixes:
+      t.add(*f)
+    self.assertEqual(gnss.unpack(t.pack()), fixes)
+    ks = t.simplify(1)
+    self.assertEqual(gnss.unpack(t.pack(ks)), [fixes[k] for k in ks])
+
+
+  def test_ring(self):
+    t = gnss.Track(4)
+    for i in range(6):
+      t.add(i, i, i)
+    self.assertEqual((len(t), t.overwritten), (4, 2))
+    self.assertEqual(t.fix(0)[0], 2)
+    m = t.mark()
+    t.add(6, 6, 6)
+    t.release(m)
+    self.assertEqual([t.fix(k)[0] for k in range(len(t))], [6])
+
+
+  def test_not_a_track(self):
+    with self.assertRaises(ValueError):
+      gnss.unpack(b'\x00' * gnss.TRACK_HDR_LEN)
@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import journal
+
+
+class TestJournal(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'j')
+
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+
+  def test_reopen(self):
+    j = journal.Journal(self.path)
+    for i in range(10):
+      j.append(1000 + i, 'rec%d' % i)
+    j.flush()
+    j.ack(4)
+    j = journal.Journal(self.path)
+    self.assertEqual(len(j), 6)
+    self.assertEqual(j.read(2), [(5, 1004, b'rec4'), (6, 1005, b'rec5')])
+
+
+  def test_torn_tail(self):
+    j = journal.Journal(self.path)
+    for i in range(5):
+      j.append(i, b'payload %d' % i)
+    j.flush()
+    seg = os.path.join(self.path, '%d.seg' % j.segs[-1][0])
+    with open(seg, 'r+b') as f: # power lost in the middle of the last record
+      f.truncate(os.path.getsize(seg) - 3)
+    j = journal.Journal(self.path)
+    self.assertEqual(j.torn, 1)
+    self.assertEqual([r[0] for r in j.read(10)], [1, 2, 3, 4])
+    # new records go to a fresh segment, the torn one is not appended to
+    self.assertEqual(j.append(9, b'after'), 5)
+    j.flush()
+    self.assertEqual(len(j.segs), 2)
+    j = journal.Journal(self.path)
+    self.assertEqual([r[2] for r in j.read(10)][-2:], [b'payload 3', b'after'])
+
+
+  def test_evict(self):
+    j = journal.Journal(self.path)
+    j.SEG_SIZE = 64
+    j.MAX_SEGS = 2
+    for i in range(20):
+      j.append(i, b'x' * 20)
+      j.flush()
+    self.assertLessEqual(len(j.segs), 2)
+    self.assertEqual(j.evicted + len(j), 20)
+    self.assertEqual(j.read(1)[0][0], j.acked + 1)
@@ -0,0 +1,58 @@
+import io
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+import bench
+import main
+import sim
+import simemu
+import uasyncio
+
+
+class TestShell(unittest.TestCase):
+  def shell(self, cmds):
+    """
+    run the shell commands cmds against an uplink on the emulated modem,
+    returns (output, exceptions the shell caught)
+    """
+    async def run():
+      mo = simemu.ScriptedModem()
+      u = sim.MQTTUplink(main.CONFIG)
+      u.sim = bench._sim(mo)
+      mo.sms('+420111', 'hi')
+      await uasyncio.sleep_ms(10)
+      it = iter(cmds + ['exit'])
+      async def readline(prompt=''):
+        return next(it)
+      with mock.patch.object(main, 'readline', readline):
+        with self.assertRaises(SystemExit):
+          await main.shell(u, {'t': 21})
+    caught = []
+    out = io.StringIO()
+    with mock.patch.object(main.usys, 'print_exception', caught.append), redirect_stdout(out):
+      uasyncio.run(run())
+    return out.getvalue(), caught
+
+
+  def test_commands(self):
+    out, caught = self.shell(['help', '', 'data', 'status', 'getsms', 'delsms 0',
+                              'sendsms +420123 hello', 'stats', 'debug', 'undebug', 'nonsense'])
+    self.assertEqual(caught, [])
+    self.assertIn('Available commands', out)
+    self.assertIn('AT+CMGS', out) # a row of the stats table
+    self.assertIn('unknown command', out)
+
+
+  def test_stats_stopped(self):
+    async def run():
+      it = iter(['stats', 'exit'])
+      async def readline(prompt=''):
+        return next(it)
+      with mock.patch.object(main, 'readline', readline):
+        with self.assertRaises(SystemExit):
+          await main.shell(sim.MQTTUplink(main.CONFIG), {})
+    out = io.StringIO()
+    with redirect_stdout(out):
+      uasyncio.run(run())
+    self.assertIn('Uplink not running', out.getvalue())
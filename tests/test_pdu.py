@@ -0,0 +1,49 @@
+import ubinascii
+import unittest
+
+import pdu
+
+
+def deliver(h, ts=b'\x12\x50\x01\x22\x01\x93\x80'):
+  """
+  the SMS-DELIVER a receiver gets for SMS-SUBMIT h from pdu.encode()
+  """
+  b = ubinascii.unhexlify(h)[1:]
+  al = 2 + (b[2] + 1) // 2
+  return ubinascii.hexlify(b'\x00' + bytes(((b[0] & 0x40) | 0x04,)) + b[2:2+al+2] + ts + b[2+al+2:])
+
+
+def roundtrip(tel, text, ref=7):
+  parts = [pdu.decode(deliver(h)) for _, h in pdu.encode(tel, text, ref)]
+  return parts, ''.join(p[2] for p in parts)
+
+
+class TestPDU(unittest.TestCase):
+  def test_gsm7(self):
+    parts, text = roundtrip('+420123456789', 'Hello @ 10$ [x] {y} ~€')
+    self.assertEqual(len(parts), 1)
+    sender, time, _, ref, part, n = parts[0]
+    self.assertEqual(text, 'Hello @ 10$ [x] {y} ~€')
+    self.assertEqual((sender, ref, part, n), ('+420123456789', None, 1, 1))
+    self.assertEqual(time, '21/05/10,22:10:39+08')
+
+
+  def test_ucs2(self):
+    parts, text = roundtrip('123', 'Ahoj 😀 čau')
+    self.assertEqual(text, 'Ahoj 😀 čau')
+    self.assertEqual(parts[0][0], '123')
+
+
+  def test_concatenated(self):
+    for msg in ('x' * 200 + ' € end', 'ž' * 70 + '😀' * 40):
+      parts, text = roundtrip('+420111', msg, ref=300)
+      self.assertEqual(text, msg)
+      self.assertGreater(len(parts), 1)
+      self.assertEqual([p[4] for p in parts], list(range(1, len(parts) + 1)))
+      self.assertTrue(all(p[3] == 300 & 0xff and p[5] == len(parts) for p in parts))
+
+
+  def test_length(self):
+    for n, h in pdu.encode('+420111', 'hi'):
+      self.assertEqual(n, len(h) // 2 - 1) # AT+CMGS counts the TPDU without the SMSC byte
+
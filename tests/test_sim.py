@@ -0,0 +1,268 @@
+import unittest
+
+import bench
+import codec
+import sim
+import simemu
+import uasyncio
+import utime
+
+
+class TestSubRouter(unittest.TestCase):
+  def test_match(self):
+    m = lambda f, t: sim.SubRouter.match(tuple(f.split(b'/')), t)
+    self.assertTrue(m(b'a/b', b'a/b'))
+    self.assertFalse(m(b'a/b', b'a/b/c'))
+    self.assertFalse(m(b'a/b/c', b'a/b'))
+    self.assertTrue(m(b'a/+/c', b'a/x/c'))
+    self.assertFalse(m(b'a/+/c', b'a/x/y'))
+    self.assertTrue(m(b'a/#', b'a/x/y'))
+    self.assertTrue(m(b'#', b'a'))
+    self.assertTrue(m(b'+/+', b'a/'))
+    self.assertFalse(m(b'+', b'a/b'))
+
+
+  def test_route(self):
+    r = sim.SubRouter()
+    got = []
+    q = sim.Queue(2)
+    r.add('dev/+/cmd', lambda t, p: got.append((t, p)))
+    r.add('dev/#', q)
+    r.feed(b'+SMSUB: "dev/1/cmd","start"\r\n')
+    r.feed(b'+SMSUB: "dev/1/state","x"\r\n')
+    r.feed(b'+SMSUB: "other","y"\r\n')
+    self.assertEqual(got, [(b'dev/1/cmd', b'start')])
+    self.assertEqual(len(r.queue('dev/#')), 2)
+    self.assertEqual((r.routed, r.unrouted), (2, 1))
+
+
+  def test_multiline(self):
+    r = sim.SubRouter()
+    got = []
+    r.add('t', lambda t, p: got.append(p))
+    self.assertTrue(r.feed(b'+SMSUB: "t","line 1\r\n'))
+    self.assertTrue(r.feed(b'line 2"\r\n'))
+    self.assertEqual(got, [b'line 1\r\nline 2'])
+
+
+  def test_partial_limit(self):
+    r = sim.SubRouter()
+    r.add('t', lambda t, p: None)
+    r.feed(b'+SMSUB: "t","cut\r\n')
+    for _ in range(r.PARTIAL_LINES - 1):
+      self.assertTrue(r.feed(b'more\r\n'))
+    self.assertFalse(r.feed(b'OK\r\n')) # back to the normal dispatch
+    self.assertIsNone(r.partial)
+    self.assertEqual(r.truncated, 1)
+
+
+class MPBytes(bytes):
+  """
+  bytes with the MicroPython startswith(), which takes no tuple
+  """
+  def startswith(self, prefix, *args):
+    if type(prefix) is tuple:
+      raise TypeError('startswith() takes no tuple')
+    return bytes.startswith(self, prefix, *args)
+
+
+class TestFailed(unittest.TestCase):
+  def test_final_errors(self):
+    for l in (b'ERROR', b'+CME ERROR: 10', b'+CMS ERROR: 500'):
+      self.assertTrue(sim.SIM._failed(MPBytes(l)))
+    for l in (b'OK', b'+CSQ: 20,99', b'ERRORS', b'+CME: 1'):
+      self.assertFalse(sim.SIM._failed(MPBytes(l)))
+
+
+class TestRegState(unittest.TestCase):
+  def test_urc(self):
+    r = sim.RegState()
+    r.update_urc('creg', b'+CREG: 1,"0B4C","01A2B3C4",7\r\n')
+    self.assertEqual((r.creg, r.lac, r.ci, r.act), (1, 0x0b4c, 0x01a2b3c4, 7))
+    r.update_urc('creg', b'+CREG: 2\r\n')
+    self.assertEqual((r.creg, r.changes), (2, 2))
+
+
+class TestScheduler(unittest.TestCase):
+  def test_due_order(self):
+    async def run():
+      s = sim.Scheduler(10, intervals={'fast': 0.05, 'slow': 0.2}, coalesce=0.02)
+      s.sync(['fast', 'slow'])
+      order = []
+      t = utime.ticks_ms()
+      while utime.ticks_diff(utime.ticks_ms(), t) < 450:
+        keys = await s.wait()
+        order.append(sorted(keys))
+        s.done(keys)
+      return order
+    order = uasyncio.run(run())
+    self.assertEqual(order[0], ['fast', 'slow']) # first deadlines are now without jitter
+    self.assertEqual(order[1:4], [['fast']] * 3)
+    self.assertEqual(sum(k.count('slow') for k in order), 3)
+    self.assertGreaterEqual(sum(k.count('fast') for k in order), 8)
+
+
+  def test_urgent(self):
+    async def run():
+      s = sim.Scheduler(10, min_intervals={'a': 0.1})
+      s.add('a')
+      s.done(await s.wait())
+      s.sent('a')
+      s.urgent('a') # held back by the minimal interval
+      t = utime.ticks_ms()
+      keys = await s.wait()
+      return keys, utime.ticks_diff(utime.ticks_ms(), t)
+    keys, dt = uasyncio.run(run())
+    self.assertEqual(keys, ['a'])
+    self.assertGreaterEqual(dt, 80)
+    self.assertLess(dt, 1000)
+
+
+  def test_sync(self):
+    s = sim.Scheduler(10)
+    s.sync(['a', 'b'])
+    s.sent('a')
+    dl = s.due['b']
+    s.sync(['b', 'c'])
+    self.assertEqual(sorted(s.due), ['b', 'c'])
+    self.assertEqual(s.due['b'], dl) # kept keys keep their deadline
+    self.assertNotIn('a', s.last)
+    self.assertEqual(sorted(s.todict()['next']), ['b', 'c'])
+
+
+  def test_remove(self):
+    s = sim.Scheduler(10)
+    s.sync(['a', 'b'])
+    s.remove('a')
+    s.remove('x')
+    self.assertEqual(list(s.due), ['b'])
+
+
+INBOX = '\n'.join('+CMGL: %d,"REC READ","+420",,"21/05/10,22:10:39+08"\nhello %d' % (i, i)
+                  for i in range(3)) + '\nOK'
+
+
+class TestATStream(unittest.TestCase):
+  def run_sim(self, f):
+    async def run():
+      s = bench._sim(simemu.ScriptedModem({'AT+CMGL=': INBOX}, latency_ms=2))
+      r = await f(s)
+      # the modem is free again and the next command gets its own answer
+      self.assertFalse(s.cmdq.busy)
+      self.assertTrue(await uasyncio.wait_for_ms(s.get_signalinfo(), 1000))
+      return r
+    return uasyncio.run(run())
+
+
+  def test_break(self):
+    async def f(s):
+      async with s.get_sms_iter() as it:
+        async for m in it:
+          break
+      return m
+    self.assertEqual(self.run_sim(f)[1], 'hello 0')
+
+
+  def test_exception(self):
+    async def f(s):
+      with self.assertRaises(ValueError):
+        async with s.get_sms_iter() as it:
+          async for _ in it:
+            raise ValueError()
+    self.run_sim(f)
+
+
+  def test_outside_async_with(self):
+    async def f(s):
+      with self.assertRaises(RuntimeError):
+        async for _ in s.get_sms_iter():
+          pass
+    self.run_sim(f)
+
+
+  def test_nested_command(self):
+    async def f(s):
+      with self.assertRaises(RuntimeError):
+        async with s.get_sms_iter() as it:
+          async for m in it:
+            await s.del_sms(int(m[0][0]))
+    self.run_sim(f)
+
+
+  def test_read_sms(self):
+    async def f(s):
+      return [await s.read_sms(i) for i in range(3)]
+    self.assertEqual(len(self.run_sim(f)), 3)
+
+
+class TestWake(unittest.TestCase):
+  def wake(self, psmode, hangs, status=None):
+    """
+    wake a sleeping modem that leaves the first hangs probes unanswered,
+    returns the number of PWRKEY pulses
+    """
+    class S(sim.SIM):
+      PROBE_TIMEOUT_MS = 20
+      WAKE_GRACE = 0.5
+      WAKE_TIMEOUT = 0.5
+    async def run():
+      m = simemu.ScriptedModem()
+      s = S(None, None, None, None, status_pin=None if status is None else 1)
+      if status is not None:
+        s.status_pin.value(status)
+      s.attach(m, m)
+      pulses = []
+      async def pulse():
+        pulses.append(1)
+        m.faults = []
+      s.signal_pwr = pulse
+      s.psmode = psmode
+      await s.sleep()
+      m.hang('AT', hangs)
+      await s.wake()
+      self.assertEqual(s.power['pwrkey_wakes'], len(pulses))
+      return len(pulses)
+    return uasyncio.run(run())
+
+
+  def test_slow(self):
+    self.assertEqual(self.wake('psm', 5), 0) # answers within WAKE_GRACE
+    self.assertEqual(self.wake('edrx', 10), 0)
+    self.assertEqual(self.wake('psm', 10, status=1), 0)
+
+
+  def test_psm(self):
+    self.assertEqual(self.wake('psm', 100), 1)
+    self.assertEqual(self.wake('psm', 100, status=0), 1)
+
+
+  def test_command_wakes(self):
+    async def run():
+      s = bench._sim(simemu.ScriptedModem())
+      await s.sleep()
+      r = await s.at('AT+CSQ', 'OK')
+      return r, s.asleep, s.power['cycles']
+    r, asleep, cycles = uasyncio.run(run())
+    self.assertTrue(r[0].startswith(b'+CSQ:'))
+    self.assertEqual((asleep, cycles), (False, 1))
+
+
+  def test_no_answer(self):
+    # up but hung, PWRKEY would switch it off
+    for psmode, status in (('edrx', None), ('psm', 1)):
+      with self.assertRaises(Exception):
+        self.wake(psmode, 100, status)
+
+
+class TestBatch(unittest.TestCase):
+  def test_size(self):
+    u = sim.MQTTUplink({})
+    u.sim = sim.SIM(None, None, None, None)
+    ts = '21/05/10,22:10:39+08'
+    for c in (codec.JSON, codec.CBOR):
+      u.CODEC = c
+      for n in range(5, 40):
+        items = [('key%02d' % i, 'v' * n, None) for i in range(30)]
+        ps = [p for g in u._groups(items, ts) for p in u._batches(g, ts)]
+        self.assertTrue(all(len(p) <= u.sim.MQTT_MAX_PAYLOAD for p in ps))
+        self.assertEqual(sum(len(c.decode(p)) - 1 for p in ps), 30)
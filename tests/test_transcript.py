@@ -0,0 +1,46 @@
+import shutil
+import tempfile
+import unittest
+
+import sim
+import simemu
+import transcript
+import uasyncio
+
+
+class TestRecorder(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+
+  def test_timer_flush(self):
+    async def run():
+      r = transcript.Recorder(self.dir)
+      r.FLUSH_MS = 20
+      r.record(transcript.TX, b'AT\r')
+      self.assertEqual(list(transcript.records(self.dir)), []) # still in RAM
+      t = uasyncio.create_task(r.flusher())
+      await uasyncio.sleep_ms(50)
+      t.cancel()
+    uasyncio.run(run())
+    self.assertEqual([(k, d) for k, _, d in transcript.records(self.dir)], [(transcript.TX, b'AT\r')])
+
+
+  def test_detach_flush(self):
+    class S(sim.SIM):
+      TRANSCRIPT = self.dir
+    async def run():
+      s = S(None, None, None, None)
+      m = simemu.ScriptedModem()
+      s.attach(m, m)
+      await s.at('AT', 'OK')
+      await s.detach()
+    uasyncio.run(run())
+    recs = [(k, d) for k, _, d in transcript.records(self.dir)]
+    self.assertEqual(recs[0], (transcript.MARK, b'attach'))
+    self.assertIn((transcript.TX, b'AT\r\n'), recs)
+
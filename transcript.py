@@ -0,0 +1,307 @@
+"""
+transcript.py
+
+Copyright (C) 2020-2021 Tomas Hlavacek (tmshlvck@gmail.com)
+
+UART transcript recorder and replayer for the sim driver
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import uos
+import ustruct
+import utime
+import uasyncio
+
+
+# Layout: <dir>/<n>.utr segment files of up to SEG_SIZE bytes, the oldest
+# beyond MAX_SEGS are removed. Every Recorder starts a new segment, so the
+# capture of the previous boot survives a crash.
+#
+# Record: kind(1) ticks_ms(4) len(2) data(len)
+#
+# A record cut by a power loss ends the reading of its segment.
+
+HDR = '<BIH'
+HDR_LEN = ustruct.calcsize(HDR)
+
+RX = 0 # bytes read from the modem
+TX = 1 # bytes written to the modem
+MARK = 2 # free-form note, e.g. attach or init
+
+
+class Recorder:
+  SEG_SIZE = 16384 # bytes
+  MAX_SEGS = 4
+  BUF_SIZE = 512 # records are collected in RAM and written in blocks of this size
+  FLUSH_MS = 3000 # flusher() writes a partly filled buffer this often
+
+  def __init__(self, path):
+    self.path = path
+    try:
+      uos.mkdir(path)
+    except OSError:
+      pass
+    self.segs = segments(path)
+    self.seg = self.segs[-1] + 1 if self.segs else 0
+    self.segs.append(self.seg)
+    self._trim()
+    self.size = 0
+    self.buf = bytearray(self.BUF_SIZE)
+    self.mv = memoryview(self.buf)
+    self.pos = 0
+    self.records = 0
+    self.nbytes = 0
+
+
+  def _seg(self, n):
+    return '%s/%d.utr' % (self.path, n)
+
+
+  def _trim(self):
+    while len(self.segs) > self.MAX_SEGS:
+      try:
+        uos.remove(self._seg(self.segs.pop(0)))
+      except OSError:
+        pass
+
+
+  def record(self, kind, data):
+    n = len(data)
+    self.records += 1
+    self.nbytes += n
+    if self.pos + HDR_LEN + n > self.BUF_SIZE:
+      self.flush()
+    if HDR_LEN + n > self.BUF_SIZE:
+      self._write(ustruct.pack(HDR, kind, utime.ticks_ms(), n) + bytes(data))
+      return
+    ustruct.pack_into(HDR, self.buf, self.pos, kind, utime.ticks_ms(), n)
+    self.mv[self.pos+HDR_LEN:self.pos+HDR_LEN+n] = data
+    self.pos += HDR_LEN + n
+
+
+  def mark(self, note):
+    self.record(MARK, note.encode() if type(note) is str else note)
+
+
+  def flush(self):
+    if self.pos:
+      self._write(self.mv[:self.pos])
+      self.pos = 0
+
+
+  async def flusher(self):
+    """
+    task writing the buffer every FLUSH_MS, records of an idle modem
+    would otherwise wait in RAM for the next BUF_SIZE bytes
+    """
+    while True:
+      await uasyncio.sleep_ms(self.FLUSH_MS)
+      self.flush()
+
+
+  def _write(self, b):
+    if self.size and self.size + len(b) > self.SEG_SIZE:
+      self.seg += 1
+      self.segs.append(self.seg)
+      self._trim()
+      self.size = 0
+    with open(self._seg(self.seg), 'ab') as f:
+      f.write(b)
+    self.size += len(b)
+
+
+  def tap(self, rdr, wtr):
+    """
+    returns the reader/writer pair wrapped to record all traffic
+    """
+    return TapReader(rdr, self), TapWriter(wtr, self)
+
+
+  def stats(self):
+    return {'records': self.records, 'bytes': self.nbytes, 'segment': self.seg}
+
+
+class TapReader:
+  def __init__(self, s, rec):
+    self.s = s
+    self.rec = rec
+
+
+  async def read(self, n):
+    b = await self.s.read(n)
+    if b:
+      self.rec.record(RX, b)
+    return b
+
+
+  async def readline(self):
+    b = await self.s.readline()
+    if b:
+      self.rec.record(RX, b)
+    return b
+
+
+  def close(self):
+    self.rec.flush()
+    self.s.close()
+
+
+class TapWriter:
+  def __init__(self, s, rec):
+    self.s = s
+    self.rec = rec
+
+
+  async def awrite(self, b):
+    self.rec.record(TX, b)
+    await self.s.awrite(b)
+
+
+  async def drain(self):
+    await self.s.drain()
+
+
+  def close(self):
+    self.rec.flush()
+    self.s.close()
+
+
+def segments(path):
+  try:
+    return sorted(int(fn[:-4]) for fn in uos.listdir(path) if fn.endswith('.utr'))
+  except OSError:
+    return []
+
+
+def records(path, seg=None):
+  """
+  yields (kind, ticks_ms, data) of all segments in path, or of segment seg only
+  """
+  for n in segments(path) if seg is None else [seg]:
+    with open('%s/%d.utr' % (path, n), 'rb') as f:
+      while True:
+        h = f.read(HDR_LEN)
+        if len(h) < HDR_LEN:
+          break
+        kind, ts, ln = ustruct.unpack(HDR, h)
+        data = f.read(ln)
+        if len(data) < ln:
+          break
+        yield kind, ts, data
+
+
+class Replayer:
+  """
+  Reader and writer for SIM.attach() playing a capture back. Received bytes
+  are released with the recorded gaps divided by speed (0 = no delays),
+  recorded writes gate what follows them: a response is released only after
+  the driver wrote as many bytes as the capture shows for its command.
+  Writes that differ from the capture count in mismatches, a write that does
+  not come within STALL_MS is skipped and counted in stalls.
+  """
+  STALL_MS = 5000
+
+  def __init__(self, recs, speed=1.0):
+    self.recs = list(records(recs)) if type(recs) is str else list(recs)
+    self.speed = speed
+    self.rx = b''
+    self.rxev = uasyncio.Event()
+    self.tx = b''
+    self.txev = uasyncio.Event()
+    self.done = uasyncio.Event()
+    self.task = None
+    self.mismatches = 0
+    self.stalls = 0
+    self.played = 0
+
+
+  async def _play(self):
+    prev = None
+    for kind, ts, data in self.recs:
+      if kind == RX:
+        if prev is not None and self.speed:
+          dl = int(utime.ticks_diff(ts, prev) / self.speed)
+          if dl > 0:
+            await uasyncio.sleep_ms(dl)
+        self.rx += data
+        self.rxev.set()
+      elif kind == TX:
+        while len(self.tx) < len(data):
+          self.txev.clear()
+          try:
+            await uasyncio.wait_for_ms(self.txev.wait(), self.STALL_MS)
+          except uasyncio.TimeoutError:
+            break
+        if len(self.tx) < len(data):
+          self.stalls += 1
+        elif self.tx[:len(data)] != data:
+          self.mismatches += 1
+        self.tx = self.tx[len(data):]
+      prev = ts
+      self.played += 1
+    self.done.set()
+
+
+  def _start(self):
+    if self.task is None:
+      self.task = uasyncio.create_task(self._play())
+
+
+  # writer side
+  async def awrite(self, data):
+    self._start()
+    self.tx += data
+    self.txev.set()
+
+
+  async def drain(self):
+    pass
+
+
+  # reader side
+  async def read(self, n):
+    self._start()
+    while not self.rx:
+      self.rxev.clear()
+      await self.rxev.wait()
+    r = self.rx[:n]
+    self.rx = self.rx[n:]
+    return r
+
+
+  async def readline(self):
+    self._start()
+    while self.rx.find(b'\n') < 0:
+      self.rxev.clear()
+      await self.rxev.wait()
+    i = self.rx.find(b'\n')
+    r = self.rx[:i+1]
+    self.rx = self.rx[i+1:]
+    return r
+
+
+  def close(self):
+    if self.task:
+      self.task.cancel()
+
+
+  def pty(self):
+    """
+    CPython only: serve the replay on a pseudo terminal, see simemu.serve_pty()
+    """
+    import simemu
+    return simemu.serve_pty(self)
+
+
+  def stats(self):
+    return {'records': len(self.recs), 'played': self.played,
+            'mismatches': self.mismatches, 'stalls': self.stalls}